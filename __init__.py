@@ -25,6 +25,30 @@ from .const import (
     DEFAULT_REPORT_UNKNOWN,
     DEFAULT_DISCOVERY,
     DEFAULT_ESPRUINO_PATH,
+    DEFAULT_CONTINUOUS_SCAN,
+    DEFAULT_BUFFER_SIZE,
+    DEFAULT_BUFFER_POLICY,
+    BUFFER_POLICIES,
+    DEFAULT_INSTANT_SWITCHES,
+    DEFAULT_NATIVE_SCAN,
+    DEFAULT_EWMA_ALPHA,
+    DEFAULT_METRICS,
+    DEFAULT_CHANGE_ONLY,
+    DEFAULT_DEADBAND,
+    DEFAULT_HEARTBEAT,
+    DEFAULT_BPF_FILTER,
+    DEFAULT_PROGRAM_CONCURRENCY,
+    DEFAULT_PROGRAM_TIMEOUT,
+    DEFAULT_DEDUP_WINDOW,
+    DEFAULT_DECODE_CACHE,
+    DEFAULT_BATCH_ENGINE,
+    DEFAULT_ADAPTIVE_PERIOD,
+    DEFAULT_MIN_PERIOD,
+    DEFAULT_MAX_PERIOD,
+    DEFAULT_WATCHDOG,
+    DEFAULT_STALL_TIMEOUT,
+    DEFAULT_DECODE_WORKERS,
+    DEFAULT_HISTORY,
     CONF_ROUNDING,
     CONF_DECIMALS,
     CONF_PERIOD,
@@ -35,6 +59,30 @@ from .const import (
     CONF_BATT_ENTITIES,
     CONF_REPORT_UNKNOWN,
     CONF_ESPRUINO_PATH,
+    CONF_CONTINUOUS_SCAN,
+    CONF_BUFFER_SIZE,
+    CONF_BUFFER_POLICY,
+    CONF_INSTANT_SWITCHES,
+    CONF_NATIVE_SCAN,
+    CONF_EWMA_ALPHA,
+    CONF_CAPTURE_FILE,
+    CONF_METRICS,
+    CONF_CHANGE_ONLY,
+    CONF_DEADBAND,
+    CONF_HEARTBEAT,
+    CONF_BPF_FILTER,
+    CONF_PROGRAM_CONCURRENCY,
+    CONF_PROGRAM_TIMEOUT,
+    CONF_DEDUP_WINDOW,
+    CONF_DECODE_CACHE,
+    CONF_BATCH_ENGINE,
+    CONF_ADAPTIVE_PERIOD,
+    CONF_MIN_PERIOD,
+    CONF_MAX_PERIOD,
+    CONF_WATCHDOG,
+    CONF_STALL_TIMEOUT,
+    CONF_DECODE_WORKERS,
+    CONF_HISTORY,
     DOMAIN
 )
 
@@ -43,6 +91,20 @@ _LOGGER = logging.getLogger(__name__)
 # regex constants for configuration schema
 MAC_REGEX = "(?i)^(?:[0-9A-F]{2}[:]){5}(?:[0-9A-F]{2})$"
 
+
+def validate_decode_workers(config):
+    """Refuse decode_workers with native_scan.
+
+    Collecting the readings of the workers waits on their pipes, which
+    would block the event loop the native update cycle runs on.
+    """
+    if config[CONF_NATIVE_SCAN] and config[CONF_DECODE_WORKERS]:
+        raise vol.Invalid(
+            "{} can not be used with {}".format(CONF_DECODE_WORKERS, CONF_NATIVE_SCAN)
+        )
+    return config
+
+
 DEVICE_SCHEMA = vol.Schema(
     {
         vol.Optional(CONF_MAC): cv.string,
@@ -53,7 +115,7 @@ DEVICE_SCHEMA = vol.Schema(
 
 CONFIG_SCHEMA = vol.Schema(
     {
-        DOMAIN: vol.Schema(
+        DOMAIN: vol.All(
             {
                 vol.Optional(CONF_ROUNDING, default=DEFAULT_ROUNDING): cv.boolean,
                 vol.Optional(CONF_DECIMALS, default=DEFAULT_DECIMALS): cv.positive_int,
@@ -72,10 +134,69 @@ CONFIG_SCHEMA = vol.Schema(
                 ): cv.boolean,
                 vol.Optional(CONF_DISCOVERY, default=DEFAULT_DISCOVERY): cv.boolean,
                 vol.Optional(CONF_ESPRUINO_PATH, default=DEFAULT_ESPRUINO_PATH): cv.isfile,
+                vol.Optional(
+                    CONF_CONTINUOUS_SCAN, default=DEFAULT_CONTINUOUS_SCAN
+                ): cv.boolean,
+                vol.Optional(CONF_BUFFER_SIZE, default=DEFAULT_BUFFER_SIZE): vol.All(
+                    vol.Coerce(int), vol.Range(min=1)
+                ),
+                vol.Optional(
+                    CONF_BUFFER_POLICY, default=DEFAULT_BUFFER_POLICY
+                ): vol.In(BUFFER_POLICIES),
+                vol.Optional(
+                    CONF_INSTANT_SWITCHES, default=DEFAULT_INSTANT_SWITCHES
+                ): cv.boolean,
+                vol.Optional(CONF_NATIVE_SCAN, default=DEFAULT_NATIVE_SCAN): cv.boolean,
+                vol.Optional(CONF_EWMA_ALPHA, default=DEFAULT_EWMA_ALPHA): vol.All(
+                    vol.Coerce(float), vol.Range(min=0, max=1)
+                ),
+                vol.Optional(CONF_CAPTURE_FILE): cv.string,
+                vol.Optional(CONF_METRICS, default=DEFAULT_METRICS): cv.boolean,
+                vol.Optional(CONF_CHANGE_ONLY, default=DEFAULT_CHANGE_ONLY): cv.boolean,
+                vol.Optional(CONF_DEADBAND, default=DEFAULT_DEADBAND): vol.All(
+                    vol.Coerce(float), vol.Range(min=0)
+                ),
+                vol.Optional(
+                    CONF_HEARTBEAT, default=DEFAULT_HEARTBEAT
+                ): cv.positive_int,
+                vol.Optional(CONF_BPF_FILTER, default=DEFAULT_BPF_FILTER): cv.boolean,
+                vol.Optional(
+                    CONF_PROGRAM_CONCURRENCY, default=DEFAULT_PROGRAM_CONCURRENCY
+                ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(
+                    CONF_PROGRAM_TIMEOUT, default=DEFAULT_PROGRAM_TIMEOUT
+                ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(
+                    CONF_DEDUP_WINDOW, default=DEFAULT_DEDUP_WINDOW
+                ): cv.positive_int,
+                vol.Optional(
+                    CONF_DECODE_CACHE, default=DEFAULT_DECODE_CACHE
+                ): cv.positive_int,
+                vol.Optional(
+                    CONF_BATCH_ENGINE, default=DEFAULT_BATCH_ENGINE
+                ): cv.boolean,
+                vol.Optional(
+                    CONF_ADAPTIVE_PERIOD, default=DEFAULT_ADAPTIVE_PERIOD
+                ): cv.boolean,
+                vol.Optional(CONF_MIN_PERIOD, default=DEFAULT_MIN_PERIOD): vol.All(
+                    vol.Coerce(int), vol.Range(min=1)
+                ),
+                vol.Optional(CONF_MAX_PERIOD, default=DEFAULT_MAX_PERIOD): vol.All(
+                    vol.Coerce(int), vol.Range(min=1)
+                ),
+                vol.Optional(CONF_WATCHDOG, default=DEFAULT_WATCHDOG): cv.boolean,
+                vol.Optional(
+                    CONF_STALL_TIMEOUT, default=DEFAULT_STALL_TIMEOUT
+                ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(
+                    CONF_DECODE_WORKERS, default=DEFAULT_DECODE_WORKERS
+                ): vol.All(vol.Coerce(int), vol.Range(min=0)),
+                vol.Optional(CONF_HISTORY, default=DEFAULT_HISTORY): cv.boolean,
                 vol.Optional(CONF_DEVICES, default=[]): vol.All(
                     cv.ensure_list, [DEVICE_SCHEMA]
                 ),
-            }
+            },
+            validate_decode_workers,
         )
     },
     extra=vol.ALLOW_EXTRA,
@@ -0,0 +1,362 @@
+"""Command line tools for scanning, decoding and profiling without Home Assistant.
+
+Run the directory of the integration::
+
+    python puckjs scan -i 0
+    python puckjs scan --replay capture.cap
+    python puckjs decode capture.cap --summary
+    python puckjs profile --frames 100000
+    python puckjs bench --json > results.json
+
+scan needs aioblescan and a Bluetooth adapter unless it replays a
+capture, such as one written by ``python puckjs bench --record``.
+
+``python -m puckjs`` works too where Home Assistant is installed. It
+imports the package, whose __init__ sets up the integration and needs
+Home Assistant. Run as a directory, this module registers the directory
+as the puckjs package itself, without its __init__, so the tools only
+import the modules they use. The decode workers spawned by the
+benchmarks run this module again and do the same.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import types
+
+if not __package__:
+    # run as a directory, or as a spawned worker of such a run
+    _DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+    if sys.path and os.path.abspath(sys.path[0]) == _DIRECTORY:
+        # the modules of the integration are only imported from the package
+        del sys.path[0]
+    if "puckjs" not in sys.modules:
+        _PACKAGE = types.ModuleType("puckjs", "The puck.js integration.")
+        _PACKAGE.__path__ = [_DIRECTORY]
+        sys.modules["puckjs"] = _PACKAGE
+    __package__ = "puckjs"
+    __spec__ = None
+
+
+def default_limits():
+    """Return the temperature limits of the devices not configured."""
+    from .const import CONF_TMAX, CONF_TMIN
+    from .sharding import DeviceLimits
+
+    return DeviceLimits(CONF_TMIN, CONF_TMAX)
+
+
+def reading_fields(reading):
+    """Return a PuckReading as a dict."""
+    return {name: getattr(reading, name) for name in reading.__slots__}
+
+
+def has_data(reading):
+    """Return True if a PuckReading holds more than the rssi."""
+    return any(
+        value is not None
+        for value in (
+            reading.temperature,
+            reading.battery,
+            reading.direction,
+            reading.button,
+        )
+    )
+
+
+def print_reading(reading, as_json=False):
+    """Print a PuckReading as a line of text or JSON."""
+    fields = reading_fields(reading)
+    if as_json:
+        print(json.dumps(fields), flush=True)
+        return
+    print(
+        "{time} {mac} rssi {rssi} temperature {temperature} battery {battery} "
+        "button {button} direction {direction} sequence {sequence}".format(
+            time=time.strftime("%H:%M:%S"), **fields
+        ),
+        flush=True,
+    )
+
+
+def device_summary(readings_by_mac):
+    """Return what would be published per MAC, as plain values."""
+    summary = {}
+    for mac, readings in sorted(readings_by_mac.items()):
+        temperature = readings.temperature
+        summary[mac] = {
+            "temperature_mean": None if temperature is None else temperature.mean(),
+            "temperature_median": None
+            if temperature is None
+            else temperature.median(),
+            "temperatures": 0 if temperature is None else temperature.count,
+            "rssi": readings.rssi(),
+            "battery": readings.battery,
+            "button": readings.button,
+            "direction": readings.direction,
+            "lost": readings.lost,
+        }
+    return summary
+
+
+def scan(args):
+    """Print the puck.js readings received live or from a replayed capture.
+
+    Returns 1 if an adapter could not be opened.
+    """
+    from .const import CONF_ACTIVE_SCAN, CONF_HCI_INTERFACE
+    from .parser import compile_whitelist, parse_raw_message
+    from .scanner import BLEScanner
+
+    whitelist = compile_whitelist(args.mac)
+    scanner = BLEScanner()
+
+    def on_frame(frame):
+        reading = parse_raw_message(frame, whitelist)
+        if reading is not None and has_data(reading):
+            print_reading(reading, args.json)
+
+    scanner.on_frame = on_frame
+    # only the readings are printed, nothing is buffered
+    scanner.frame_filter = lambda frame: False
+    if args.replay:
+        scanner.replay(args.replay, args.speed)
+    else:
+        scanner.start(
+            {CONF_ACTIVE_SCAN: args.active, CONF_HCI_INTERFACE: args.interface}
+        )
+    deadline = None if args.duration is None else time.monotonic() + args.duration
+    status = 0
+    try:
+        while scanner.is_running():
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            time.sleep(0.2)
+        else:
+            # an HCIdump thread ends when its adapter can not be opened
+            if not args.replay:
+                status = 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scanner.stop()
+    return status
+
+
+def decode(args):
+    """Print the readings of a capture file, or a summary per device."""
+    from .capture import read_capture
+    from .parser import compile_whitelist, parse_raw_message
+    from .processing import FrameProcessor
+
+    whitelist = compile_whitelist(args.mac)
+    frames = (frame for _, _, frame in read_capture(args.path))
+    if not args.summary:
+        for frame in frames:
+            reading = parse_raw_message(frame, whitelist)
+            if reading is not None and has_data(reading):
+                print_reading(reading, args.json)
+        return 0
+    processor = FrameProcessor(whitelist, {}, default_limits())
+    processor.add_frames(frames)
+    summary = device_summary(processor.collect())
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return 0
+    for mac, device in summary.items():
+        print(
+            "{} temperature {temperature_mean} (median {temperature_median}, "
+            "{temperatures} readings) rssi {rssi} battery {battery} button {button} "
+            "direction {direction} lost {lost}".format(mac, **device)
+        )
+    return 0
+
+
+def timed(stage, func, items):
+    """Run func on every item, observing the latency in stage.
+
+    Returns the items func returned True for and the results that are
+    not None or False.
+    """
+    histogram = stage["latency"]
+    results = []
+    start = time.perf_counter()
+    for item in items:
+        before = time.perf_counter()
+        result = func(item)
+        histogram.observe(time.perf_counter() - before)
+        if result is not None and result is not False:
+            results.append(item if result is True else result)
+    stage["total"] += time.perf_counter() - start
+    return results
+
+
+def profile_stages(frames, whitelist):
+    """Run frames through the stages of an update cycle, timing each.
+
+    The stages are buffering by BLEScanner.collect, the raw prefilter,
+    parse_raw_message on the frames passing it, folding the readings
+    into a FrameProcessor and collecting the published states.
+    """
+    from .metrics import Histogram
+    from .parser import parse_raw_message, prefilter_raw_message
+    from .processing import FrameProcessor
+    from .scanner import BLEScanner
+
+    stages = {
+        name: {"total": 0.0, "latency": Histogram()}
+        for name in ("collect", "prefilter", "parse", "fold", "publish")
+    }
+    scanner = BLEScanner(buffer_size=max(len(frames), 1))
+    processor = FrameProcessor(whitelist, {}, default_limits())
+    timed(stages["collect"], scanner.collect, frames)
+    buffered = scanner.drain()
+    passed = timed(
+        stages["prefilter"],
+        lambda frame: prefilter_raw_message(frame, whitelist),
+        buffered,
+    )
+    readings = timed(
+        stages["parse"], lambda frame: parse_raw_message(frame, whitelist), passed
+    )
+    timed(stages["fold"], processor.add_reading, readings)
+    published = timed(
+        stages["publish"], lambda _: device_summary(processor.collect()), [None]
+    )
+    counts = {
+        "collect": len(frames),
+        "prefilter": len(buffered),
+        "parse": len(passed),
+        "fold": len(readings),
+        "publish": len(published[0]) if published else 0,
+    }
+    results = []
+    for name, stage in stages.items():
+        latency = stage["latency"]
+        results.append(
+            {
+                "stage": name,
+                "items": counts[name],
+                "total_ms": round(stage["total"] * 1000, 2),
+                "per_s": round(counts[name] / stage["total"])
+                if stage["total"]
+                else 0,
+                "p50_us": None
+                if latency.count == 0
+                else round(latency.quantile(0.5) * 1e6, 1),
+                "p99_us": None
+                if latency.count == 0
+                else round(latency.quantile(0.99) * 1e6, 1),
+            }
+        )
+    return results
+
+
+def profile(args):
+    """Report the throughput and latency of the stages of the hot path."""
+    from .capture import read_capture
+    from .parser import compile_whitelist
+
+    if args.capture:
+        frames = [frame for _, _, frame in read_capture(args.capture)]
+    else:
+        from .bench import synthetic_capture
+
+        frames, _ = synthetic_capture(
+            args.frames, pucks=args.devices, puck_ratio=args.puck_ratio
+        )
+    results = profile_stages(frames, compile_whitelist(args.mac))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+    for result in results:
+        print(
+            "{stage:9} {items:8} items {total_ms:9} ms {per_s:9}/s "
+            "p50 <= {p50_us} us, p99 <= {p99_us} us".format(**result)
+        )
+    return 0
+
+
+def bench(args):
+    """Run the benchmarks, see python puckjs bench --help."""
+    from .bench import main as bench_main
+
+    bench_main(args.arguments, "puckjs bench")
+    return 0
+
+
+def main(argv=None):
+    """Run a command line tool, return the exit status."""
+    parser = argparse.ArgumentParser(
+        prog="puckjs", description=__doc__.splitlines()[0]
+    )
+    parser.add_argument("--debug", action="store_true", help="log debug messages")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scan_parser = commands.add_parser("scan", help=scan.__doc__)
+    scan_parser.add_argument(
+        "-i",
+        "--interface",
+        type=int,
+        nargs="+",
+        default=[0],
+        help="HCI interface numbers (default 0)",
+    )
+    scan_parser.add_argument("--active", action="store_true", help="scan actively")
+    scan_parser.add_argument(
+        "--replay", metavar="PATH", help="replay a capture in place of the adapters"
+    )
+    scan_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1,
+        help="replay speed, 1 as recorded (default), 0 as fast as possible",
+    )
+    scan_parser.add_argument(
+        "--duration", type=float, help="seconds to scan, until interrupted if omitted"
+    )
+    scan_parser.set_defaults(func=scan)
+
+    decode_parser = commands.add_parser("decode", help=decode.__doc__)
+    decode_parser.add_argument("path", help="capture file")
+    decode_parser.add_argument(
+        "--summary", action="store_true", help="print what is published per device"
+    )
+    decode_parser.set_defaults(func=decode)
+
+    profile_parser = commands.add_parser("profile", help=profile.__doc__)
+    profile_parser.add_argument(
+        "--capture",
+        metavar="PATH",
+        help="profile a capture, synthetic frames if omitted",
+    )
+    profile_parser.add_argument("--frames", type=int, default=100000)
+    profile_parser.add_argument("--devices", type=int, default=100)
+    profile_parser.add_argument(
+        "--puck-ratio",
+        type=float,
+        default=0.1,
+        help="share of the synthetic frames sent by pucks",
+    )
+    profile_parser.set_defaults(func=profile)
+
+    # the options of the benchmarks, --help included, are passed on
+    bench_parser = commands.add_parser("bench", help=bench.__doc__, add_help=False)
+    bench_parser.set_defaults(func=bench)
+
+    for command in (scan_parser, decode_parser, profile_parser):
+        command.add_argument(
+            "--mac", nargs="+", default=[], help="only these MAC addresses"
+        )
+        command.add_argument("--json", action="store_true", help="print JSON")
+    args, args.arguments = parser.parse_known_args(argv)
+    if args.arguments and args.command != "bench":
+        parser.error("unrecognized arguments: " + " ".join(args.arguments))
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
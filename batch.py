@@ -0,0 +1,478 @@
+"""Vectorized folding of an update cycle's frames with NumPy.
+
+BatchProcessor is a drop-in for processing.FrameProcessor for large
+installations. Per frame it only locates the fields of the advertising
+report and appends them to columns; the binary v1 payloads are decoded,
+spike filtered and reduced per device with grouped NumPy reductions when
+the cycle is collected. Needs numpy, which is not a requirement of the
+integration.
+"""
+import logging
+from time import perf_counter
+
+import numpy as np
+
+from .const import PUCKJS_MANUFACTURER_ID
+from .parser import (
+    BINARY_PAYLOAD_V1,
+    FLAG_BUTTON,
+    FLAG_DIRECTION,
+    PAYLOAD_V1,
+    PuckReading,
+    decode_payload,
+    parse_raw_message,
+    raw_address,
+    reject_reason,
+    scan_raw_message,
+)
+from .processing import DeviceReadings
+
+_LOGGER = logging.getLogger(__name__)
+
+# BINARY_PAYLOAD_V1 as a structured dtype
+PAYLOAD_V1_DTYPE = np.dtype(
+    [
+        ("version", "u1"),
+        ("battery", "u1"),
+        ("temperature", "<i2"),
+        ("flags", "u1"),
+        ("sequence", "u1"),
+    ]
+)
+
+
+class BatchAggregate:
+    """Temperatures of a device in an update cycle, reduced by BatchProcessor.
+
+    Has the interface of stats.MeasurementAggregator that the update
+    cycle uses.
+    """
+
+    __slots__ = ("count", "ewma", "_mean", "_median")
+
+    def __init__(self, count, mean, median, ewma=None):
+        """Initialize the aggregate with the reduced values."""
+        self.count = count
+        self.ewma = ewma
+        self._mean = mean
+        self._median = median
+
+    def mean(self):
+        """Return the mean of the period's samples."""
+        return self._mean
+
+    def median(self):
+        """Return the median of the period's samples."""
+        return self._median
+
+
+# columns of the rows folded in per update cycle, by the device index column
+# they belong to; the v1 payloads are packed in _v1_payloads
+ROW_COLUMNS = (
+    ("_rssi_index", "_rssi"),
+    ("_v1_index", "_v1_position"),
+    (
+        "_v0_index",
+        "_v0_position",
+        "_v0_temperature",
+        "_v0_battery",
+        "_v0_flags",
+    ),
+)
+
+
+# the flags of the switches published by the sensors
+SWITCH_FLAGS = FLAG_BUTTON | FLAG_DIRECTION
+
+
+def _group_starts(keys):
+    """Return the start of every run of equal values in a sorted array."""
+    if not len(keys):
+        # every device of the cycle is held
+        return np.zeros(0, dtype=np.intp)
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+class BatchProcessor:
+    """Fold HCI frames into DeviceReadings per MAC with NumPy.
+
+    Takes the arguments of FrameProcessor and gives the same readings,
+    with means to floating point accuracy. The decode cache is not used,
+    a frame is never fully decoded on arrival. With a PipelineMetrics the
+    rejected frames are counted and the parse time is recorded per frame
+    as the mean of each batch.
+
+    The readings of devices in the hold of collect() stay in the columns
+    for a later cycle, unless their button or direction changed.
+    """
+
+    def __init__(
+        self,
+        whitelist,
+        devices,
+        default_device,
+        ewma_alpha=None,
+        log_spikes=False,
+        report_unknown=False,
+        metrics=None,
+        cache_size=0,
+    ):
+        """Initialize the processor, whitelist as for parse_raw_message."""
+        self.whitelist = whitelist
+        self.devices = devices
+        self.default_device = default_device
+        self.ewma_alpha = ewma_alpha or None
+        self.log_spikes = log_spikes
+        self.report_unknown = report_unknown
+        self.metrics = metrics
+        # last sequence counter and temperature EWMA per MAC
+        self._sequences = {}
+        self._ewma = {}
+        # button and direction flags per MAC as last collected
+        self._switches = {}
+        # MACs heard in the last collected cycle without readings
+        self.silent = []
+        # position of the last frame, frames are ordered by it per device
+        self._position = 0
+        self._reset()
+
+    def _reset(self):
+        # raw address -> device index of the cycle, and the MACs by index
+        self._index = {}
+        self._macs = []
+        # rssi of every accepted frame
+        self._rssi_index = []
+        self._rssi = []
+        # binary v1 payloads, with their device index and frame position
+        self._v1_index = []
+        self._v1_position = []
+        self._v1_payloads = bytearray()
+        # fresh v1 columns, set by _fold_sequences
+        self._v1 = None
+        # other decoded payloads
+        self._v0_index = []
+        self._v0_position = []
+        self._v0_temperature = []
+        self._v0_battery = []
+        self._v0_flags = []
+
+    def _device(self, address):
+        index = self._index.get(address)
+        if index is None:
+            index = self._index[address] = len(self._macs)
+            self._macs.append(address[::-1].hex(":"))
+        return index
+
+    def add_frames(self, frames):
+        """Locate the fields of the frames of an update cycle."""
+        start = perf_counter()
+        metrics = self.metrics
+        whitelist = self.whitelist
+        device = self._device
+        rssi_index = self._rssi_index
+        rssi_values = self._rssi
+        v1_index = self._v1_index
+        v1_position = self._v1_position
+        v1_payloads = self._v1_payloads
+        position = self._position
+        parsed = 0
+        for msg in frames:
+            position += 1
+            scanned = scan_raw_message(msg)
+            if scanned is None:
+                reading = parse_raw_message(msg, whitelist, self.report_unknown)
+                if reading is None:
+                    if metrics is not None:
+                        metrics.reject(reject_reason(msg, whitelist))
+                    continue
+                parsed += 1
+                self._add_reading(reading, position)
+                continue
+            address, rssi, manufacturer_id, pstart, pstop = scanned
+            if (whitelist and address not in whitelist) or (
+                manufacturer_id is not None
+                and manufacturer_id != PUCKJS_MANUFACTURER_ID
+            ):
+                if metrics is not None:
+                    metrics.reject(reject_reason(msg, whitelist))
+                continue
+            index = device(address)
+            if manufacturer_id is None:
+                pass
+            elif pstop - pstart == BINARY_PAYLOAD_V1.size and msg[pstart] == PAYLOAD_V1:
+                v1_index.append(index)
+                v1_position.append(position)
+                v1_payloads += msg[pstart:pstop]
+            else:
+                reading = decode_payload(msg, pstart, pstop, rssi, self._macs[index])
+                if reading is None:
+                    if metrics is not None:
+                        metrics.reject("payload")
+                    continue
+                self._add_payload(index, reading, position)
+            parsed += 1
+            if rssi:
+                rssi_index.append(index)
+                rssi_values.append(rssi)
+        self._position = position
+        if metrics is not None and frames:
+            metrics.frames_parsed += parsed
+            metrics.parse_time.observe((perf_counter() - start) / len(frames))
+
+    def add_frame(self, msg):
+        """Locate the fields of a frame."""
+        self.add_frames((msg,))
+
+    def _add_reading(self, reading, position):
+        index = self._device(raw_address(reading.mac))
+        if reading.temperature is not None:
+            self._add_payload(index, reading, position)
+        if reading.rssi:
+            self._rssi_index.append(index)
+            self._rssi.append(reading.rssi)
+
+    def _add_payload(self, index, reading, position):
+        self._v0_index.append(index)
+        self._v0_position.append(position)
+        self._v0_temperature.append(reading.temperature)
+        self._v0_battery.append(reading.battery)
+        self._v0_flags.append(
+            (FLAG_DIRECTION if reading.direction else 0)
+            | (FLAG_BUTTON if reading.button else 0)
+        )
+
+    def cache_stats(self):
+        """Return None, the batch engine has no decode cache."""
+        return None
+
+    def collect(self, hold=None):
+        """Return the DeviceReadings of the cycle by MAC and start a new one.
+
+        The readings of the MACs in hold are kept for a later cycle,
+        unless their button or direction changed since last collected.
+        The other MACs heard without readings are left in silent.
+        """
+        macs = self._macs
+        devices = len(macs)
+        self.silent = []
+        if not devices:
+            return {}
+        held = held_devices = None
+        if hold:
+            held_devices = np.fromiter((mac in hold for mac in macs), bool, devices)
+            if held_devices.any():
+                self._release_switched(held_devices)
+            if held_devices.any():
+                held = self._take_held(held_devices)
+        readings = {}
+        lost, sequenced = self._fold_sequences(devices)
+        index, position, temperature, battery, flags = self._payload_columns()
+        # rssi
+        rssi_index = np.array(self._rssi_index, dtype=np.intp)
+        rssi = np.array(self._rssi, dtype=np.float64)
+        rssi_sum = np.bincount(rssi_index, rssi, devices)
+        rssi_count = np.bincount(rssi_index, minlength=devices)
+        # battery and flags of the last advertisement per device
+        order = np.lexsort((position, index))
+        index = index[order]
+        temperature = temperature[order]
+        battery = battery[order]
+        flags = flags[order]
+        starts = _group_starts(index)
+        with_data = index[starts]
+        last = np.r_[starts[1:], len(index)] - 1
+        temperatures = self._fold_temperatures(index, temperature, devices)
+        silent = np.ones(devices, dtype=bool)
+        silent[with_data] = False
+        if held_devices is not None:
+            silent &= ~held_devices
+        self.silent = [macs[device] for device in np.flatnonzero(silent).tolist()]
+        for device, last_row in zip(with_data.tolist(), last.tolist()):
+            mac = macs[device]
+            device_readings = DeviceReadings(PuckReading.type)
+            device_readings.battery = int(battery[last_row])
+            device_readings.direction = int(bool(flags[last_row] & FLAG_DIRECTION))
+            device_readings.button = int(bool(flags[last_row] & FLAG_BUTTON))
+            device_readings.temperature = temperatures.get(device)
+            device_readings.rssi_sum = int(rssi_sum[device])
+            device_readings.rssi_count = int(rssi_count[device])
+            if sequenced[device]:
+                device_readings.lost = int(lost[device])
+            device_readings.has_data = True
+            readings[mac] = device_readings
+            self._switches[mac] = int(flags[last_row]) & SWITCH_FLAGS
+        self._reset()
+        if held is not None:
+            self._restore_held(*held)
+        return readings
+
+    def _release_switched(self, held):
+        """Clear the held devices whose last flags changed the switches."""
+        payloads = np.frombuffer(self._v1_payloads, dtype=PAYLOAD_V1_DTYPE)
+        index = np.array(self._v0_index + self._v1_index, dtype=np.intp)
+        if not len(index):
+            return
+        position = np.array(self._v0_position + self._v1_position, dtype=np.int64)
+        flags = np.concatenate(
+            (np.array(self._v0_flags, dtype=np.int64), payloads["flags"])
+        )
+        order = np.lexsort((position, index))
+        index = index[order]
+        last = np.r_[_group_starts(index)[1:], len(index)] - 1
+        for device, value in zip(index[last].tolist(), flags[order][last].tolist()):
+            if held[device] and self._switches.get(self._macs[device]) != (
+                value & SWITCH_FLAGS
+            ):
+                held[device] = False
+
+    def _take_held(self, held):
+        """Take the rows of the held device indexes out of the columns.
+
+        Returns the held MACs, their raw addresses and their rows, with
+        the device indexes renumbered for _restore_held().
+        """
+        held_devices = np.flatnonzero(held)
+        renumbered = np.full(len(held), -1, dtype=np.intp)
+        renumbered[held_devices] = np.arange(len(held_devices))
+        rows = {}
+        for columns in ROW_COLUMNS:
+            index = np.array(getattr(self, columns[0]), dtype=np.intp)
+            mask = held[index]
+            rows[columns[0]] = renumbered[index[mask]].tolist()
+            setattr(self, columns[0], index[~mask].tolist())
+            for name in columns[1:]:
+                column = np.array(getattr(self, name))
+                rows[name] = column[mask].tolist()
+                setattr(self, name, column[~mask].tolist())
+            if columns[0] == "_v1_index":
+                payloads = np.frombuffer(self._v1_payloads, dtype=PAYLOAD_V1_DTYPE)
+                rows["_v1_payloads"] = bytearray(payloads[mask].tobytes())
+                self._v1_payloads = bytearray(payloads[~mask].tobytes())
+        addresses = list(self._index)
+        held_devices = held_devices.tolist()
+        return (
+            [self._macs[device] for device in held_devices],
+            [addresses[device] for device in held_devices],
+            rows,
+        )
+
+    def _restore_held(self, macs, addresses, rows):
+        self._macs = macs
+        self._index = dict(zip(addresses, range(len(addresses))))
+        for name, column in rows.items():
+            setattr(self, name, column)
+
+    def _fold_sequences(self, devices):
+        """Drop the repeated v1 advertisements, return the lost counts."""
+        lost = np.zeros(devices, dtype=np.int64)
+        sequenced = np.zeros(devices, dtype=bool)
+        if not self._v1_payloads:
+            return lost, sequenced
+        payloads = np.frombuffer(self._v1_payloads, dtype=PAYLOAD_V1_DTYPE)
+        index = np.array(self._v1_index, dtype=np.intp)
+        position = np.array(self._v1_position, dtype=np.int64)
+        order = np.lexsort((position, index))
+        index = index[order]
+        payloads = payloads[order]
+        position = position[order]
+        sequence = payloads["sequence"].astype(np.int64)
+        starts = _group_starts(index)
+        # the sequence of the previous advertisement of the same device,
+        # -1 if unknown; a repeat only counts for the rssi
+        previous = np.r_[-1, sequence[:-1]]
+        previous[starts] = [
+            self._sequences.get(self._macs[device], -1)
+            for device in index[starts].tolist()
+        ]
+        fresh = sequence != previous
+        gaps = np.where(fresh & (previous >= 0), (sequence - previous - 1) & 0xFF, 0)
+        lost = np.bincount(index, gaps, devices).astype(np.int64)
+        sequenced = np.bincount(index, fresh, devices) > 0
+        last = np.r_[starts[1:], len(index)] - 1
+        for device, value in zip(index[last].tolist(), sequence[last].tolist()):
+            self._sequences[self._macs[device]] = value
+        self._v1 = (index[fresh], position[fresh], payloads[fresh])
+        return lost, sequenced
+
+    def _payload_columns(self):
+        """Return the columns of the fresh payloads of the cycle."""
+        index = [np.array(self._v0_index, dtype=np.intp)]
+        position = [np.array(self._v0_position, dtype=np.int64)]
+        temperature = [np.array(self._v0_temperature, dtype=np.float64)]
+        battery = [np.array(self._v0_battery, dtype=np.int64)]
+        flags = [np.array(self._v0_flags, dtype=np.int64)]
+        if self._v1 is not None:
+            v1_index, v1_position, payloads = self._v1
+            index.append(v1_index)
+            position.append(v1_position)
+            temperature.append(payloads["temperature"] / 100)
+            battery.append(payloads["battery"].astype(np.int64))
+            flags.append(payloads["flags"].astype(np.int64))
+        columns = (index, position, temperature, battery, flags)
+        return tuple(np.concatenate(column) for column in columns)
+
+    def _fold_temperatures(self, index, temperature, devices):
+        """Return a BatchAggregate per device index with temperatures.
+
+        index is sorted and temperature in the order of the frames per
+        device.
+        """
+        default = self.default_device
+        tmin = np.empty(devices)
+        tmax = np.empty(devices)
+        for device, mac in enumerate(self._macs):
+            limits = self.devices.get(mac, default)
+            tmin[device] = limits.tmin
+            tmax[device] = limits.tmax
+        valid = (temperature >= tmin[index]) & (temperature <= tmax[index])
+        if self.log_spikes and not valid.all():
+            spikes = zip(index[~valid].tolist(), temperature[~valid].tolist())
+            for device, value in spikes:
+                _LOGGER.error("Temperature spike: %s (%s)", value, self._macs[device])
+        index = index[valid]
+        temperature = temperature[valid]
+        if not len(index):
+            return {}
+        starts = _group_starts(index)
+        counts = np.diff(np.r_[starts, len(index)])
+        with_temperature = index[starts]
+        means = np.bincount(index, temperature, devices)[with_temperature] / counts
+        # median of the values sorted per device
+        ordered = temperature[np.lexsort((temperature, index))]
+        upper = starts + counts // 2
+        lower = starts + (counts - 1) // 2
+        medians = (ordered[lower] + ordered[upper]) / 2
+        ewmas = self._fold_ewma(index, temperature, starts, counts, with_temperature)
+        return {
+            device: BatchAggregate(count, mean, median, ewma)
+            for device, count, mean, median, ewma in zip(
+                with_temperature.tolist(),
+                counts.tolist(),
+                means.tolist(),
+                medians.tolist(),
+                ewmas,
+            )
+        }
+
+    def _fold_ewma(self, index, temperature, starts, counts, with_temperature):
+        """Return the EWMA per device after the samples of the cycle.
+
+        The recurrence is unrolled into weights per sample, a device
+        without an EWMA starts from its first sample.
+        """
+        if self.ewma_alpha is None:
+            return [None] * len(starts)
+        alpha = self.ewma_alpha
+        macs = [self._macs[device] for device in with_temperature.tolist()]
+        initial = np.array(
+            [self._ewma.get(mac, np.nan) for mac in macs], dtype=np.float64
+        )
+        initial = np.where(np.isnan(initial), temperature[starts], initial)
+        # samples after each one of the same device
+        after = np.repeat(starts + counts, counts) - np.arange(len(index)) - 1
+        weights = alpha * (1 - alpha) ** after
+        ewmas = np.bincount(index, temperature * weights)[with_temperature]
+        ewmas += (1 - alpha) ** counts * initial
+        ewmas = ewmas.tolist()
+        self._ewma.update(zip(macs, ewmas))
+        return ewmas
@@ -0,0 +1,1083 @@
+"""Benchmarks for the puck.js advertisement parser.
+
+Run the directory of the integration, Home Assistant is not needed::
+
+    python puckjs bench
+    python puckjs bench --json > results.json
+
+Where Home Assistant is installed, ``python -m puckjs.bench`` works too.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+from .bpf import REJECT, build_filter, run_filter
+from .capture import CaptureWriter, replay_capture
+from .const import (
+    CONF_ACTIVE_SCAN,
+    CONF_HCI_INTERFACE,
+    CONF_TMAX,
+    CONF_TMIN,
+    PUCKJS_MANUFACTURER_ID,
+)
+from .processing import FrameConsumer, FrameProcessor
+from .publish import PublishScheduler
+from .scanner import BLEScanner
+from .history import HistoryStore
+from .stats import MeasurementAggregator
+from .parser import (
+    ASCII_PAYLOAD,
+    BINARY_PAYLOAD_V1,
+    PAYLOAD_V1,
+    compile_whitelist,
+    decode_payload,
+    decode_raw_message,
+    parse_raw_message,
+    scan_raw_message,
+)
+
+# Company identifiers of common foreign advertisers (Apple, Microsoft, Samsung)
+FOREIGN_MANUFACTURER_IDS = (0x004C, 0x0006, 0x0075)
+
+# Advertising report event type of a scan response
+SCAN_RSP = 0x04
+
+# Temperature limits for the FrameProcessor, as DeviceConfig in sensor.py
+DeviceLimits = namedtuple("DeviceLimits", ("tmin", "tmax"))
+
+
+def build_adv_report(mac, ad_structures, rssi=-60, event_type=0):
+    """Build a raw HCI LE Advertising Report frame.
+
+    ad_structures is a list of (AD type, value bytes) tuples.
+    """
+    adv_data = b"".join(
+        bytes((len(value) + 1, ad_type)) + value for ad_type, value in ad_structures
+    )
+    report = (
+        bytes((event_type, 0))
+        + bytes.fromhex(mac.replace(":", ""))[::-1]
+        + bytes((len(adv_data),))
+        + adv_data
+        + bytes((rssi & 0xFF,))
+    )
+    # LE Advertising Report subevent with a single report
+    params = bytes((0x02, 1)) + report
+    return bytes((0x04, 0x3E, len(params))) + params
+
+
+def puck_payload(battery=100, temperature=21.5, flags=0, version=0, sequence=0):
+    """Return the manufacturer data of advertise() in ha-puck.js.
+
+    Version 1 is the binary payload of the current firmware. Version 0
+    is the ASCII payload of older firmware, where like pad() the
+    temperature is only zero padded to 4 characters, so the payload is
+    8 to 10 bytes long.
+    """
+    if version == PAYLOAD_V1:
+        return BINARY_PAYLOAD_V1.pack(
+            PAYLOAD_V1, round(battery), round(temperature * 100), flags, sequence & 0xFF
+        )
+    return "{:0>3}{:0>4}{}".format(
+        "{:.0f}".format(battery), "{:.2f}".format(temperature), flags
+    ).encode()
+
+
+def build_puck_frame(
+    mac, battery=100, temperature=21.5, flags=0, rssi=-60, version=0, sequence=0
+):
+    """Build an advertisement as sent by advertise() in ha-puck.js.
+
+    Espruino adds the flags and the default "Puck.js xxxx" device name.
+    """
+    return build_adv_report(
+        mac,
+        [
+            (0x01, b"\x06"),
+            (0x09, "Puck.js {}".format(mac.replace(":", "")[-4:]).encode()),
+            (
+                0xFF,
+                PUCKJS_MANUFACTURER_ID.to_bytes(2, "little")
+                + puck_payload(battery, temperature, flags, version, sequence),
+            ),
+        ],
+        rssi,
+    )
+
+
+def build_scan_response(mac, rssi=-60):
+    """Build the empty scan response of a device, as seen with active scans."""
+    return build_adv_report(mac, [], rssi, SCAN_RSP)
+
+
+def random_mac(rnd):
+    """Return a random MAC address."""
+    return ":".join("{:02x}".format(rnd.randrange(256)) for _ in range(6))
+
+
+def synthetic_capture(
+    frames,
+    pucks=10,
+    puck_ratio=0.01,
+    seed=0,
+    scan_response_ratio=0.05,
+    name_ratio=0.2,
+    manufacturers=FOREIGN_MANUFACTURER_IDS,
+    payload_version=0,
+):
+    """Return (capture, puck MACs), a capture with a given mix of frames.
+
+    puck_ratio of the frames are puck.js advertisements and
+    scan_response_ratio payload-less scan responses of pucks and foreign
+    devices. Of the remaining frames name_ratio only hold a device name,
+    the others carry manufacturer data of one of the manufacturers. The
+    pucks send payload_version payloads, with version 1 every
+    advertisement is repeated a few times with the same sequence number.
+    """
+    rnd = random.Random(seed)
+    puck_macs = [random_mac(rnd) for _ in range(pucks)]
+    foreign_macs = [random_mac(rnd) for _ in range(200)]
+    # every puck advertises around its own temperature and battery level
+    pucks_state = {
+        mac: (rnd.randrange(20, 101), rnd.uniform(-5, 30)) for mac in puck_macs
+    }
+    sequences = dict.fromkeys(puck_macs, 0)
+    capture = []
+    for _ in range(frames):
+        kind = rnd.random()
+        if kind < puck_ratio:
+            mac = rnd.choice(puck_macs)
+            battery, temperature = pucks_state[mac]
+            if rnd.random() < 0.25:
+                sequences[mac] += 1
+            capture.append(
+                build_puck_frame(
+                    mac,
+                    battery,
+                    round(temperature + rnd.uniform(-0.5, 0.5), 2),
+                    rnd.randrange(4),
+                    rnd.randrange(-95, -40),
+                    payload_version,
+                    sequences[mac],
+                )
+            )
+        elif kind < puck_ratio + scan_response_ratio:
+            capture.append(
+                build_scan_response(
+                    rnd.choice(puck_macs + foreign_macs), rnd.randrange(-95, -40)
+                )
+            )
+        elif rnd.random() < name_ratio:
+            capture.append(
+                build_adv_report(
+                    rnd.choice(foreign_macs),
+                    [(0x09, b"foreign device")],
+                    rnd.randrange(-95, -40),
+                )
+            )
+        else:
+            manufacturer_id = rnd.choice(manufacturers)
+            capture.append(
+                build_adv_report(
+                    rnd.choice(foreign_macs),
+                    [
+                        (0x01, b"\x1a"),
+                        (
+                            0xFF,
+                            manufacturer_id.to_bytes(2, "little")
+                            + bytes(rnd.randrange(256) for _ in range(20)),
+                        ),
+                    ],
+                    rnd.randrange(-95, -40),
+                )
+            )
+    return capture, puck_macs
+
+
+def frames_per_second(func, capture, whitelist, repeat=3):
+    """Return the best throughput of func over the capture."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for frame in capture:
+            func(frame, whitelist)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(capture) / best
+
+
+def bench_prefilter(frames=20000):
+    """Compare the raw bytes path of parse_raw_message with aioblescan."""
+    capture, puck_macs = synthetic_capture(frames)
+    results = {}
+    for name, whitelist in (
+        ("discovery", compile_whitelist([])),
+        ("whitelist", compile_whitelist(puck_macs)),
+    ):
+        full = frames_per_second(decode_raw_message, capture, whitelist)
+        raw = frames_per_second(parse_raw_message, capture, whitelist)
+        results[name] = {
+            "aioblescan_fps": round(full),
+            "raw_fps": round(raw),
+            "speedup": round(raw / full, 1),
+        }
+    return results
+
+
+def legacy_decode_payload(data, start, stop, rssi, mac):
+    """Decode a payload the way parse_raw_message did before PuckReading."""
+    payload = data[start:stop]
+    battery     = float(payload[0:3])
+    temperature = float(payload[3:8])
+    direction   = bool(int(payload[8]) & 2)
+    button      = bool(int(payload[8]) & 1)
+    return {
+        "rssi": rssi,
+        "mac": mac,
+        "temperature" : temperature,
+        "battery" : battery,
+        "direction" : direction,
+        "button" : button,
+        "type": "puck.js" }
+
+
+def locate_payloads(capture, ascii_only=False):
+    """Return the decode_payload arguments of the frames of a capture."""
+    located = []
+    for frame in capture:
+        address, rssi, _, start, stop = scan_raw_message(frame)
+        if ascii_only and stop - start != ASCII_PAYLOAD.size:
+            # the dict decoder fails on the payloads of pucks below 10 °C
+            continue
+        located.append((memoryview(frame), start, stop, rssi, address[::-1].hex(":")))
+    return located
+
+
+def bench_decoder(frames=100000):
+    """Compare decode_payload with the dict based payload decoding.
+
+    The ASCII v0 payloads are decoded by both, the binary v1 payloads
+    by decode_payload.
+    """
+    ascii_capture, _ = synthetic_capture(frames, pucks=100, puck_ratio=1)
+    binary_capture, _ = synthetic_capture(
+        frames, pucks=100, puck_ratio=1, payload_version=PAYLOAD_V1
+    )
+    ascii_located = locate_payloads(ascii_capture, ascii_only=True)
+    results = {}
+    for name, func, located in (
+        ("dict", legacy_decode_payload, ascii_located),
+        ("record", decode_payload, ascii_located),
+        ("binary", decode_payload, locate_payloads(binary_capture)),
+    ):
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            for args in located:
+                func(*args)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name + "_fps"] = round(len(located) / best)
+    results["speedup"] = round(results["record_fps"] / results["dict_fps"], 2)
+    results["binary_speedup"] = round(results["binary_fps"] / results["record_fps"], 2)
+    return results
+
+
+def bench_statistics(devices=1000, samples=60, seed=0):
+    """Compare MeasurementAggregator with buffering samples for statistics.
+
+    Each device reports around its own temperature in the 0.25 degree
+    steps of the puck.js sensor. Returns the time spent per frame and at
+    publish time in milliseconds, whether the medians are the same as
+    those of statistics and the largest difference of the means.
+    """
+    rnd = random.Random(seed)
+    base = [round(rnd.uniform(15, 25) * 4) / 4 for _ in range(devices)]
+    readings = [
+        (device, base[device] + rnd.choice((-0.25, 0, 0.25)))
+        for _ in range(samples)
+        for device in range(devices)
+    ]
+    start = time.perf_counter()
+    lists = {}
+    for device, value in readings:
+        lists.setdefault(device, []).append(value)
+    ingested = time.perf_counter()
+    expected = {
+        device: (statistics.mean(values), statistics.median(values))
+        for device, values in lists.items()
+    }
+    buffered = (ingested - start, time.perf_counter() - ingested)
+    start = time.perf_counter()
+    aggregates = {}
+    for device, value in readings:
+        if device not in aggregates:
+            aggregates[device] = MeasurementAggregator()
+        aggregates[device].add(value)
+    ingested = time.perf_counter()
+    results = {
+        device: (aggregate.mean(), aggregate.median())
+        for device, aggregate in aggregates.items()
+    }
+    streaming = (ingested - start, time.perf_counter() - ingested)
+    return {
+        "buffered_frames_ms": round(buffered[0] * 1000, 1),
+        "buffered_publish_ms": round(buffered[1] * 1000, 1),
+        "streaming_frames_ms": round(streaming[0] * 1000, 1),
+        "streaming_publish_ms": round(streaming[1] * 1000, 1),
+        "identical_medians": all(
+            results[device][1] == median for device, (_, median) in expected.items()
+        ),
+        "max_mean_error": max(
+            abs(results[device][0] - mean) for device, (mean, _) in expected.items()
+        ),
+    }
+
+
+def write_capture(path, frames=20000, rate=250, pucks=10, puck_ratio=0.01):
+    """Write a synthetic capture received at rate frames per second."""
+    capture, _ = synthetic_capture(frames, pucks, puck_ratio)
+    writer = CaptureWriter(path)
+    start = time.time()
+    for index, frame in enumerate(capture):
+        writer.append(frame, 0, start + index / rate)
+    writer.close()
+    return len(capture)
+
+
+def bench_replay(path, speed=0, period=60):
+    """Run a capture through BLEScanner and the FrameProcessor.
+
+    The frames are replayed into a BLEScanner and processed in update
+    cycles of period seconds of recorded time, as discover_ble_devices
+    would. Returns the frame counts, the published devices and the time
+    spent replaying and processing.
+    """
+    scanner = BLEScanner()
+    processor = FrameProcessor(
+        compile_whitelist([]), {}, DeviceLimits(CONF_TMIN, CONF_TMAX)
+    )
+    results = {"frames": 0, "cycles": 0, "devices": set(), "processing": 0}
+    next_cycle = None
+
+    def process():
+        start = time.perf_counter()
+        frames = scanner.drain()
+        processor.add_frames(frames)
+        results["devices"].update(processor.collect())
+        results["processing"] += time.perf_counter() - start
+        results["frames"] += len(frames)
+        results["cycles"] += 1
+
+    def collect(frame, timestamp):
+        nonlocal next_cycle
+        if next_cycle is None:
+            next_cycle = timestamp + period
+        elif timestamp >= next_cycle:
+            next_cycle += period
+            process()
+        scanner.collect(frame)
+
+    start = time.perf_counter()
+    replayed = replay_capture(path, collect, speed, timestamps=True)
+    process()
+    elapsed = time.perf_counter() - start
+    processing = results["processing"]
+    return {
+        "replayed": replayed,
+        "processed": results["frames"],
+        "dropped": scanner.hcidump_data.dropped,
+        "cycles": results["cycles"],
+        "devices": len(results["devices"]),
+        "replay_s": round(elapsed, 2),
+        "processing_s": round(processing, 3),
+        "processed_fps": round(results["frames"] / processing) if processing else 0,
+    }
+
+
+def legacy_add_frames(processor, frames, idle_sleep=0.0001):
+    """Fold in frames sleeping after every frame without puck data, as before."""
+    for msg in frames:
+        if not processor.add_frame(msg):
+            time.sleep(idle_sleep)
+
+
+def bench_consumer(frames=20000, rate=5000, period=1.0):
+    """Compare the FrameConsumer with processing each cycle's frames at its end.
+
+    A busy synthetic capture is replayed in real time into a BLEScanner
+    while update cycles run every period seconds. "legacy" processes
+    the frames of a cycle when it ends, with the sleep after every
+    foreign frame; "consumer" processes them as they arrive. Returns the
+    process CPU time of the run and the mean and worst latency of the
+    update cycles, from draining the buffer to the readings collected.
+    """
+    limits = DeviceLimits(CONF_TMIN, CONF_TMAX)
+    results = {"frames": frames, "rate": rate}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "busy.cap")
+        write_capture(path, frames, rate)
+        for name in ("legacy", "consumer"):
+            scanner = BLEScanner(buffer_size=frames)
+            processor = FrameProcessor(compile_whitelist([]), {}, limits)
+            consumer = None
+            if name == "consumer":
+                consumer = FrameConsumer(scanner.hcidump_data, processor)
+                consumer.start()
+            latencies = []
+            cpu = time.process_time()
+            scanner.replay(path, speed=1)
+            while True:
+                replaying = scanner.is_running()
+                if replaying:
+                    time.sleep(period)
+                start = time.perf_counter()
+                if consumer is None:
+                    legacy_add_frames(processor, scanner.drain())
+                    processor.collect()
+                else:
+                    consumer.collect(scanner.drain())
+                latencies.append(time.perf_counter() - start)
+                if not replaying:
+                    break
+            scanner.stop()
+            if consumer is not None:
+                consumer.stop()
+            results[name + "_cpu_s"] = round(time.process_time() - cpu, 3)
+            results[name + "_cycle_ms"] = round(statistics.mean(latencies) * 1000, 1)
+            results[name + "_worst_cycle_ms"] = round(max(latencies) * 1000, 1)
+    return results
+
+
+def bench_dedup(devices=100, adapters=3, adverts=20, window=0.1):
+    """Compare an update cycle with and without cross-adapter deduplication.
+
+    Every frame of the cycle is heard by all adapters with a different
+    rssi. Returns the frames processed and the time spent collecting
+    and processing them, both ways.
+    """
+    capture, _ = cycle_capture(devices, adverts)
+    rnd = random.Random(0)
+    heard = [
+        (frame[:-1] + bytes(((frame[-1] + rnd.randrange(-10, 10)) & 0xFF,)), adapter)
+        for frame in capture
+        for adapter in range(adapters)
+    ]
+    limits = DeviceLimits(CONF_TMIN, CONF_TMAX)
+    results = {"devices": devices, "adapters": adapters}
+    for name, deduplicate in (("plain", False), ("dedup", True)):
+        scanner = BLEScanner(buffer_size=len(heard))
+        if deduplicate:
+            scanner.deduplicate(window)
+        collectors = [scanner.collector(adapter) for adapter in range(adapters)]
+        processor = FrameProcessor(compile_whitelist([]), {}, limits)
+        start = time.perf_counter()
+        for frame, adapter in heard:
+            collectors[adapter](frame)
+        frames = scanner.drain()
+        processor.add_frames(frames)
+        publish(processor.collect())
+        results[name + "_frames"] = len(frames)
+        results[name + "_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return results
+
+
+def repeated_capture(devices=100, adverts=20, changes=2, seed=0):
+    """Return the frames of an update cycle of pucks repeating their adverts.
+
+    Every puck sends changes different advertisements, each repeated
+    until the puck sent adverts frames, with a different rssi each time.
+    """
+    rnd = random.Random(seed)
+    capture = []
+    for mac in (random_mac(rnd) for _ in range(devices)):
+        battery = rnd.randrange(20, 101)
+        for _ in range(changes):
+            temperature = round(rnd.uniform(-5, 30), 2)
+            flags = rnd.randrange(4)
+            capture += [
+                build_puck_frame(
+                    mac, battery, temperature, flags, rnd.randrange(-95, -40)
+                )
+                for _ in range(adverts // changes)
+            ]
+    rnd.shuffle(capture)
+    return capture
+
+
+def bench_cache(devices=100, adverts=20, changes=2, cache_size=1024, repeat=5):
+    """Compare folding repeated advertisements with and without a ReadingCache."""
+    capture = repeated_capture(devices, adverts, changes)
+    results = {"devices": devices, "frames": len(capture)}
+    results.update(compare_cache(capture, cache_size, repeat))
+    return results
+
+
+def bench_foreign_cache(
+    frames=100000, pucks=20, puck_ratio=0.01, cache_size=1024, socket_filter=False
+):
+    """Compare the ReadingCache on mostly foreign traffic, as pucks usually see.
+
+    With socket_filter the frames the BPF filter drops in the kernel are
+    left out, as with the bpf_filter option.
+    """
+    capture, _ = synthetic_capture(frames, pucks=pucks, puck_ratio=puck_ratio)
+    if socket_filter:
+        program = build_filter()
+        capture = [frame for frame in capture if run_filter(program, frame) != REJECT]
+    results = {
+        "pucks": pucks,
+        "frames": len(capture),
+        "puck_ratio": puck_ratio,
+        "filter": "BPF filter" if socket_filter else "no filter",
+    }
+    # few frames are left with the filter, more rounds steady the timing
+    repeat = 20 if socket_filter else 3
+    results.update(compare_cache(capture, cache_size, repeat))
+    return results
+
+
+def compare_cache(capture, cache_size, repeat):
+    """Return the frames/s folding capture without and with a ReadingCache."""
+    limits = DeviceLimits(CONF_TMIN, CONF_TMAX)
+    results = {}
+    for name, size in (("plain", 0), ("cached", cache_size)):
+        # the processor and its cache live across update cycles
+        processor = FrameProcessor(compile_whitelist([]), {}, limits, cache_size=size)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            processor.add_frames(capture)
+            publish(processor.collect())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name + "_fps"] = round(len(capture) / best)
+    results["speedup"] = round(results["cached_fps"] / results["plain_fps"], 2)
+    results.update(processor.cache_stats())
+    return results
+
+
+def cycle_capture(devices, adverts=20, foreign_ratio=0.5, seed=0, payload_version=0):
+    """Return the frames of one update cycle with the given number of pucks.
+
+    Every puck sends about adverts advertisements of payload_version,
+    foreign_ratio of the frames come from other devices.
+    """
+    puck_ratio = 1 - foreign_ratio
+    return synthetic_capture(
+        round(devices * adverts / puck_ratio),
+        pucks=devices,
+        puck_ratio=puck_ratio,
+        seed=seed,
+        scan_response_ratio=min(0.05, foreign_ratio),
+        payload_version=payload_version,
+    )
+
+
+def publish(readings_by_mac):
+    """Compute the states discover_ble_devices publishes, return the count."""
+    for readings in readings_by_mac.values():
+        readings.rssi()
+        if readings.temperature is not None:
+            readings.temperature.mean()
+            readings.temperature.median()
+    return len(readings_by_mac)
+
+
+def bench_discover(devices, adverts=20, repeat=5):
+    """Measure an update cycle of discover_ble_devices for a number of pucks.
+
+    The latency covers parsing and folding the frames of the cycle and
+    computing the published states. The peak memory is what is allocated
+    while buffering and processing the cycle, the frames not included.
+    """
+    capture, _ = cycle_capture(devices, adverts)
+    limits = DeviceLimits(CONF_TMIN, CONF_TMAX)
+    processor = FrameProcessor(compile_whitelist([]), {}, limits)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        processor.add_frames(capture)
+        published = publish(processor.collect())
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    scanner = BLEScanner(buffer_size=len(capture))
+    for frame in capture:
+        scanner.collect(frame)
+    processor = FrameProcessor(compile_whitelist([]), {}, limits)
+    processor.add_frames(scanner.drain())
+    publish(processor.collect())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "devices": devices,
+        "frames": len(capture),
+        "published": published,
+        "latency_ms": round(best * 1000, 2),
+        "frames_per_s": round(len(capture) / best),
+        "peak_memory_kib": round(peak / 1024),
+    }
+
+
+def bench_batch(devices=1000, adverts=20, payload_version=1, repeat=3):
+    """Compare the FrameProcessor with the NumPy BatchProcessor.
+
+    Both fold the frames of an update cycle and compute the published
+    states. Returns None if numpy is not installed.
+    """
+    try:
+        from .batch import BatchProcessor
+    except ImportError:
+        return None
+    capture, _ = cycle_capture(devices, adverts, payload_version=payload_version)
+    limits = DeviceLimits(CONF_TMIN, CONF_TMAX)
+    results = {"devices": devices, "frames": len(capture), "version": payload_version}
+    for name, engine in (("python", FrameProcessor), ("numpy", BatchProcessor)):
+        processor = engine(compile_whitelist([]), {}, limits, 0.1)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            processor.add_frames(capture)
+            publish(processor.collect())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name + "_ms"] = round(best * 1000, 1)
+    results["speedup"] = round(results["python_ms"] / results["numpy_ms"], 2)
+    return results
+
+
+def published_states(readings_by_mac):
+    """Return the rssi and mean temperature published per MAC."""
+    return {
+        mac: (
+            readings.rssi(),
+            None if readings.temperature is None else readings.temperature.mean(),
+        )
+        for mac, readings in readings_by_mac.items()
+    }
+
+
+def bench_sharding(devices=1000, adapters=3, adverts=20, workers=(1, 2, 4), repeat=3):
+    """Compare decoding in process with decoding in worker processes.
+
+    Every frame of the cycle is heard by all adapters with a different
+    rssi. The time covers handing the frames over, decoding them and
+    computing the published states, the worker startup not included.
+    """
+    from .sharding import ShardedProcessor
+
+    capture, _ = cycle_capture(devices, adverts)
+    rnd = random.Random(0)
+    heard = [
+        frame[:-1] + bytes(((frame[-1] + rnd.randrange(-10, 10)) & 0xFF,))
+        for frame in capture
+        for _ in range(adapters)
+    ]
+    limits = DeviceLimits(CONF_TMIN, CONF_TMAX)
+    results = {
+        "devices": devices,
+        "adapters": adapters,
+        "frames": len(heard),
+        "cpus": os.cpu_count(),
+        "workers": [],
+    }
+    expected = None
+    for count in (0,) + tuple(workers):
+        if count:
+            processor = ShardedProcessor(
+                compile_whitelist([]), {}, limits, 0.1, workers=count
+            )
+        else:
+            processor = FrameProcessor(compile_whitelist([]), {}, limits, 0.1)
+        try:
+            best = None
+            for cycle in range(repeat):
+                start = time.perf_counter()
+                processor.add_frames(heard)
+                readings = processor.collect()
+                publish(readings)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+                if cycle == 0:
+                    states = published_states(readings)
+        finally:
+            if count:
+                processor.stop()
+        if expected is None:
+            expected = states
+            results["in_process_ms"] = round(best * 1000, 1)
+            continue
+        results["workers"].append(
+            {
+                "workers": count,
+                "ms": round(best * 1000, 1),
+                "speedup": round(results["in_process_ms"] / (best * 1000), 2),
+                "identical": states == expected,
+            }
+        )
+    return results
+
+
+def bench_history(devices=10, days=7, period=60, seed=0):
+    """Write days of readings of devices to a HistoryStore and query them.
+
+    Returns the append time per reading, the disk space taken per
+    reading and the time of a query per tier over the span it serves.
+    """
+    rnd = random.Random(seed)
+    macs = [random_mac(rnd) for _ in range(devices)]
+    cycles = days * 86400 // period
+    end = 1600000000
+    start = end - cycles * period
+    with tempfile.TemporaryDirectory() as directory:
+        store = HistoryStore(directory)
+        begin = time.perf_counter()
+        for cycle in range(cycles):
+            now = start + cycle * period
+            for mac in macs:
+                store.append(
+                    mac, now, 20 + rnd.random(), 100, rnd.randrange(-90, -40)
+                )
+        append_time = time.perf_counter() - begin
+        store.close()
+        disk = sum(
+            os.stat(os.path.join(directory, name)).st_blocks * 512
+            for name in os.listdir(directory)
+        )
+        store = HistoryStore(directory)
+        results = {
+            "devices": devices,
+            "readings": cycles * devices,
+            "append_us": round(append_time / (cycles * devices) * 1e6, 2),
+            "bytes_per_reading": round(disk / (cycles * devices), 1),
+            "queries": [],
+        }
+        for tier, span in (("raw", 86400), ("minute", days * 86400), ("hour", None)):
+            first = start if span is None else end - span
+            begin = time.perf_counter()
+            for mac in macs:
+                _, records = store.query(mac, first, end, tier)
+            results["queries"].append(
+                {
+                    "tier": tier,
+                    "days": round((end - first) / 86400, 1),
+                    "records": len(records),
+                    "ms": round((time.perf_counter() - begin) / devices * 1000, 2),
+                }
+            )
+        store.close()
+    return results
+
+
+def bench_scheduler(
+    devices=1000,
+    active_ratio=0.1,
+    duration=3600,
+    period=60,
+    min_period=10,
+    max_period=600,
+):
+    """Compare publishing every device each period with adaptive periods.
+
+    Simulated pucks advertise every 5 s, active_ratio of them warm up by
+    0.1 °C a minute while the others hold their temperature. Returns the
+    device states published over duration seconds and the time spent
+    collecting and computing the published states, both ways; folding
+    the frames costs the same.
+    """
+    rnd = random.Random(0)
+    macs = [random_mac(rnd) for _ in range(devices)]
+    active = set(macs[: round(devices * active_ratio)])
+    frames = {}
+
+    def advertisements(seconds, now):
+        """Return the frames the pucks sent in the seconds up to now."""
+        capture = []
+        for mac in macs:
+            temperature = 20.0
+            if mac in active:
+                temperature += (now // 60) / 10
+            frame = frames.get((mac, temperature))
+            if frame is None:
+                frame = frames[mac, temperature] = build_puck_frame(
+                    mac, 90, temperature
+                )
+            capture += [frame] * (seconds // 5)
+        return capture
+
+    limits = DeviceLimits(CONF_TMIN, CONF_TMAX)
+    results = {"devices": devices, "active": len(active), "duration_s": duration}
+    for name, tick in (("fixed", period), ("adaptive", min_period)):
+        now = 0
+        scheduler = None
+        if name == "adaptive":
+            scheduler = PublishScheduler(
+                min_period, max_period, 0.1, clock=lambda: now
+            )
+        processor = FrameProcessor(compile_whitelist([]), {}, limits)
+        published = 0
+        elapsed = 0
+        while now < duration:
+            now += tick
+            capture = advertisements(tick, now)
+            processor.add_frames(capture)
+            start = time.perf_counter()
+            hold = None
+            if scheduler is not None:
+                scheduler.advance()
+                hold = scheduler.waiting
+            readings_by_mac = processor.collect(hold)
+            published += publish(readings_by_mac)
+            if scheduler is not None:
+                for mac, readings in readings_by_mac.items():
+                    scheduler.schedule(mac, round(readings.temperature.mean(), 1))
+            elapsed += time.perf_counter() - start
+        results[name + "_published"] = published
+        results[name + "_ms"] = round(elapsed * 1000)
+    return results
+
+
+# seconds the scanning setup may take, adapters missing or not
+STARTUP_BUDGET = 0.1
+
+# Home Assistant has imported the package by the time the platform sets
+# up, the package is registered without its __init__ as in __main__.py
+IMPORT_TIMER = """
+import asyncio, json, logging, sys, time, types
+sys.modules[{package!r}] = types.ModuleType({package!r})
+sys.modules[{package!r}].__path__ = [{path!r}]
+start = time.perf_counter()
+import {package}.processing, {package}.scanner
+print(json.dumps([time.perf_counter() - start, "aioblescan" in sys.modules]))
+"""
+
+
+def bench_startup(interface=99):
+    """Measure what setting up the scanning costs.
+
+    The import time of the scanning modules is measured in a fresh
+    interpreter with the modules Home Assistant already has loaded.
+    Starting the scanner is timed on an adapter that does not exist.
+    """
+    timer = IMPORT_TIMER.format(
+        package=__package__, path=os.path.dirname(os.path.abspath(__file__))
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", timer],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    import_time, aioblescan_loaded = json.loads(output)
+    scanner = BLEScanner()
+    start = time.perf_counter()
+    scanner.start({CONF_ACTIVE_SCAN: False, CONF_HCI_INTERFACE: [interface]})
+    start_time = time.perf_counter() - start
+    scanner.stop()
+    return {
+        "import_ms": round(import_time * 1000, 1),
+        "aioblescan_imported": aioblescan_loaded,
+        "start_ms": round(start_time * 1000, 1),
+        "budget_ms": STARTUP_BUDGET * 1000,
+        "within_budget": import_time + start_time <= STARTUP_BUDGET,
+    }
+
+
+def package_version():
+    """Return the version in manifest.json."""
+    with open(os.path.join(os.path.dirname(__file__), "manifest.json")) as manifest:
+        return json.load(manifest)["version"]
+
+
+def run_suite(frames=20000, devices=(10, 100, 1000), adverts=20):
+    """Run all benchmarks, return the results as a JSON serializable dict."""
+    return {
+        "version": package_version(),
+        "python": platform.python_implementation() + " " + platform.python_version(),
+        "machine": platform.machine(),
+        "parse_raw_message": bench_prefilter(frames),
+        "decode_payload": bench_decoder(frames * 5),
+        "statistics": bench_statistics(),
+        "dedup": bench_dedup(),
+        "decode_cache": bench_cache(),
+        "decode_cache_foreign": [
+            bench_foreign_cache(socket_filter=socket_filter)
+            for socket_filter in (False, True)
+        ],
+        "consumer": bench_consumer(),
+        "startup": bench_startup(),
+        "scheduler": bench_scheduler(),
+        "sharding": bench_sharding(),
+        "history": bench_history(),
+        "batch_engine": [
+            bench_batch(count, adverts, version)
+            for count in devices
+            if count >= 1000
+            for version in (0, 1)
+        ],
+        "discover_ble_devices": [bench_discover(count, adverts) for count in devices],
+    }
+
+
+def main(argv=None, prog=None):
+    """Run the benchmarks and print the results."""
+    parser = argparse.ArgumentParser(prog=prog, description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=20000)
+    parser.add_argument(
+        "--devices",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000],
+        help="puck counts of the discover_ble_devices benchmark",
+    )
+    parser.add_argument(
+        "--adverts",
+        type=int,
+        default=20,
+        help="advertisements per puck and update cycle",
+    )
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="check the scanning setup time against its budget and exit",
+    )
+    parser.add_argument(
+        "--record", metavar="PATH", help="write a synthetic capture and exit"
+    )
+    parser.add_argument(
+        "--replay", metavar="PATH", help="replay a capture through the pipeline"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=0,
+        help="replay speed, 1 as recorded, 0 as fast as possible (default)",
+    )
+    args = parser.parse_args(argv)
+    if args.record:
+        frames = write_capture(args.record, args.frames)
+        print("wrote {} frames to {}".format(frames, args.record))
+        return
+    if args.startup:
+        result = bench_startup()
+        print(
+            "startup: imports {import_ms} ms (aioblescan imported: "
+            "{aioblescan_imported}), scanner start on a missing adapter "
+            "{start_ms} ms, budget {budget_ms} ms".format(**result)
+        )
+        sys.exit(0 if result["within_budget"] else 1)
+    if args.replay:
+        print(
+            "replay: {replayed} frames, {processed} processed in {cycles} cycle(s), "
+            "{dropped} dropped, {devices} device(s), {replay_s} s total, "
+            "{processing_s} s processing ({processed_fps} frames/s)".format(
+                **bench_replay(args.replay, args.speed)
+            )
+        )
+        return
+    results = run_suite(args.frames, args.devices, args.adverts)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, result in results["parse_raw_message"].items():
+        print(
+            "parse_raw_message ({}): {aioblescan_fps} -> {raw_fps} frames/s "
+            "({speedup}x)".format(name, **result)
+        )
+    print(
+        "payload decoder: {dict_fps} -> {record_fps} frames/s ({speedup}x), "
+        "binary v1 {binary_fps} frames/s ({binary_speedup}x)".format(
+            **results["decode_payload"]
+        )
+    )
+    print(
+        "statistics per period: frames {buffered_frames_ms} -> "
+        "{streaming_frames_ms} ms, publish {buffered_publish_ms} -> "
+        "{streaming_publish_ms} ms (identical medians: {identical_medians}, "
+        "mean error {max_mean_error:.1e})".format(
+            **results["statistics"]
+        )
+    )
+    print(
+        "deduplication ({devices} devices, {adapters} adapters): "
+        "{plain_frames} -> {dedup_frames} frames, "
+        "{plain_ms} -> {dedup_ms} ms".format(**results["dedup"])
+    )
+    print(
+        "decode cache ({devices} devices, {frames} frames): {plain_fps} -> "
+        "{cached_fps} frames/s ({speedup}x), {hits} hits, {misses} misses".format(
+            **results["decode_cache"]
+        )
+    )
+    for result in results["decode_cache_foreign"]:
+        print(
+            "decode cache ({pucks} pucks, {puck_ratio} of the frames, {filter}, "
+            "{frames} frames): {plain_fps} -> {cached_fps} frames/s ({speedup}x), "
+            "{hits} hits, {misses} misses, {evictions} evictions".format(**result)
+        )
+    print(
+        "frame consumer ({frames} frames at {rate}/s): cpu {legacy_cpu_s} -> "
+        "{consumer_cpu_s} s, update cycle {legacy_cycle_ms} -> "
+        "{consumer_cycle_ms} ms (worst {legacy_worst_cycle_ms} -> "
+        "{consumer_worst_cycle_ms} ms)".format(**results["consumer"])
+    )
+    print(
+        "adaptive periods ({devices} devices, {active} active, {duration_s} s): "
+        "{fixed_published} -> {adaptive_published} states published, "
+        "{fixed_ms} -> {adaptive_ms} ms".format(**results["scheduler"])
+    )
+    history = results["history"]
+    print(
+        "history ({devices} devices, {readings} readings): append {append_us} us, "
+        "{bytes_per_reading} bytes per reading on disk".format(**history)
+    )
+    for result in history["queries"]:
+        print(
+            "  query {days} days of {tier} records: {records} records in "
+            "{ms} ms".format(**result)
+        )
+    sharding = results["sharding"]
+    print(
+        "decode workers ({devices} devices, {adapters} adapters, {frames} frames, "
+        "{cpus} cpus): in process {in_process_ms} ms".format(**sharding)
+    )
+    for result in sharding["workers"]:
+        print(
+            "  {workers} worker(s): {ms} ms ({speedup}x, identical: "
+            "{identical})".format(**result)
+        )
+    print(
+        "startup: imports {import_ms} ms, scanner start {start_ms} ms "
+        "(budget {budget_ms} ms)".format(**results["startup"])
+    )
+    for result in results["batch_engine"]:
+        if result is None:
+            print("batch engine: numpy not installed")
+            break
+        print(
+            "batch engine ({devices} devices, {frames} frames, v{version} "
+            "payload): python {python_ms} ms, numpy {numpy_ms} ms "
+            "({speedup}x)".format(**result)
+        )
+    for result in results["discover_ble_devices"]:
+        print(
+            "discover_ble_devices ({devices} devices, {frames} frames): "
+            "{latency_ms} ms, {frames_per_s} frames/s, "
+            "peak {peak_memory_kib} KiB".format(**result)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Classic BPF socket filter for the HCI sockets.
+
+The filter drops LE advertising reports that do not carry puck.js
+manufacturer data in the kernel, so they never wake the HCIdump
+threads. Other HCI traffic, reports it can not judge (several reports
+in one event, many AD structures) and extended advertising reports are
+passed on for parse_raw_message to decide.
+
+run_filter() evaluates a program in userspace, to check it against
+captured or synthetic frames.
+"""
+import ctypes
+import socket
+import struct
+
+from .const import PUCKJS_MANUFACTURER_ID
+from .parser import (
+    ADV_ADDR_START,
+    ADV_DATA_LENGTH,
+    ADV_DATA_START,
+    AD_TYPE_MANUFACTURER_DATA,
+    HCI_EVENT_PACKET,
+    HCI_LE_META_EVENT,
+    LE_ADVERTISING_REPORT,
+    raw_address,
+)
+
+# instruction classes, sizes, modes and operations of linux/filter.h
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_ST = 0x02
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_MISC = 0x07
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_IMM = 0x00
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MEM = 0x60
+BPF_ADD = 0x00
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_JGT = 0x20
+BPF_K = 0x00
+BPF_X = 0x08
+BPF_TAX = 0x00
+BPF_TXA = 0x80
+
+SO_ATTACH_FILTER = 26
+# struct sock_filter, an instruction: code, jt, jf, k
+SOCK_FILTER = struct.Struct("HBBI")
+
+ACCEPT = 0xFFFF
+REJECT = 0
+# AD structures looked at before the frame is passed on undecided
+MAX_AD_STRUCTURES = 8
+
+
+def _stmt(code, k=0):
+    return (code, 0, 0, k)
+
+
+def _jump(code, k, jt, jf):
+    return (code, jt, jf, k)
+
+
+def build_filter(whitelist=None):
+    """Return the filter program for a list of MAC addresses.
+
+    With an empty whitelist reports of all devices with puck.js
+    manufacturer data are accepted.
+    """
+    program = [
+        # only LE advertising reports with a single report are filtered
+        _stmt(BPF_LD | BPF_B | BPF_ABS, 0),
+        _jump(BPF_JMP | BPF_JEQ | BPF_K, HCI_EVENT_PACKET, 1, 0),
+        _stmt(BPF_RET | BPF_K, ACCEPT),
+        _stmt(BPF_LD | BPF_B | BPF_ABS, 1),
+        _jump(BPF_JMP | BPF_JEQ | BPF_K, HCI_LE_META_EVENT, 1, 0),
+        _stmt(BPF_RET | BPF_K, ACCEPT),
+        _stmt(BPF_LD | BPF_B | BPF_ABS, 3),
+        _jump(BPF_JMP | BPF_JEQ | BPF_K, LE_ADVERTISING_REPORT, 1, 0),
+        _stmt(BPF_RET | BPF_K, ACCEPT),
+        _stmt(BPF_LD | BPF_B | BPF_ABS, 4),
+        _jump(BPF_JMP | BPF_JEQ | BPF_K, 1, 1, 0),
+        _stmt(BPF_RET | BPF_K, ACCEPT),
+    ]
+    addresses = list(dict.fromkeys(raw_address(mac) for mac in whitelist or ()))
+    for index, address in enumerate(addresses):
+        # jump over the remaining addresses and the final reject
+        remaining = (len(addresses) - index - 1) * 5 + 1
+        program += [
+            _stmt(BPF_LD | BPF_W | BPF_ABS, ADV_ADDR_START),
+            _jump(BPF_JMP | BPF_JEQ | BPF_K, int.from_bytes(address[:4], "big"), 0, 3),
+            _stmt(BPF_LD | BPF_H | BPF_ABS, ADV_ADDR_START + 4),
+            _jump(BPF_JMP | BPF_JEQ | BPF_K, int.from_bytes(address[4:], "big"), 0, 1),
+            _stmt(BPF_JMP | BPF_JA, remaining),
+        ]
+    if addresses:
+        program.append(_stmt(BPF_RET | BPF_K, REJECT))
+    # M[0] = end of the advertising data, X = position of the AD structure
+    program += [
+        _stmt(BPF_LD | BPF_B | BPF_ABS, ADV_DATA_LENGTH),
+        _stmt(BPF_ALU | BPF_ADD | BPF_K, ADV_DATA_START),
+        _stmt(BPF_ST, 0),
+        _stmt(BPF_LDX | BPF_W | BPF_IMM, ADV_DATA_START),
+    ]
+    # the company identifier is little endian, halfword loads are big endian
+    company = int.from_bytes(PUCKJS_MANUFACTURER_ID.to_bytes(2, "little"), "big")
+    for _ in range(MAX_AD_STRUCTURES):
+        program += [
+            _stmt(BPF_LD | BPF_MEM, 0),
+            _jump(BPF_JMP | BPF_JGT | BPF_X, 0, 1, 0),
+            _stmt(BPF_RET | BPF_K, REJECT),
+            _stmt(BPF_LD | BPF_B | BPF_IND, 1),
+            _jump(BPF_JMP | BPF_JEQ | BPF_K, AD_TYPE_MANUFACTURER_DATA, 0, 4),
+            _stmt(BPF_LD | BPF_H | BPF_IND, 2),
+            _jump(BPF_JMP | BPF_JEQ | BPF_K, company, 0, 1),
+            _stmt(BPF_RET | BPF_K, ACCEPT),
+            _stmt(BPF_RET | BPF_K, REJECT),
+            # next AD structure, a zero length ends the data
+            _stmt(BPF_LD | BPF_B | BPF_IND, 0),
+            _jump(BPF_JMP | BPF_JEQ | BPF_K, 0, 0, 1),
+            _stmt(BPF_RET | BPF_K, REJECT),
+            _stmt(BPF_ALU | BPF_ADD | BPF_K, 1),
+            _stmt(BPF_ALU | BPF_ADD | BPF_X),
+            _stmt(BPF_MISC | BPF_TAX),
+        ]
+    program.append(_stmt(BPF_RET | BPF_K, ACCEPT))
+    return program
+
+
+def attach_filter(sock, program):
+    """Attach a filter program to a socket."""
+    filters = ctypes.create_string_buffer(
+        b"".join(SOCK_FILTER.pack(*instruction) for instruction in program)
+    )
+    # struct sock_fprog, the kernel copies the instructions
+    fprog = struct.pack("HL", len(program), ctypes.addressof(filters))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def run_filter(program, data):
+    """Run a filter program on a frame, return the number of bytes kept.
+
+    Only the instructions build_filter emits are supported. Loads past
+    the end of the frame reject it, as in the kernel.
+    """
+    acc = index = pc = 0
+    memory = [0] * 16
+    size = len(data)
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+        cls = code & 0x07
+        if cls == BPF_RET:
+            return k if code & 0x18 == BPF_K else acc
+        if cls == BPF_LD:
+            mode = code & 0xE0
+            if mode == BPF_MEM:
+                acc = memory[k]
+                continue
+            if mode == BPF_IMM:
+                acc = k
+                continue
+            offset = k + index if mode == BPF_IND else k
+            width = {BPF_W: 4, BPF_H: 2, BPF_B: 1}[code & 0x18]
+            if offset + width > size:
+                return REJECT
+            acc = int.from_bytes(data[offset:offset + width], "big")
+        elif cls == BPF_LDX:
+            index = k
+        elif cls == BPF_ST:
+            memory[k] = acc
+        elif cls == BPF_ALU:
+            if code & 0xF0 != BPF_ADD:
+                raise ValueError("Unsupported instruction: {:#x}".format(code))
+            acc = (acc + (index if code & BPF_X else k)) & 0xFFFFFFFF
+        elif cls == BPF_JMP:
+            operation = code & 0xF0
+            if operation == BPF_JA:
+                pc += k
+                continue
+            operand = index if code & BPF_X else k
+            if operation == BPF_JEQ:
+                taken = acc == operand
+            elif operation == BPF_JGT:
+                taken = acc > operand
+            else:
+                raise ValueError("Unsupported instruction: {:#x}".format(code))
+            pc += jt if taken else jf
+        elif cls == BPF_MISC:
+            if code & 0xF8 == BPF_TXA:
+                acc = index
+            else:
+                index = acc
+        else:
+            raise ValueError("Unsupported instruction: {:#x}".format(code))
@@ -0,0 +1,149 @@
+"""Recording and replay of raw HCI frames.
+
+A capture file starts with the CAPTURE_MAGIC header followed by one
+record per frame: the RECORD_HEADER (receive time, HCI interface, frame
+length) and the frame bytes. Records are only appended, so a capture
+being written can be read up to its last complete record.
+"""
+import logging
+import mmap
+import struct
+import time
+from threading import Event, Lock, Thread
+
+_LOGGER = logging.getLogger(__name__)
+
+CAPTURE_MAGIC = b"PUCKCAP1"
+# receive time (seconds since the epoch), interface number, frame length
+RECORD_HEADER = struct.Struct("<dBH")
+
+
+class CaptureWriter:
+    """Append raw HCI frames to a capture file."""
+
+    def __init__(self, path):
+        """Open the capture file, writing the header to a new file."""
+        self.path = path
+        self.frames = 0
+        self._lock = Lock()
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(CAPTURE_MAGIC)
+        else:
+            with open(path, "rb") as capture:
+                if capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                    self._file.close()
+                    raise ValueError("Not a capture file: {}".format(path))
+
+    def append(self, frame, interface=0, timestamp=None):
+        """Record a frame, may be called from several HCIdump threads."""
+        if timestamp is None:
+            timestamp = time.time()
+        record = RECORD_HEADER.pack(timestamp, interface, len(frame)) + frame
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(record)
+            self.frames += 1
+
+    def flush(self):
+        """Write the buffered records to the file."""
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        """Close the capture file."""
+        with self._lock:
+            self._file.close()
+        _LOGGER.debug("Recorded %s frames to %s", self.frames, self.path)
+
+
+def read_capture(path):
+    """Yield (timestamp, interface, frame) for every record of a capture.
+
+    The file is memory mapped, so a large capture is not read into
+    memory at once. A truncated last record is ignored.
+    """
+    with open(path, "rb") as capture:
+        if capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("Not a capture file: {}".format(path))
+        size = capture.seek(0, 2)
+        if size == len(CAPTURE_MAGIC):
+            return
+        with mmap.mmap(capture.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            pos = len(CAPTURE_MAGIC)
+            while pos + RECORD_HEADER.size <= size:
+                timestamp, interface, length = RECORD_HEADER.unpack_from(mapped, pos)
+                pos += RECORD_HEADER.size
+                if pos + length > size:
+                    _LOGGER.warning("Truncated record at the end of %s", path)
+                    break
+                yield timestamp, interface, mapped[pos:pos + length]
+                pos += length
+
+
+def replay_capture(
+    path, collect, speed=1, stop_event=None, timestamps=False, interfaces=False
+):
+    """Feed the frames of a capture to collect(frame).
+
+    speed 1 replays at the recorded speed, N at N times the recorded
+    speed and 0 or None as fast as possible. With timestamps the
+    recorded receive time is passed too, as collect(frame, timestamp),
+    with interfaces the interface, as collect(frame, interface).
+    Returns the number of replayed frames.
+    """
+    count = 0
+    first = start = None
+    for timestamp, interface, frame in read_capture(path):
+        if stop_event is not None and stop_event.is_set():
+            break
+        if speed:
+            if first is None:
+                first, start = timestamp, time.monotonic()
+            delay = (timestamp - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                if stop_event is None:
+                    time.sleep(delay)
+                elif stop_event.wait(delay):
+                    break
+        if timestamps:
+            collect(frame, timestamp)
+        elif interfaces:
+            collect(frame, interface)
+        else:
+            collect(frame)
+        count += 1
+    return count
+
+
+class CaptureReplay(Thread):
+    """Replay a capture in the background, standing in for HCIdump."""
+
+    def __init__(self, path, collect, speed=1, interfaces=False):
+        """Initiate the replay thread, interfaces as for replay_capture."""
+        Thread.__init__(self)
+        self._path = path
+        self._collect = collect
+        self._speed = speed
+        self._interfaces = interfaces
+        self._stop_event = Event()
+        self.frames = 0
+
+    def run(self):
+        """Replay the capture."""
+        _LOGGER.debug("Replaying %s at speed %s", self._path, self._speed)
+        self.frames = replay_capture(
+            self._path,
+            self._collect,
+            self._speed,
+            self._stop_event,
+            interfaces=self._interfaces,
+        )
+        _LOGGER.debug("Replayed %s frames from %s", self.frames, self._path)
+
+    def join(self, timeout=10):
+        """Stop the replay and join the thread."""
+        self._stop_event.set()
+        Thread.join(self, timeout)
@@ -13,6 +13,40 @@ CONF_HCI_INTERFACE = "hci_interface"
 CONF_BATT_ENTITIES = "batt_entities"
 CONF_REPORT_UNKNOWN = "report_unknown"
 CONF_ESPRUINO_PATH = 'path_to_espruino'
+CONF_CONTINUOUS_SCAN = "continuous_scan"
+CONF_BUFFER_SIZE = "buffer_size"
+CONF_BUFFER_POLICY = "buffer_policy"
+CONF_INSTANT_SWITCHES = "instant_switches"
+CONF_NATIVE_SCAN = "native_scan"
+CONF_EWMA_ALPHA = "ewma_alpha"
+CONF_CAPTURE_FILE = "capture_file"
+CONF_METRICS = "metrics"
+CONF_CHANGE_ONLY = "change_only"
+CONF_DEADBAND = "deadband"
+CONF_HEARTBEAT = "heartbeat"
+CONF_BPF_FILTER = "bpf_filter"
+CONF_PROGRAM_CONCURRENCY = "program_concurrency"
+CONF_PROGRAM_TIMEOUT = "program_timeout"
+CONF_DEDUP_WINDOW = "dedup_window"
+CONF_DECODE_CACHE = "decode_cache"
+CONF_BATCH_ENGINE = "batch_engine"
+CONF_ADAPTIVE_PERIOD = "adaptive_period"
+CONF_MIN_PERIOD = "min_period"
+CONF_MAX_PERIOD = "max_period"
+CONF_WATCHDOG = "watchdog"
+CONF_STALL_TIMEOUT = "stall_timeout"
+CONF_DECODE_WORKERS = "decode_workers"
+CONF_HISTORY = "history"
+
+# HCIdump buffer overflow policies
+BUFFER_POLICY_DROP_OLDEST = "drop_oldest"
+BUFFER_POLICY_DROP_NEWEST = "drop_newest"
+BUFFER_POLICY_LATEST_PER_MAC = "latest_per_mac"
+BUFFER_POLICIES = [
+    BUFFER_POLICY_DROP_OLDEST,
+    BUFFER_POLICY_DROP_NEWEST,
+    BUFFER_POLICY_LATEST_PER_MAC,
+]
 
 
 # Default values for configuration options
@@ -27,10 +61,36 @@ DEFAULT_BATT_ENTITIES = False
 DEFAULT_REPORT_UNKNOWN = False
 DEFAULT_DISCOVERY = True
 DEFAULT_ESPRUINO_PATH = '/usr/bin/espruino'
+DEFAULT_CONTINUOUS_SCAN = False
+DEFAULT_BUFFER_SIZE = 20000
+DEFAULT_BUFFER_POLICY = BUFFER_POLICY_DROP_OLDEST
+DEFAULT_INSTANT_SWITCHES = False
+DEFAULT_NATIVE_SCAN = False
+DEFAULT_EWMA_ALPHA = 0
+DEFAULT_METRICS = False
+DEFAULT_CHANGE_ONLY = False
+DEFAULT_DEADBAND = 0
+DEFAULT_HEARTBEAT = 3600
+DEFAULT_BPF_FILTER = False
+DEFAULT_PROGRAM_CONCURRENCY = 2
+DEFAULT_PROGRAM_TIMEOUT = 120
+DEFAULT_DEDUP_WINDOW = 100
+DEFAULT_DECODE_CACHE = 0
+DEFAULT_BATCH_ENGINE = False
+DEFAULT_ADAPTIVE_PERIOD = False
+DEFAULT_MIN_PERIOD = 10
+DEFAULT_MAX_PERIOD = 600
+DEFAULT_WATCHDOG = False
+DEFAULT_STALL_TIMEOUT = 60
+DEFAULT_DECODE_WORKERS = 0
+DEFAULT_HISTORY = False
 
 
 """Fixed constants."""
 
+# Bluetooth SIG company identifier used by the puck.js firmware (0x0590)
+PUCKJS_MANUFACTURER_ID = 1424
+
 # Sensor measurement limits to exclude erroneous spikes from the results (temperature in °C)
 CONF_TMIN = -40.0
 CONF_TMAX = 60.0
@@ -0,0 +1,93 @@
+"""Deduplication of advertisements heard by several HCI interfaces."""
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from .parser import (
+    ADV_ADDR_END,
+    ADV_ADDR_START,
+    ADV_DATA_START,
+    HCI_LE_META_EVENT,
+    LE_ADVERTISING_REPORT,
+)
+
+
+class FrameDeduplicator:
+    """Pass on one copy of an advertisement received by several adapters.
+
+    A single advertising report is held back for window seconds, keyed
+    on its address and advertising data. Copies arriving from other
+    interfaces meanwhile are dropped, keeping the one with the best
+    rssi. A repeat from the same interface is a new advertisement and
+    releases the held copy. At most max_entries reports are held, the
+    oldest is released first when more arrive.
+    """
+
+    def __init__(self, release, window=0.1, max_entries=1024, clock=monotonic):
+        """Initialize the deduplicator, release(frame) takes the kept copies."""
+        self.window = window
+        self.max_entries = max_entries
+        self.duplicates = 0
+        self._release = release
+        self._clock = clock
+        # key -> [deadline, frame, interface, rssi], oldest first
+        self._pending = OrderedDict()
+        # raw address -> interface of the last kept copy
+        self._best_interfaces = {}
+        self._lock = Lock()
+
+    def add(self, frame, interface):
+        """Take a frame received on an interface."""
+        if (
+            len(frame) <= ADV_DATA_START
+            or frame[4] != 1
+            or frame[3] != LE_ADVERTISING_REPORT
+            or frame[1] != HCI_LE_META_EVENT
+        ):
+            self._release(frame)
+            return
+        # address and advertising data, without the trailing rssi
+        key = frame[ADV_ADDR_START:-1]
+        rssi = frame[-1]
+        if rssi > 127:
+            rssi -= 256
+        now = self._clock()
+        with self._lock:
+            self._expire(now)
+            entry = self._pending.get(key)
+            if entry is not None:
+                if entry[2] != interface:
+                    self.duplicates += 1
+                    if rssi > entry[3]:
+                        entry[1:] = frame, interface, rssi
+                    return
+                del self._pending[key]
+                self._emit(entry)
+            self._pending[key] = [now + self.window, frame, interface, rssi]
+            if len(self._pending) > self.max_entries:
+                self._emit(self._pending.popitem(last=False)[1])
+
+    def flush(self):
+        """Release all held frames."""
+        with self._lock:
+            while self._pending:
+                self._emit(self._pending.popitem(last=False)[1])
+
+    def take_best_interfaces(self):
+        """Return the interface of the best copy per raw address and reset."""
+        with self._lock:
+            best, self._best_interfaces = self._best_interfaces, {}
+        return best
+
+    def _emit(self, entry):
+        frame = entry[1]
+        self._best_interfaces[frame[ADV_ADDR_START:ADV_ADDR_END]] = entry[2]
+        self._release(frame)
+
+    def _expire(self, now):
+        pending = self._pending
+        while pending:
+            key = next(iter(pending))
+            if pending[key][0] > now:
+                return
+            self._emit(pending.pop(key))
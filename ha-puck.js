@@ -7,16 +7,19 @@ var hold_timeout = 0;
 var battery = Puck.getBatteryPercentage();
 var temp = E.getTemperature();
 
-function pad(s,size) {
-    while (s.length < (size || 2)) {s = "0" + s;}
-    return s;
-}
+// Binary advertisement v1: version, battery (%), temperature (centi-degrees,
+// int16 little endian), flags (bit 0 button, bit 1 upside down), sequence
+var PAYLOAD_VERSION = 1;
+var sequence = 0;
 
 function advertise(button_state, upside_down){
   puck_data = (button_state & 0x1) | (upside_down & 0x1) << 1;
   battery = (battery + Puck.getBatteryPercentage())/2;
   temp = (temp + E.getTemperature())/2;
-  data = pad(battery.toFixed(0), 3) + pad(temp.toFixed(2),4) + puck_data.toString();
+  sequence = (sequence + 1) & 0xFF;
+  var centi = Math.round(temp * 100);
+  data = [PAYLOAD_VERSION, E.clip(Math.round(battery), 0, 100),
+          centi & 0xFF, (centi >> 8) & 0xFF, puck_data, sequence];
   NRF.setAdvertising({},{manufacturer: 0x0590, manufacturerData:data});
   console.log(data);
 }
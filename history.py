@@ -0,0 +1,367 @@
+"""On-disk history of the published readings per device.
+
+Every device has a file per tier: the raw readings of the update
+cycles, and their downsampling to minutes and to hours. A file is a
+memory-mapped ring of fixed-width records. It is not append-only: once
+full, the oldest records are overwritten, so each tier keeps a window
+of its capacity. The downsampled records hold the mean temperature and
+rssi, the last battery level and the flags seen during the minute or
+hour.
+
+The minute and hour being folded are only written when they are over
+or the store is closed. After a crash, the raw records of the current
+minute and hour are on disk but their downsampling is lost. When a
+store is reopened within the minute or hour it was closed in, the new
+readings are merged into its last record, so the times of the records
+of a tier stay in increasing order.
+"""
+import math
+import mmap
+import os
+import struct
+from collections import namedtuple
+from threading import Lock
+
+from .parser import FLAG_BUTTON, FLAG_DIRECTION
+
+# file header: magic, format version, record size, capacity, records written
+HEADER = struct.Struct("<4sHHIQ")
+WRITTEN = struct.Struct("<Q")
+WRITTEN_OFFSET = HEADER.size - WRITTEN.size
+MAGIC = b"PJSH"
+VERSION = 1
+# time, temperature, readings folded in, battery, rssi, flags
+RECORD = struct.Struct("<IfHBbB")
+TIME = struct.Struct("<I")
+NO_BATTERY = 0xFF
+NO_RSSI = 0
+MAX_COUNT = 0xFFFF
+
+Tier = namedtuple("Tier", ("name", "resolution", "capacity"))
+# about 11 days of raw readings at a period of 60 s, a month of minutes
+# and ten years of hours
+TIERS = (
+    Tier("raw", 0, 16384),
+    Tier("minute", 60, 44640),
+    Tier("hour", 3600, 87840),
+)
+
+HistoryRecord = namedtuple(
+    "HistoryRecord", ("time", "temperature", "count", "battery", "rssi", "flags")
+)
+
+
+def history_record(values):
+    """Return the HistoryRecord of unpacked record values, None if missing."""
+    time, temperature, count, battery, rssi, flags = values
+    return HistoryRecord(
+        time,
+        # float32, good for about 7 digits
+        None if math.isnan(temperature) else round(temperature, 4),
+        count,
+        None if battery == NO_BATTERY else battery,
+        None if rssi == NO_RSSI else rssi,
+        flags,
+    )
+
+
+class SeriesFile:
+    """Ring of records in a memory-mapped file, ordered by time."""
+
+    def __init__(self, path, capacity):
+        """Open or create the file, an existing file keeps its capacity."""
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < HEADER.size:
+                # sparse, the disk space is taken as records are written
+                os.ftruncate(fd, HEADER.size + capacity * RECORD.size)
+                self._map = mmap.mmap(fd, 0)
+                HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD.size, capacity, 0)
+                written = 0
+            else:
+                self._map = mmap.mmap(fd, 0)
+                magic, version, size, capacity, written = HEADER.unpack_from(self._map)
+                if (
+                    magic != MAGIC
+                    or version != VERSION
+                    or size != RECORD.size
+                    or len(self._map) < HEADER.size + capacity * RECORD.size
+                ):
+                    self._map.close()
+                    raise ValueError("Not a history file: {}".format(path))
+        finally:
+            os.close(fd)
+        self.capacity = capacity
+        self.written = written
+
+    def __len__(self):
+        """Return the number of records held."""
+        return min(self.written, self.capacity)
+
+    def _offset(self, index):
+        position = (self.written - len(self) + index) % self.capacity
+        return HEADER.size + position * RECORD.size
+
+    def __getitem__(self, index):
+        """Return the unpacked values of a record, the oldest first."""
+        if not 0 <= index < len(self):
+            raise IndexError("record index out of range")
+        return RECORD.unpack_from(self._map, self._offset(index))
+
+    def time(self, index):
+        """Return the time of a record."""
+        return TIME.unpack_from(self._map, self._offset(index))[0]
+
+    def append(self, values):
+        """Write a record, over the oldest one if full."""
+        position = self.written % self.capacity
+        RECORD.pack_into(self._map, HEADER.size + position * RECORD.size, *values)
+        self.written += 1
+        WRITTEN.pack_into(self._map, WRITTEN_OFFSET, self.written)
+
+    def replace_last(self, values):
+        """Overwrite the newest record."""
+        RECORD.pack_into(self._map, self._offset(len(self) - 1), *values)
+
+    def span(self, start, end):
+        """Return the index range of the records from start to end."""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.time(middle) < start:
+                low = middle + 1
+            else:
+                high = middle
+        first = low
+        high = len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.time(middle) <= end:
+                low = middle + 1
+            else:
+                high = middle
+        return range(first, low)
+
+    def flush(self):
+        """Write the changes to disk."""
+        self._map.flush()
+
+    def close(self):
+        """Close the file."""
+        self._map.close()
+
+
+class Bucket:
+    """Records of one minute or hour being folded into one."""
+
+    __slots__ = (
+        "start",
+        "count",
+        "temperature_sum",
+        "temperature_count",
+        "rssi_sum",
+        "rssi_count",
+        "battery",
+        "flags",
+    )
+
+    def __init__(self, start):
+        """Initialize an empty bucket starting at start."""
+        self.start = start
+        self.count = 0
+        self.temperature_sum = 0.0
+        self.temperature_count = 0
+        self.rssi_sum = 0
+        self.rssi_count = 0
+        self.battery = NO_BATTERY
+        self.flags = 0
+
+    def add(self, values):
+        """Fold in a record, weighted by the readings it holds."""
+        _, temperature, count, battery, rssi, flags = values
+        self.count = min(self.count + count, MAX_COUNT)
+        if not math.isnan(temperature):
+            self.temperature_sum += temperature * count
+            self.temperature_count += count
+        if rssi != NO_RSSI:
+            self.rssi_sum += rssi * count
+            self.rssi_count += count
+        if battery != NO_BATTERY:
+            self.battery = battery
+        self.flags |= flags
+
+    def record(self):
+        """Return the values of the downsampled record."""
+        temperature = math.nan
+        if self.temperature_count:
+            temperature = self.temperature_sum / self.temperature_count
+        rssi = NO_RSSI
+        if self.rssi_count:
+            # 0 stands for no rssi
+            rssi = round(self.rssi_sum / self.rssi_count) or -1
+        return self.start, temperature, self.count, self.battery, rssi, self.flags
+
+
+class DeviceHistory:
+    """The tiers of one device, with the minute and hour being folded."""
+
+    def __init__(self, path, tiers=TIERS):
+        """Open the files of the tiers, named path.<tier name>."""
+        self.tiers = tiers
+        self.series = []
+        self._buckets = [None] * len(tiers)
+        # the last records of the files, for the buckets they were closed in
+        self._resumed = [None] * len(tiers)
+        try:
+            for tier in tiers:
+                self.series.append(
+                    SeriesFile("{}.{}".format(path, tier.name), tier.capacity)
+                )
+        except (OSError, ValueError):
+            self.close()
+            raise
+
+    def append(self, values):
+        """Add raw record values and downsample them."""
+        self.series[0].append(values)
+        if len(self.tiers) > 1:
+            self._fold(1, values)
+
+    def _fold(self, level, values):
+        time = values[0]
+        start = time - time % self.tiers[level].resolution
+        bucket = self._buckets[level]
+        if bucket is not None and bucket.start != start:
+            self._finish(level)
+            bucket = None
+        if bucket is None:
+            bucket = self._buckets[level] = Bucket(start)
+            series = self.series[level]
+            if len(series) and series.time(len(series) - 1) == start:
+                self._resumed[level] = series[len(series) - 1]
+        bucket.add(values)
+
+    def _finish(self, level):
+        values = self._buckets[level].record()
+        self._buckets[level] = None
+        resumed = self._resumed[level]
+        if resumed is None:
+            self.series[level].append(values)
+        else:
+            self._resumed[level] = None
+            merged = Bucket(values[0])
+            merged.add(resumed)
+            merged.add(values)
+            self.series[level].replace_last(merged.record())
+        # the resumed record is already folded into the next tier
+        if level + 1 < len(self.tiers):
+            self._fold(level + 1, values)
+
+    def flush(self):
+        """Write the changes to disk."""
+        for series in self.series:
+            series.flush()
+
+    def close(self):
+        """Write the minute and hour being folded and close the files."""
+        for level in range(1, len(self.series)):
+            if self._buckets[level] is not None:
+                self._finish(level)
+        for series in self.series:
+            series.close()
+
+
+class HistoryStore:
+    """The history of all devices in a directory, a file per device and tier.
+
+    The directory and the files of a device are created when it is first
+    seen, not by the constructor. Appending and querying may happen from
+    different threads.
+    """
+
+    def __init__(self, directory, tiers=TIERS):
+        """Initialize the store of the files in directory."""
+        self.directory = directory
+        self.tiers = tiers
+        self._devices = {}
+        self._lock = Lock()
+
+    def _device(self, mac, create=True):
+        name = mac.replace(":", "").lower()
+        history = self._devices.get(name)
+        if history is None:
+            path = os.path.join(self.directory, name)
+            if not create and not os.path.exists(
+                "{}.{}".format(path, self.tiers[0].name)
+            ):
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            history = self._devices[name] = DeviceHistory(path, self.tiers)
+        return history
+
+    def append(
+        self,
+        mac,
+        time,
+        temperature=None,
+        battery=None,
+        rssi=None,
+        button=None,
+        direction=None,
+    ):
+        """Add the readings of a device published at time, epoch seconds."""
+        flags = 0
+        if button:
+            flags |= FLAG_BUTTON
+        if direction:
+            flags |= FLAG_DIRECTION
+        values = (
+            int(time),
+            math.nan if temperature is None else temperature,
+            1,
+            NO_BATTERY if battery is None else battery,
+            NO_RSSI if rssi is None else max(-128, min(rssi, 127)),
+            flags,
+        )
+        with self._lock:
+            self._device(mac).append(values)
+
+    def query(self, mac, start, end, tier=None):
+        """Return (tier name, HistoryRecords) of a device from start to end.
+
+        Without a tier the finest one still holding start is used, or
+        else the one reaching back the furthest.
+        """
+        with self._lock:
+            history = self._device(mac, create=False)
+            if history is None:
+                return None, []
+            if tier is None:
+                oldest = [
+                    series.time(0) if len(series) else math.inf
+                    for series in history.series
+                ]
+                level = oldest.index(min(oldest))
+                for index, time in enumerate(oldest):
+                    if time <= start:
+                        level = index
+                        break
+            else:
+                level = [item.name for item in self.tiers].index(tier)
+            series = history.series[level]
+            return self.tiers[level].name, [
+                history_record(series[index]) for index in series.span(start, end)
+            ]
+
+    def flush(self):
+        """Write the changes to disk."""
+        with self._lock:
+            for history in self._devices.values():
+                history.flush()
+
+    def close(self):
+        """Close the files of all devices."""
+        with self._lock:
+            for history in self._devices.values():
+                history.close()
+            self._devices.clear()
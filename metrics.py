@@ -0,0 +1,149 @@
+"""Counters and histograms of the scanner pipeline."""
+from bisect import bisect_left
+
+# Upper bounds of the histogram buckets, 1 µs to about 8 s for durations
+# and 1 to about a million for frame counts
+DURATION_BUCKETS = tuple(0.000001 * 2 ** i for i in range(24))
+COUNT_BUCKETS = tuple(2 ** i for i in range(21))
+
+
+class Histogram:
+    """Count of observations per bucket, plus their count, sum and range."""
+
+    __slots__ = ("bounds", "count", "total", "min", "max", "_buckets")
+
+    def __init__(self, bounds=DURATION_BUCKETS):
+        """Initialize an empty histogram with the bucket upper bounds."""
+        self.bounds = bounds
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        # the last bucket holds what is above the highest bound
+        self._buckets = [0] * (len(bounds) + 1)
+
+    def observe(self, value):
+        """Add an observation."""
+        self._buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the observations of a histogram with the same bounds."""
+        for index, count in enumerate(other._buckets):
+            self._buckets[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, fraction):
+        """Return the upper bound of the bucket holding the quantile."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self._buckets):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        """Return the histogram as a dict of plain values."""
+        buckets = {}
+        for index, count in enumerate(self._buckets):
+            if count:
+                bound = self.bounds[index] if index < len(self.bounds) else "+Inf"
+                buckets[str(bound)] = count
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class PipelineMetrics:
+    """Metrics of the scanner, the frame processing and the update cycle.
+
+    The counters are plain ints and dicts: frames_received is only
+    incremented by the thread of its interface, everything else by the
+    update cycle or the FrameConsumer, never at the same time, so no
+    locking is needed.
+    """
+
+    def __init__(self):
+        """Initialize the metrics."""
+        # frames received per HCI interface
+        self.frames_received = {}
+        # frames parse_raw_message rejected, per reason
+        self.frames_rejected = {}
+        self.frames_parsed = 0
+        # copies of advertisements dropped by the deduplicator
+        self.frames_duplicate = 0
+        self.parse_time = Histogram()
+        self.discover_time = Histogram()
+        # frames taken from the buffer per update cycle
+        self.buffer_occupancy = Histogram(COUNT_BUCKETS)
+        self.hcidump_starts = 0
+        self.hcidump_restarts = 0
+        self.hcidump_join_time = Histogram()
+        # seconds the platform setup took
+        self.setup_time = None
+
+    def receive(self, interface):
+        """Count a frame received on an interface."""
+        try:
+            self.frames_received[interface] += 1
+        except KeyError:
+            self.frames_received[interface] = 1
+
+    def reject(self, reason, count=1):
+        """Count a frame rejected by the parser."""
+        self.frames_rejected[reason] = self.frames_rejected.get(reason, 0) + count
+
+    def merge_parsing(self, other):
+        """Add the parse counters of the metrics of a decode worker."""
+        self.frames_parsed += other.frames_parsed
+        for reason, count in other.frames_rejected.items():
+            self.reject(reason, count)
+        self.parse_time.merge(other.parse_time)
+
+    def snapshot(self, buffer_stats=None, cache_stats=None):
+        """Return all metrics as a JSON serializable dict.
+
+        buffer_stats and cache_stats are the FrameBuffer and ReadingCache
+        counters to include.
+        """
+        snapshot = {
+            "frames_received": {
+                "hci{}".format(interface): count
+                for interface, count in sorted(self.frames_received.items())
+            },
+            "frames_rejected": dict(self.frames_rejected),
+            "frames_parsed": self.frames_parsed,
+            "frames_duplicate": self.frames_duplicate,
+            "parse_time": self.parse_time.snapshot(),
+            "discover_time": self.discover_time.snapshot(),
+            "buffer_occupancy": self.buffer_occupancy.snapshot(),
+            "hcidump_starts": self.hcidump_starts,
+            "hcidump_restarts": self.hcidump_restarts,
+            "hcidump_join_time": self.hcidump_join_time.snapshot(),
+            "setup_time": self.setup_time,
+        }
+        if buffer_stats is not None:
+            snapshot["buffer"] = dict(buffer_stats)
+        if cache_stats is not None:
+            snapshot["decode_cache"] = dict(cache_stats)
+        return snapshot
@@ -0,0 +1,411 @@
+"""Parser for puck.js BLE advertisements."""
+import struct
+from collections import OrderedDict
+
+from .const import PUCKJS_MANUFACTURER_ID
+
+# Layout of a raw legacy LE Advertising Report frame as read from the HCI
+# socket: packet type, event code, parameter length, subevent, number of
+# reports, event type, address type, address, data length, AD structures, rssi
+HCI_EVENT_PACKET = 0x04
+HCI_LE_META_EVENT = 0x3E
+LE_ADVERTISING_REPORT = 0x02
+LE_EXT_ADVERTISING_REPORT = 0x0D
+ADV_ADDR_START = 7
+ADV_ADDR_END = 13
+ADV_DATA_LENGTH = 13
+ADV_DATA_START = 14
+AD_TYPE_MANUFACTURER_DATA = 0xFF
+# AD type and manufacturer ID every puck.js advertisement holds
+PUCKJS_AD_MARKER = struct.pack("<BH", AD_TYPE_MANUFACTURER_DATA, PUCKJS_MANUFACTURER_ID)
+
+# ASCII payload of advertise() in older ha-puck.js firmware (v0): 3 digit
+# battery level, 5 character temperature and the button/upside down flags digit
+ASCII_PAYLOAD = struct.Struct("3s5sB")
+# binary payload of advertise() in ha-puck.js (v1): version, battery level,
+# temperature in centi-degrees, flags and a rolling sequence counter
+PAYLOAD_V1 = 0x01
+BINARY_PAYLOAD_V1 = struct.Struct("<BBhBB")
+FLAG_BUTTON = 0x01
+FLAG_DIRECTION = 0x02
+
+
+class PuckReading:
+    """Decoded puck.js advertisement.
+
+    temperature, battery, direction and button are None for frames
+    without puck.js manufacturer data, sequence is None unless the
+    payload is binary.
+    """
+
+    __slots__ = (
+        "rssi",
+        "mac",
+        "temperature",
+        "battery",
+        "direction",
+        "button",
+        "sequence",
+    )
+
+    type = "puck.js"
+
+    def __init__(
+        self,
+        rssi,
+        mac,
+        temperature=None,
+        battery=None,
+        direction=None,
+        button=None,
+        sequence=None,
+    ):
+        """Initialize the reading."""
+        self.rssi = rssi
+        self.mac = mac
+        self.temperature = temperature
+        self.battery = battery
+        self.direction = direction
+        self.button = button
+        self.sequence = sequence
+
+    def __repr__(self):
+        """Return the reading as a string."""
+        return "PuckReading({})".format(
+            ", ".join(
+                "{}={!r}".format(name, getattr(self, name)) for name in self.__slots__
+            )
+        )
+
+
+def raw_address(mac):
+    """Return a MAC address as the little endian bytes of the HCI frame."""
+    return bytes.fromhex(mac.replace(":", ""))[::-1]
+
+
+def compile_whitelist(whitelist):
+    """Prepare a list of MAC addresses for parse_raw_message.
+
+    The result holds every address both in the lower case notation used
+    by aioblescan and as the raw little endian bytes of the HCI frame, so
+    frames can be matched without decoding them.
+    """
+    compiled = set()
+    for mac in whitelist:
+        compiled.add(mac.lower())
+        compiled.add(raw_address(mac))
+    return frozenset(compiled)
+
+
+def scan_raw_message(data):
+    """Locate the fields of a single legacy advertising report.
+
+    Walks the AD structures of the raw frame without decoding anything.
+    Returns a tuple (address, rssi, manufacturer id, payload start,
+    payload end) where the manufacturer fields are None if the report
+    carries no manufacturer specific data, or None if the frame is not a
+    well formed single report.
+    """
+    if (
+        len(data) <= ADV_DATA_START
+        or data[4] != 1
+        or data[3] != LE_ADVERTISING_REPORT
+        or data[1] != HCI_LE_META_EVENT
+        or data[0] != HCI_EVENT_PACKET
+    ):
+        return None
+    end = ADV_DATA_START + data[ADV_DATA_LENGTH]
+    if end > len(data):
+        return None
+    manufacturer_id = start = stop = None
+    pos = ADV_DATA_START
+    while pos < end:
+        length = data[pos]
+        if length == 0:
+            break
+        if pos + length >= end:
+            # AD structure runs past the advertising data
+            return None
+        if manufacturer_id is None and data[pos + 1] == AD_TYPE_MANUFACTURER_DATA:
+            if length < 3:
+                return None
+            manufacturer_id = data[pos + 2] | data[pos + 3] << 8
+            start = pos + 4
+            stop = pos + length + 1
+        pos += length + 1
+    rssi = data[end] if end < len(data) else None
+    if rssi is not None and rssi > 127:
+        rssi -= 256
+    return data[ADV_ADDR_START:ADV_ADDR_END], rssi, manufacturer_id, start, stop
+
+
+def prefilter_raw_message(data, whitelist):
+    """Return False if the frame can not hold data of a wanted puck.js.
+
+    Frames from devices that are not whitelisted and frames carrying
+    another vendor's manufacturer data are rejected on the raw bytes.
+    Frames that do not have the layout of a single legacy advertising
+    report are passed on for a full decode.
+    """
+    if len(data) < 4 or data[0] != HCI_EVENT_PACKET or data[1] != HCI_LE_META_EVENT:
+        return False
+    scanned = scan_raw_message(data)
+    if scanned is None:
+        return data[3] in (LE_ADVERTISING_REPORT, LE_EXT_ADVERTISING_REPORT)
+    address, _, manufacturer_id, start, stop = scanned
+    if whitelist and address not in whitelist:
+        return False
+    if manufacturer_id is not None and (
+        manufacturer_id != PUCKJS_MANUFACTURER_ID or start == stop
+    ):
+        return False
+    return True
+
+
+def reject_reason(data, whitelist):
+    """Return why parse_raw_message rejected the frame.
+
+    One of "not_advertisement", "whitelist", "manufacturer", "payload",
+    or "decode" for frames aioblescan had to decode.
+    """
+    if data is None or not prefilter_raw_message(data, whitelist):
+        scanned = data and scan_raw_message(data)
+        if scanned is None:
+            return "not_advertisement"
+        if whitelist and scanned[0] not in whitelist:
+            return "whitelist"
+        return "manufacturer"
+    if scan_raw_message(data) is None:
+        return "decode"
+    return "payload"
+
+
+class FlagChangeDetector:
+    """Spot button and upside down changes of pucks in raw frames.
+
+    Meant to be called for every frame as it is received, so it only
+    locates the flags byte and compares it with the last one seen from
+    the same device.
+    """
+
+    def __init__(self, whitelist):
+        """Initialize the detector, whitelist as for parse_raw_message."""
+        self._whitelist = whitelist
+        self._flags = {}
+
+    def __call__(self, data):
+        """Return (mac, direction, button) if the flags changed, else None."""
+        scanned = scan_raw_message(data)
+        if scanned is None:
+            return None
+        address, _, manufacturer_id, start, stop = scanned
+        if manufacturer_id != PUCKJS_MANUFACTURER_ID or stop - start < 5:
+            return None
+        if self._whitelist and address not in self._whitelist:
+            return None
+        if data[start] == PAYLOAD_V1 and stop - start == BINARY_PAYLOAD_V1.size:
+            flags = data[start + 4]
+        else:
+            flags = data[stop - 1]
+        if self._flags.get(address) == flags:
+            return None
+        self._flags[address] = flags
+        return (
+            address[::-1].hex(":"),
+            bool(flags & FLAG_DIRECTION),
+            bool(flags & FLAG_BUTTON),
+        )
+
+
+def decode_payload(data, start, stop, rssi, mac):
+    """Decode the puck.js manufacturer payload held in data[start:stop].
+
+    data may be bytes or a memoryview, the binary v1 payload and the
+    common 9 byte ASCII payload are unpacked in place. Returns None for
+    a malformed payload.
+    """
+    if stop - start == BINARY_PAYLOAD_V1.size and data[start] == PAYLOAD_V1:
+        _, battery, temperature, flags, sequence = BINARY_PAYLOAD_V1.unpack_from(
+            data, start
+        )
+        return PuckReading(
+            rssi,
+            mac,
+            temperature / 100,
+            battery,
+            bool(flags & FLAG_DIRECTION),
+            bool(flags & FLAG_BUTTON),
+            sequence,
+        )
+    try:
+        if stop - start == ASCII_PAYLOAD.size:
+            battery, temperature, flags = ASCII_PAYLOAD.unpack_from(data, start)
+        elif stop - start > 4:
+            battery = data[start:start + 3]
+            temperature = data[start + 3:stop - 1]
+            flags = data[stop - 1]
+        else:
+            return None
+        return PuckReading(
+            rssi,
+            mac,
+            float(temperature),
+            int(battery),
+            bool(flags & FLAG_DIRECTION),
+            bool(flags & FLAG_BUTTON),
+        )
+    except ValueError:
+        return None
+
+
+def parse_raw_message(data, whitelist, report_unknown=False):
+    """Parse the raw data into a PuckReading.
+
+    whitelist is the result of compile_whitelist, empty to accept all
+    devices. Single legacy advertising reports are decoded straight from
+    the raw bytes, anything else is decoded with aioblescan.
+    """
+    if data is None:
+        return None
+    scanned = scan_raw_message(data)
+    if scanned is None:
+        if not prefilter_raw_message(data, whitelist):
+            return None
+        return decode_raw_message(data, whitelist)
+    return parse_scanned(data, scanned, whitelist)
+
+
+def parse_scanned(data, scanned, whitelist):
+    """Return the PuckReading of a frame scanned by scan_raw_message."""
+    address, rssi, manufacturer_id, start, stop = scanned
+    if whitelist and address not in whitelist:
+        return None
+    if manufacturer_id is None:
+        # This message is not a manufacture data
+        return PuckReading(rssi, address[::-1].hex(":"))
+    if manufacturer_id != PUCKJS_MANUFACTURER_ID:
+        # This is not the puck
+        return None
+    return decode_payload(data, start, stop, rssi, address[::-1].hex(":"))
+
+
+class ReadingCache:
+    """Bounded LRU cache of parse_raw_message results.
+
+    A puck repeats the same advertisement many times between changes,
+    on every advertising channel. Single legacy advertising reports are
+    keyed on their raw bytes without the trailing rssi, so a repeat only
+    costs a dict lookup; the rssi is still taken from every frame.
+    Only puck.js advertisements are cached, the frames of other devices
+    make up the bulk of the traffic and would evict them. Other frames
+    are always parsed.
+    """
+
+    def __init__(self, whitelist, report_unknown=False, max_entries=1024):
+        """Initialize the cache, whitelist as for parse_raw_message."""
+        self.whitelist = whitelist
+        self.report_unknown = report_unknown
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # frame without rssi -> (mac, temperature, battery, direction,
+        # button, sequence), least recently used first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        """Return the number of cached frames."""
+        return len(self._entries)
+
+    def parse(self, data):
+        """Return parse_raw_message(data), from the cache if possible."""
+        if (
+            data is None
+            # most frames are not from a puck, they are not worth a lookup
+            or PUCKJS_AD_MARKER not in data
+            or len(data) <= ADV_DATA_START
+            or len(data) != ADV_DATA_START + data[ADV_DATA_LENGTH] + 1
+            or data[4] != 1
+            or data[3] != LE_ADVERTISING_REPORT
+        ):
+            return parse_raw_message(data, self.whitelist, self.report_unknown)
+        key = data[:-1]
+        entries = self._entries
+        fields = entries.get(key)
+        if fields is not None:
+            self.hits += 1
+            entries.move_to_end(key)
+            rssi = data[-1]
+            if rssi > 127:
+                rssi -= 256
+            return PuckReading(rssi, *fields)
+        self.misses += 1
+        scanned = scan_raw_message(data)
+        if scanned is None:
+            return parse_raw_message(data, self.whitelist, self.report_unknown)
+        reading = parse_scanned(data, scanned, self.whitelist)
+        if reading is None or scanned[2] != PUCKJS_MANUFACTURER_ID:
+            # the marker was found in other data
+            return reading
+        entries[key] = (
+            reading.mac,
+            reading.temperature,
+            reading.battery,
+            reading.direction,
+            reading.button,
+            reading.sequence,
+        )
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evictions += 1
+        return reading
+
+    def clear(self):
+        """Drop all cached frames."""
+        self._entries.clear()
+
+    def stats(self):
+        """Return the cache counters."""
+        return {
+            "capacity": self.max_entries,
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def decode_raw_message(data, whitelist):
+    """Fully decode the raw data with aioblescan."""
+    # imported on first use, the raw bytes path decodes nearly every frame
+    import aioblescan as aiobs
+
+    ev=aiobs.HCI_Event()
+    decoded_msg=ev.decode(data)
+    mac= ev.retrieve("peer")
+    mac= mac[0].val if len(mac) > 0 else None
+
+    if not mac or (whitelist and mac not in whitelist):
+        return
+
+    rssi = ev.retrieve("rssi")
+    rssi = rssi[0].val if len(rssi) > 0 else None
+
+    manufacturer_data = ev.retrieve("Manufacturer Specific Data")
+    if len(manufacturer_data) == 0:
+        # This message is not a manufacture data
+        return PuckReading(rssi, mac)
+
+    manufacturer_id = manufacturer_data[0].retrieve("Manufacturer ID")
+    manufacturer_id = manufacturer_id[0].val
+
+    if manufacturer_id != PUCKJS_MANUFACTURER_ID:
+        # This is not the puck
+        return
+
+    payload = manufacturer_data[0].retrieve("Payload")
+    if len(payload) == 0:
+        return
+
+    payload = payload[0].val
+    return decode_payload(payload, 0, len(payload), rssi, mac)
@@ -0,0 +1,279 @@
+"""Folding of the collected HCI frames into per device readings."""
+import logging
+from threading import Lock, Thread
+from time import perf_counter
+
+from .parser import (
+    PUCKJS_AD_MARKER,
+    ReadingCache,
+    parse_raw_message,
+    reject_reason,
+)
+from .stats import MeasurementAggregator
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class DeviceReadings:
+    """What one device reported during an update cycle.
+
+    temperature is the MeasurementAggregator of the temperatures within
+    the limits, it and the other readings are None if not reported.
+    lost counts the advertisements the sequence counter shows were
+    missed, None for payloads without a counter.
+    """
+
+    __slots__ = (
+        "type",
+        "temperature",
+        "direction",
+        "button",
+        "battery",
+        "rssi_sum",
+        "rssi_count",
+        "lost",
+        "has_data",
+    )
+
+    def __init__(self, sensor_type):
+        """Initialize empty readings."""
+        self.type = sensor_type
+        self.temperature = None
+        self.direction = None
+        self.button = None
+        self.battery = None
+        self.rssi_sum = 0
+        self.rssi_count = 0
+        self.lost = None
+        # True once a reading worth publishing was seen
+        self.has_data = False
+
+    def rssi(self):
+        """Return the rounded mean rssi, None without rssi reports."""
+        if not self.rssi_count:
+            return None
+        # int division is correctly rounded, same as statistics.mean
+        return round(self.rssi_sum / self.rssi_count)
+
+
+class FrameProcessor:
+    """Parse HCI frames and fold them into DeviceReadings per MAC.
+
+    devices maps MAC addresses to objects with tmin and tmax temperature
+    limits, default_device is used for the other MACs. Every update cycle
+    gets new temperature aggregates, the EWMA carries over. Repeats of
+    an advertisement with a sequence counter only count for the rssi.
+    With a PipelineMetrics the parse time and rejected frames are
+    recorded. With a cache_size repeated advertisements are taken from a
+    ReadingCache of that many frames instead of being parsed again, which
+    only pays off when most frames are puck.js advertisements, as with
+    the BPF filter.
+    """
+
+    def __init__(
+        self,
+        whitelist,
+        devices,
+        default_device,
+        ewma_alpha=None,
+        log_spikes=False,
+        report_unknown=False,
+        metrics=None,
+        cache_size=0,
+    ):
+        """Initialize the processor, whitelist as for parse_raw_message."""
+        self.whitelist = whitelist
+        self.devices = devices
+        self.default_device = default_device
+        self.ewma_alpha = ewma_alpha
+        self.log_spikes = log_spikes
+        self.report_unknown = report_unknown
+        self.metrics = metrics
+        self.cache = None
+        if cache_size:
+            self.cache = ReadingCache(whitelist, report_unknown, cache_size)
+        self.temp_stats = {}
+        # last sequence counter per MAC
+        self._sequences = {}
+        # button and direction per MAC as last collected
+        self._switches = {}
+        self._readings = {}
+        # MACs heard in the last collected cycle without readings
+        self.silent = []
+
+    def add_frames(self, frames):
+        """Parse and fold in the frames of an update cycle."""
+        if self.metrics is not None:
+            self._add_frames_measured(frames)
+            return
+        for msg in frames:
+            self.add_frame(msg)
+
+    def _add_frames_measured(self, frames):
+        metrics = self.metrics
+        for msg in frames:
+            start = perf_counter()
+            data = self._parse(msg)
+            metrics.parse_time.observe(perf_counter() - start)
+            if data is None:
+                metrics.reject(reject_reason(msg, self.whitelist))
+                continue
+            metrics.frames_parsed += 1
+            self.add_reading(data)
+
+    def add_frame(self, msg):
+        """Parse and fold in a frame, return False if it holds no puck data."""
+        data = self._parse(msg)
+        if data is None:
+            return False
+        self.add_reading(data)
+        return True
+
+    def _parse(self, msg):
+        # only puck.js advertisements are cached, the bulk of the frames
+        # from other devices skip the call into the cache
+        if self.cache is not None and msg is not None and PUCKJS_AD_MARKER in msg:
+            return self.cache.parse(msg)
+        return parse_raw_message(msg, self.whitelist, self.report_unknown)
+
+    def cache_stats(self):
+        """Return the ReadingCache counters, None without a cache."""
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def add_reading(self, data):
+        """Fold in a PuckReading."""
+        mac = data.mac
+        readings = self._readings.get(mac)
+        if readings is None:
+            readings = self._readings[mac] = DeviceReadings(data.type)
+        if data.sequence is not None:
+            last = self._sequences.get(mac)
+            if last == data.sequence:
+                # the same advertisement again
+                if data.rssi:
+                    readings.rssi_sum += int(data.rssi)
+                    readings.rssi_count += 1
+                return
+            if readings.lost is None:
+                readings.lost = 0
+            if last is not None:
+                readings.lost += (data.sequence - last - 1) & 0xFF
+            self._sequences[mac] = data.sequence
+        # store found readings per device
+        if data.temperature is not None:
+            device = self.devices.get(mac, self.default_device)
+            if device.tmax >= data.temperature >= device.tmin:
+                if readings.temperature is None:
+                    # the aggregate of the last cycle may still be read
+                    aggregate = MeasurementAggregator(self.ewma_alpha)
+                    last = self.temp_stats.get(mac)
+                    if last is not None:
+                        aggregate.ewma = last.ewma
+                    readings.temperature = self.temp_stats[mac] = aggregate
+                readings.temperature.add(data.temperature)
+                readings.has_data = True
+            elif self.log_spikes:
+                _LOGGER.error(
+                    "Temperature spike: %s (%s)",
+                    data.temperature,
+                    mac,
+                )
+        if data.direction is not None:
+            readings.direction = int(data.direction)
+            readings.has_data = True
+        if data.button is not None:
+            readings.button = int(data.button)
+            readings.has_data = True
+        if data.battery is not None:
+            readings.battery = int(data.battery)
+            readings.has_data = True
+        if data.rssi:
+            readings.rssi_sum += int(data.rssi)
+            readings.rssi_count += 1
+        readings.type = data.type
+
+    def collect(self, hold=None):
+        """Return the DeviceReadings of the cycle by MAC and start a new one.
+
+        The readings of the MACs in hold are kept for a later cycle,
+        unless their button or direction changed since last collected.
+        The other MACs heard without readings are left in silent.
+        """
+        readings, self._readings = self._readings, {}
+        switches = self._switches
+        if hold:
+            self._readings = {
+                mac: readings.pop(mac)
+                for mac in hold
+                if mac in readings
+                and _switch(readings[mac]) in (None, switches.get(mac))
+            }
+        collected = {}
+        silent = []
+        for mac, device in readings.items():
+            if device.has_data:
+                collected[mac] = device
+                if device.button is not None:
+                    switches[mac] = _switch(device)
+            else:
+                silent.append(mac)
+        self.silent = silent
+        return collected
+
+
+def _switch(readings):
+    """Return the button and direction of DeviceReadings, None if unknown."""
+    if readings.button is None:
+        return None
+    return readings.button, readings.direction
+
+
+class FrameConsumer(Thread):
+    """Fold the frames of a FrameBuffer into a FrameProcessor as they arrive.
+
+    The thread blocks on the buffer until batch frames are waiting or
+    interval seconds passed, then drains and processes them at full
+    speed, so the frames of an update cycle are mostly processed by the
+    time collect() ends it.
+    """
+
+    def __init__(self, source, processor, batch=256, interval=1.0):
+        """Initialize the consumer of a threadsafe FrameBuffer."""
+        Thread.__init__(self, name="PuckjsFrameConsumer", daemon=True)
+        self.source = source
+        self.processor = processor
+        self.batch = batch
+        self.interval = interval
+        # frames processed in the current update cycle
+        self.frames = 0
+        self._lock = Lock()
+        self._running = True
+
+    def run(self):
+        """Process the buffered frames until stopped."""
+        while self._running:
+            if self.source.wait(self.batch, self.interval):
+                frames = self.source.drain()
+                with self._lock:
+                    self.processor.add_frames(frames)
+                    self.frames += len(frames)
+
+    def collect(self, frames=(), hold=None):
+        """Process the remaining frames and end the update cycle.
+
+        Returns the DeviceReadings by MAC, hold as for the processor, and
+        the number of frames processed in the cycle.
+        """
+        with self._lock:
+            self.processor.add_frames(frames)
+            count = self.frames + len(frames)
+            self.frames = 0
+            return self.processor.collect(hold), count
+
+    def stop(self, timeout=None):
+        """Stop the thread."""
+        self._running = False
+        self.source.wake()
+        self.join(timeout)
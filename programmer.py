@@ -0,0 +1,166 @@
+"""Firmware programming of the pucks with espruino."""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from time import monotonic
+
+_LOGGER = logging.getLogger(__name__)
+
+PROGRAMMED = "programmed"
+SKIPPED = "skipped"
+FAILED = "failed"
+TIMEOUT = "timeout"
+
+
+def firmware_hash(path):
+    """Return the SHA-256 of a firmware source file."""
+    with open(path, "rb") as source:
+        return hashlib.sha256(source.read()).hexdigest()
+
+
+class FirmwareStore:
+    """Hash of the firmware last programmed per MAC, kept in a JSON file."""
+
+    def __init__(self, path):
+        """Initialize the store, load() reads the file."""
+        self.path = path
+        self.loaded = False
+        self._hashes = {}
+
+    def load(self):
+        """Read the store, an unreadable file starts it empty."""
+        self.loaded = True
+        try:
+            with open(self.path) as store:
+                self._hashes = dict(json.load(store))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as error:
+            _LOGGER.warning("Firmware store %s not loaded: %s", self.path, error)
+
+    def get(self, mac):
+        """Return the hash of the firmware on a puck, None if unknown."""
+        return self._hashes.get(mac.lower())
+
+    def set(self, mac, digest):
+        """Remember the firmware programmed to a puck."""
+        self._hashes[mac.lower()] = digest
+
+    def save(self):
+        """Write the store, replacing the file atomically."""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as store:
+            json.dump(self._hashes, store, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+
+class FirmwareWatch:
+    """Notice pucks heard without readings, they lack the ha-puck.js firmware.
+
+    A puck heard for more than grace seconds of update cycles without a
+    reading is due for programming. Its timer then starts again, so a
+    programming that did not help is retried after another grace.
+    """
+
+    def __init__(self, grace=60, clock=monotonic):
+        """Initialize the watch, grace in seconds."""
+        self.grace = grace
+        self._clock = clock
+        # time a MAC was first heard without readings since its last reading
+        self._silent_since = {}
+
+    def update(self, silent, reported):
+        """Note the MACs heard without and with readings in a cycle.
+
+        Returns the MACs due for programming.
+        """
+        now = self._clock()
+        silent_since = self._silent_since
+        for mac in reported:
+            silent_since.pop(mac, None)
+        due = []
+        for mac in silent:
+            if now - silent_since.setdefault(mac, now) > self.grace:
+                due.append(mac)
+                silent_since[mac] = now
+        return due
+
+
+class ProgrammingScheduler:
+    """Program pucks in parallel with espruino subprocesses.
+
+    At most concurrency espruino processes run at the same time, each is
+    killed after timeout seconds. Pucks the store knows to run the
+    current firmware are skipped unless forced.
+    """
+
+    def __init__(self, espruino_path, source, store=None, concurrency=2, timeout=120):
+        """Initialize the scheduler."""
+        self.espruino_path = espruino_path
+        self.source = source
+        self.store = store
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    async def async_program(self, macs, force=False):
+        """Program the pucks, return the result per MAC."""
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, firmware_hash, self.source)
+        if self.store is not None and not self.store.loaded:
+            await loop.run_in_executor(None, self.store.load)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = {}
+        pending = []
+        for mac in dict.fromkeys(macs):
+            if not force and self.store is not None and self.store.get(mac) == digest:
+                _LOGGER.debug("Puck.js %s already runs the current firmware", mac)
+                results[mac] = SKIPPED
+            else:
+                pending.append(mac)
+
+        async def program(mac):
+            async with semaphore:
+                results[mac] = await self._async_program_one(mac)
+            if results[mac] == PROGRAMMED and self.store is not None:
+                self.store.set(mac, digest)
+
+        await asyncio.gather(*(program(mac) for mac in pending))
+        if self.store is not None and PROGRAMMED in results.values():
+            await loop.run_in_executor(None, self.store.save)
+        return results
+
+    async def _async_program_one(self, mac):
+        _LOGGER.info("Programming Puck.js with mac: %s.", mac)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                self.espruino_path,
+                "-p",
+                mac,
+                self.source,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+            )
+        except OSError as error:
+            _LOGGER.warning("Running '%s' failed: %s", self.espruino_path, error)
+            return FAILED
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            _LOGGER.warning(
+                "Programming Puck.js %s timed out after %s s", mac, self.timeout
+            )
+            return TIMEOUT
+        if process.returncode:
+            _LOGGER.warning(
+                "Running '%s -p %s %s'\ngave the following error:\n%s",
+                self.espruino_path,
+                mac,
+                self.source,
+                output.decode(errors="replace"),
+            )
+            return FAILED
+        return PROGRAMMED
@@ -0,0 +1,134 @@
+"""Change detection and scheduling of the published entity states."""
+from heapq import heappop, heappush
+from time import monotonic
+
+
+class ChangeFilter:
+    """Decide which entity states are worth writing.
+
+    A state is written when it differs from the last written state of the
+    same key by more than the deadband, or when the last write is older
+    than heartbeat seconds. The deadband is measured from the last
+    written state, so a slow drift is still published once it adds up.
+    """
+
+    def __init__(self, heartbeat=None, clock=monotonic):
+        """Initialize the filter, heartbeat None or 0 to never force writes."""
+        self.heartbeat = heartbeat or None
+        self._clock = clock
+        # last written (state, time) per key
+        self._written = {}
+
+    def changed(self, key, state, deadband=0):
+        """Return True if the state has to be written, and remember it."""
+        now = self._clock()
+        last = self._written.get(key)
+        if last is not None:
+            last_state, last_time = last
+            if self.heartbeat is None or now - last_time < self.heartbeat:
+                if state == last_state:
+                    return False
+                if (
+                    deadband
+                    and state is not None
+                    and last_state is not None
+                    and abs(state - last_state) <= deadband
+                ):
+                    return False
+        self._written[key] = (state, now)
+        return True
+
+    def forget(self, key):
+        """Drop the last written state of a key, its next state is written."""
+        self._written.pop(key, None)
+
+
+class PublishScheduler:
+    """Publish interval per device, adapted to how fast its state changes.
+
+    After a device is published it is due again after resolution divided
+    by the rate of change of its state (a smoothed change per second),
+    bounded by min_interval and max_interval. A device is published
+    every min_interval until its rate is known, and again after a switch
+    change. Scheduled devices wait in a heap, so a tick only pops the
+    due ones; waiting holds the MACs of the devices not yet due.
+    """
+
+    def __init__(
+        self,
+        min_interval,
+        max_interval,
+        resolution=0.1,
+        smoothing=0.5,
+        clock=monotonic,
+    ):
+        """Initialize the scheduler, the intervals in seconds."""
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.resolution = resolution
+        self.smoothing = smoothing
+        self.waiting = set()
+        self._clock = clock
+        # (due time, mac), with stale entries of rescheduled devices
+        self._heap = []
+        self._due = {}
+        # last published (state, time, rate) per MAC
+        self._published = {}
+
+    def advance(self):
+        """Take the devices due by now out of waiting, return their MACs.
+
+        Devices due within half a min_interval are taken too, so timer
+        jitter does not delay them by a tick.
+        """
+        limit = self._clock() + self.min_interval / 2
+        heap = self._heap
+        due = []
+        while heap and heap[0][0] <= limit:
+            time, mac = heappop(heap)
+            if self._due.get(mac) == time:
+                del self._due[mac]
+                self.waiting.discard(mac)
+                due.append(mac)
+        return due
+
+    def schedule(self, mac, state=None, switched=False):
+        """Schedule the next publish of a device published now.
+
+        state is the published value its rate of change is measured on,
+        switched True if a switch of the device changed. Returns the
+        interval.
+        """
+        now = self._clock()
+        last = self._published.get(mac)
+        rate = None
+        if last is not None:
+            last_state, last_time, rate = last
+            if state is None:
+                state = last_state
+            elif last_state is not None and now > last_time:
+                observed = abs(state - last_state) / (now - last_time)
+                if rate is None:
+                    rate = observed
+                else:
+                    rate += self.smoothing * (observed - rate)
+        self._published[mac] = (state, now, rate)
+        if switched or rate is None:
+            interval = self.min_interval
+        elif rate:
+            interval = min(
+                max(self.resolution / rate, self.min_interval), self.max_interval
+            )
+        else:
+            interval = self.max_interval
+        due = now + interval
+        self._due[mac] = due
+        self.waiting.add(mac)
+        heappush(self._heap, (due, mac))
+        return interval
+
+    def forget(self, mac):
+        """Drop a device, it is due right away."""
+        self._due.pop(mac, None)
+        self._published.pop(mac, None)
+        self.waiting.discard(mac)
@@ -0,0 +1,512 @@
+"""HCI scanning for the puck.js integration."""
+import asyncio
+import logging
+from functools import partial
+from threading import Condition, Thread, Lock
+from time import perf_counter
+
+from .dedup import FrameDeduplicator
+from .const import (
+    CONF_ACTIVE_SCAN,
+    CONF_HCI_INTERFACE,
+    DEFAULT_BUFFER_SIZE,
+    BUFFER_POLICIES,
+    BUFFER_POLICY_DROP_OLDEST,
+    BUFFER_POLICY_LATEST_PER_MAC,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# Position of the peer address in a raw LE Advertising Report frame:
+# packet type, event code, length, subevent, num reports, event type, addr type
+MAC_START = 7
+MAC_END = MAC_START + 6
+
+
+class FrameBuffer:
+    """Fixed capacity ring buffer for raw HCI frames.
+
+    When the buffer is full the overflow policy decides what is lost:
+    drop_oldest overwrites the oldest frame, drop_newest discards the
+    incoming frame and latest_per_mac replaces the last buffered frame of
+    the same device (or discards the incoming frame for unseen devices).
+    """
+
+    def __init__(
+        self,
+        capacity=DEFAULT_BUFFER_SIZE,
+        policy=BUFFER_POLICY_DROP_OLDEST,
+        threadsafe=True,
+    ):
+        """Initiate the buffer with preallocated slots.
+
+        A buffer that is only used from a single thread (an event loop)
+        can be created with threadsafe=False to skip the locking, it can
+        not be waited on.
+        """
+        if policy not in BUFFER_POLICIES:
+            raise ValueError("Unknown buffer overflow policy: {}".format(policy))
+        self.capacity = capacity
+        self.policy = policy
+        self._slots = [None] * capacity
+        self._head = 0
+        self._count = 0
+        self._mac_slot = {}
+        self._lock = Lock()
+        self._ready = Condition(self._lock)
+        # frame count a consumer blocked in wait() is waiting for
+        self._wake_at = None
+        self.received = 0
+        self.dropped = 0
+        self.high_water = 0
+        if not threadsafe:
+            self.append = self._append
+            self.drain = self._drain
+
+    def __len__(self):
+        """Return the number of buffered frames."""
+        return self._count
+
+    def append(self, frame):
+        """Store a frame, applying the overflow policy when full."""
+        with self._lock:
+            self._append(frame)
+            if self._wake_at is not None and self._count >= self._wake_at:
+                self._wake_at = None
+                self._ready.notify()
+
+    def wait(self, count=1, timeout=None):
+        """Block until count frames are buffered, return the buffered count.
+
+        Also returns after timeout seconds or when wake() is called. Only
+        one thread may wait at a time.
+        """
+        with self._lock:
+            if self._count < count:
+                self._wake_at = min(count, self.capacity)
+                self._ready.wait(timeout)
+                self._wake_at = None
+            return self._count
+
+    def wake(self):
+        """Return from wait() without waiting for frames."""
+        with self._lock:
+            self._wake_at = None
+            self._ready.notify_all()
+
+    def drain(self):
+        """Atomically take all buffered frames, oldest first."""
+        with self._lock:
+            return self._drain()
+
+    def _append(self, frame):
+        self.received += 1
+        if self._count < self.capacity:
+            slot = (self._head + self._count) % self.capacity
+            self._slots[slot] = frame
+            self._count += 1
+            if self._count > self.high_water:
+                self.high_water = self._count
+            if self.policy == BUFFER_POLICY_LATEST_PER_MAC:
+                self._mac_slot[frame[MAC_START:MAC_END]] = slot
+            return
+        self.dropped += 1
+        if self.policy == BUFFER_POLICY_DROP_OLDEST:
+            self._slots[self._head] = frame
+            self._head = (self._head + 1) % self.capacity
+        elif self.policy == BUFFER_POLICY_LATEST_PER_MAC:
+            slot = self._mac_slot.get(frame[MAC_START:MAC_END])
+            if slot is not None:
+                self._slots[slot] = frame
+
+    def _drain(self):
+        end = self._head + self._count
+        if end <= self.capacity:
+            frames = self._slots[self._head:end]
+        else:
+            frames = self._slots[self._head:] + self._slots[: end - self.capacity]
+        self._head = 0
+        self._count = 0
+        self._mac_slot.clear()
+        return frames
+
+    def stats(self):
+        """Return the buffer counters."""
+        return {
+            "capacity": self.capacity,
+            "policy": self.policy,
+            "occupancy": self._count,
+            "high_water": self.high_water,
+            "received": self.received,
+            "dropped": self.dropped,
+        }
+
+
+class HCIdump(Thread):
+    """Mimic deprecated hcidump tool."""
+
+    def __init__(self, collect, interface=0, active=0, socket_filter=None):
+        """Initiate HCIdump thread."""
+        Thread.__init__(self)
+        _LOGGER.debug("HCIdump thread: Init")
+        self._interface = interface
+        self._active = active
+        self._socket_filter = socket_filter
+        self.process_hci_events = collect
+        # set when the thread did not stop in time, its frames are dropped
+        self.abandoned = False
+        self._event_loop = None
+        _LOGGER.debug("HCIdump thread: Init finished")
+
+    def _process(self, data):
+        if not self.abandoned:
+            self.process_hci_events(data)
+
+    def run(self):
+        """Run HCIdump thread."""
+        _LOGGER.debug("HCIdump thread: Run")
+        import aioblescan as aiobs
+
+        try:
+            mysocket = aiobs.create_bt_socket(self._interface)
+        except OSError as error:
+            _LOGGER.error("HCIdump thread: OS error: %s", error)
+        except AttributeError:
+            _LOGGER.error("HCIdump thread: Python is built without Bluetooth support")
+        else:
+            if self._socket_filter:
+                from .bpf import attach_filter
+
+                try:
+                    attach_filter(mysocket, self._socket_filter)
+                except OSError as error:
+                    _LOGGER.warning(
+                        "HCIdump thread: socket filter not attached: %s", error
+                    )
+            self._event_loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._event_loop)
+            fac = self._event_loop._create_connection_transport(
+                mysocket, aiobs.BLEScanRequester, None, None
+            )
+            _LOGGER.debug("HCIdump thread: Connection")
+            conn, btctrl = self._event_loop.run_until_complete(fac)
+            _LOGGER.debug("HCIdump thread: Connected")
+            btctrl.process = self._process
+            btctrl.send_command(
+                aiobs.HCI_Cmd_LE_Set_Scan_Params(scan_type=self._active)
+            )
+            btctrl.send_scan_request()
+            _LOGGER.debug("HCIdump thread: start main event_loop")
+            try:
+                self._event_loop.run_forever()
+            finally:
+                _LOGGER.debug(
+                    "HCIdump thread: main event_loop stopped, finishing",
+                )
+                btctrl.stop_scan_request()
+                conn.close()
+                self._event_loop.run_until_complete(asyncio.sleep(0))
+                self._event_loop.close()
+                _LOGGER.debug("HCIdump thread: Run finished")
+
+    def join(self, timeout=10):
+        """Join HCIdump thread."""
+        _LOGGER.debug("HCIdump thread: joining")
+        try:
+            self._event_loop.call_soon_threadsafe(self._event_loop.stop)
+        except AttributeError as error:
+            _LOGGER.debug("%s", error)
+        finally:
+            Thread.join(self, timeout)
+            _LOGGER.debug("HCIdump thread: joined")
+
+
+class BLEScanner:
+    """BLE scanner."""
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, buffer_policy=BUFFER_POLICY_DROP_OLDEST):
+        """Initiate BLE scanner."""
+        self.dumpthreads = []
+        self.hcidump_data = FrameBuffer(buffer_size, buffer_policy)
+        # optional callable getting every raw HCI event as it arrives
+        self.on_frame = None
+        # optional callable returning False for HCI events not worth keeping
+        self.frame_filter = None
+        # optional CaptureWriter recording every raw HCI event
+        self.recorder = None
+        # optional PipelineMetrics counting the frames and HCIdump restarts
+        self.metrics = None
+        # optional BPF program attached to the HCI sockets, see bpf.py
+        self.socket_filter = None
+        # optional FrameDeduplicator, see deduplicate()
+        self.deduplicator = None
+        # optional HCIWatchdog, see check_watchdog()
+        self.watchdog = None
+        # HCIdump or a stand-in with its interface
+        self.dump_factory = HCIdump
+        # HCIdump thread per scanning interface
+        self._interface_threads = {}
+        self._active = 0
+        self._threads_lock = Lock()
+
+    def collect(self, data):
+        """Store a raw HCI event, called from the HCIdump thread(s)."""
+        if self.on_frame is not None:
+            self.on_frame(data)
+        if self.frame_filter is None or self.frame_filter(data):
+            self.hcidump_data.append(data)
+
+    def _collect_from(self, interface, data):
+        if self.watchdog is not None:
+            self.watchdog.feed(interface)
+        if self.metrics is not None:
+            self.metrics.receive(interface)
+        if self.recorder is not None:
+            self.recorder.append(data, interface)
+        if self.deduplicator is None:
+            self.collect(data)
+            return
+        if self.on_frame is not None:
+            self.on_frame(data)
+        if self.frame_filter is None or self.frame_filter(data):
+            self.deduplicator.add(data, interface)
+
+    def deduplicate(self, window, max_entries=1024):
+        """Keep one copy of the advertisements heard by several interfaces.
+
+        Must be called before start(), see dedup.FrameDeduplicator.
+        """
+        self.deduplicator = FrameDeduplicator(
+            self.hcidump_data.append, window, max_entries
+        )
+
+    def collector(self, interface):
+        """Return the callable taking the raw HCI events of an interface."""
+        if (
+            self.recorder is None
+            and self.metrics is None
+            and self.deduplicator is None
+            and self.watchdog is None
+        ):
+            return self.collect
+        return partial(self._collect_from, interface)
+
+    def replay(self, path, speed=1):
+        """Feed a capture file in place of the HCIdump threads.
+
+        The frames are collected as received by their recorded interface,
+        speed as for capture.replay_capture, stop() ends the replay.
+        """
+        from .capture import CaptureReplay
+
+        self.drain()
+        replay = CaptureReplay(path, self._replay_collect, speed, interfaces=True)
+        self.dumpthreads.append(replay)
+        replay.start()
+
+    def _replay_collect(self, data, interface):
+        self.collector(interface)(data)
+
+    def drain(self):
+        """Atomically take all collected HCI events, leaving an empty buffer."""
+        if self.deduplicator is not None:
+            self.deduplicator.flush()
+        return self.hcidump_data.drain()
+
+    def is_running(self):
+        """Return True if all HCIdump threads are alive."""
+        return bool(self.dumpthreads) and all(
+            dumpthread.is_alive() for dumpthread in self.dumpthreads
+        )
+
+    def start(self, config):
+        """Start receiving broadcasts."""
+        self._active = int(config[CONF_ACTIVE_SCAN] is True)
+        self.drain()
+        _LOGGER.debug("Spawning HCIdump thread(s).")
+        with self._threads_lock:
+            for hci_int in config[CONF_HCI_INTERFACE]:
+                self._start_interface(hci_int)
+        _LOGGER.debug("HCIdump threads count = %s", len(self.dumpthreads))
+
+    def _start_interface(self, hci_int):
+        dumpthread = self.dump_factory(
+            collect=self.collector(hci_int),
+            interface=hci_int,
+            active=self._active,
+            socket_filter=self.socket_filter,
+        )
+        self.dumpthreads.append(dumpthread)
+        self._interface_threads[hci_int] = dumpthread
+        _LOGGER.debug("Starting HCIdump thread for hci%s", hci_int)
+        dumpthread.start()
+        if self.metrics is not None:
+            self.metrics.hcidump_starts += 1
+
+    def stop(self, timeout=10):
+        """Stop HCIdump thread(s).
+
+        Threads that do not finish within timeout seconds are abandoned,
+        returns False if there were any.
+        """
+        result = True
+        start = perf_counter()
+        with self._threads_lock:
+            for dumpthread in self.dumpthreads:
+                if dumpthread.is_alive():
+                    dumpthread.join(timeout)
+                    if dumpthread.is_alive():
+                        result = False
+                        dumpthread.abandoned = True
+                        _LOGGER.error(
+                            "Waiting for the HCIdump thread to finish took too long!"
+                            " (>%ss), abandoned",
+                            timeout,
+                        )
+            if self.metrics is not None and self.dumpthreads:
+                self.metrics.hcidump_join_time.observe(perf_counter() - start)
+            self.dumpthreads.clear()
+            self._interface_threads.clear()
+        return result
+
+    def check_watchdog(self):
+        """Restart the interfaces the watchdog finds stalled, return them.
+
+        Only the HCIdump threads of those interfaces are restarted, a
+        thread that does not stop within a second is abandoned. The
+        restarts of start() between update cycles do not reset the stall
+        timer, so without continuous_scan a dead adapter is noticed too.
+        """
+        with self._threads_lock:
+            due = self.watchdog.check(
+                {
+                    hci_int: dumpthread.is_alive()
+                    for hci_int, dumpthread in self._interface_threads.items()
+                }
+            )
+            for hci_int in due:
+                _LOGGER.warning("hci%s stalled, restarting its HCIdump thread", hci_int)
+                dumpthread = self._interface_threads.pop(hci_int)
+                self.dumpthreads.remove(dumpthread)
+                if dumpthread.is_alive():
+                    dumpthread.join(1)
+                    if dumpthread.is_alive():
+                        dumpthread.abandoned = True
+                        _LOGGER.error("HCIdump thread of hci%s abandoned", hci_int)
+                if self.metrics is not None:
+                    self.metrics.hcidump_restarts += 1
+                self._start_interface(hci_int)
+                self.watchdog.started(hci_int)
+        return due
+
+    def shutdown_handler(self, event):
+        """Run homeassistant_stop event handler."""
+        _LOGGER.debug("Running homeassistant_stop event handler: %s", event)
+        self.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+class AsyncBLEScanner(BLEScanner):
+    """BLE scanner attached to an already running asyncio event loop.
+
+    The HCI sockets are served by the given loop, so no HCIdump threads are
+    spawned and frames are collected without locking. start() and stop()
+    may be called from other threads, async_start() and async_stop() must
+    run on the loop.
+    """
+
+    def __init__(
+        self,
+        loop,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        buffer_policy=BUFFER_POLICY_DROP_OLDEST,
+    ):
+        """Initiate BLE scanner."""
+        super().__init__(buffer_size, buffer_policy)
+        self.hcidump_data = FrameBuffer(buffer_size, buffer_policy, threadsafe=False)
+        self._loop = loop
+        # (transport, BLEScanRequester) per interface
+        self._connections = {}
+        self._scan_interfaces = []
+
+    def is_running(self):
+        """Return True if scanning on at least one interface."""
+        return bool(self._connections)
+
+    async def async_start(self, config):
+        """Start receiving broadcasts on the event loop."""
+        self._active = int(config[CONF_ACTIVE_SCAN] is True)
+        self.drain()
+        self._scan_interfaces = list(config[CONF_HCI_INTERFACE])
+        for hci_int in self._scan_interfaces:
+            if not await self._async_start_interface(hci_int):
+                return
+
+    async def _async_start_interface(self, hci_int):
+        """Scan on an interface, return False without Bluetooth support."""
+        import aioblescan as aiobs
+
+        try:
+            mysocket = aiobs.create_bt_socket(hci_int)
+        except OSError as error:
+            _LOGGER.error("hci%s: OS error: %s", hci_int, error)
+            return True
+        except AttributeError:
+            _LOGGER.error("Python is built without Bluetooth support")
+            return False
+        if self.socket_filter:
+            from .bpf import attach_filter
+
+            try:
+                attach_filter(mysocket, self.socket_filter)
+            except OSError as error:
+                _LOGGER.warning("hci%s: socket filter not attached: %s", hci_int, error)
+        conn, btctrl = await self._loop._create_connection_transport(
+            mysocket, aiobs.BLEScanRequester, None, None
+        )
+        btctrl.process = self.collector(hci_int)
+        btctrl.send_command(aiobs.HCI_Cmd_LE_Set_Scan_Params(scan_type=self._active))
+        btctrl.send_scan_request()
+        self._connections[hci_int] = (conn, btctrl)
+        if self.metrics is not None:
+            self.metrics.hcidump_starts += 1
+        _LOGGER.debug("Scanning on hci%s", hci_int)
+        return True
+
+    async def async_check_watchdog(self):
+        """Reopen the interfaces the watchdog finds stalled, return them."""
+        alive = {}
+        for hci_int in self._scan_interfaces:
+            connection = self._connections.get(hci_int)
+            alive[hci_int] = connection is not None and not connection[0].is_closing()
+        due = self.watchdog.check(alive)
+        for hci_int in due:
+            _LOGGER.warning("hci%s stalled, reopening it", hci_int)
+            connection = self._connections.pop(hci_int, None)
+            if connection is not None:
+                conn, btctrl = connection
+                btctrl.stop_scan_request()
+                conn.close()
+            if self.metrics is not None:
+                self.metrics.hcidump_restarts += 1
+            self.watchdog.started(hci_int)
+            await self._async_start_interface(hci_int)
+        return due
+
+    async def async_stop(self):
+        """Stop receiving broadcasts on the event loop."""
+        for conn, btctrl in self._connections.values():
+            btctrl.stop_scan_request()
+            conn.close()
+        self._connections.clear()
+        self._scan_interfaces = []
+        return True
+
+    def start(self, config):
+        """Start receiving broadcasts from outside the event loop."""
+        asyncio.run_coroutine_threadsafe(self.async_start(config), self._loop).result()
+
+    def stop(self):
+        """Stop receiving broadcasts from outside the event loop."""
+        return asyncio.run_coroutine_threadsafe(self.async_stop(), self._loop).result()
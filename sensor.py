@@ -1,15 +1,13 @@
 """Passive BLE monitor sensor platform."""
-import asyncio
-from datetime import timedelta
+from datetime import datetime, timedelta
+import json
 import logging
-import statistics as sts
-import struct
-import subprocess
 import os
-from threading import Thread, Lock
-from time import sleep
-
-import aioblescan as aiobs
+from functools import partial
+from threading import Lock
+from time import perf_counter
+from types import MappingProxyType
+from typing import NamedTuple
 
 from homeassistant.const import (
     DEVICE_CLASS_BATTERY,
@@ -34,7 +32,31 @@ from . import (
     CONF_HCI_INTERFACE,
     CONF_BATT_ENTITIES,
     CONF_REPORT_UNKNOWN,
-    CONF_ESPRUINO_PATH
+    CONF_ESPRUINO_PATH,
+    CONF_CONTINUOUS_SCAN,
+    CONF_BUFFER_SIZE,
+    CONF_BUFFER_POLICY,
+    CONF_INSTANT_SWITCHES,
+    CONF_NATIVE_SCAN,
+    CONF_EWMA_ALPHA,
+    CONF_CAPTURE_FILE,
+    CONF_METRICS,
+    CONF_CHANGE_ONLY,
+    CONF_DEADBAND,
+    CONF_HEARTBEAT,
+    CONF_BPF_FILTER,
+    CONF_PROGRAM_CONCURRENCY,
+    CONF_PROGRAM_TIMEOUT,
+    CONF_DEDUP_WINDOW,
+    CONF_DECODE_CACHE,
+    CONF_BATCH_ENGINE,
+    CONF_ADAPTIVE_PERIOD,
+    CONF_MIN_PERIOD,
+    CONF_MAX_PERIOD,
+    CONF_WATCHDOG,
+    CONF_STALL_TIMEOUT,
+    CONF_DECODE_WORKERS,
+    CONF_HISTORY,
 )
 
 from .const import (
@@ -43,256 +65,239 @@ from .const import (
     CONF_HMIN,
     CONF_HMAX
 )
+from .metrics import PipelineMetrics
+from .publish import ChangeFilter, PublishScheduler
+from .parser import (
+    FlagChangeDetector,
+    compile_whitelist,
+    prefilter_raw_message,
+    raw_address,
+)
+from .history import TIERS, HistoryStore
+from .processing import FrameConsumer, FrameProcessor
+from .programmer import FirmwareStore, FirmwareWatch, ProgrammingScheduler
+from .scanner import AsyncBLEScanner, BLEScanner
+from .watchdog import HCIWatchdog
 
 
 from homeassistant.components.binary_sensor import BinarySensorEntity
 from homeassistant.helpers.entity import Entity
-from homeassistant.helpers.event import track_point_in_utc_time
+from homeassistant.core import callback
+from homeassistant.helpers.event import (
+    async_track_time_interval,
+    track_time_interval,
+    track_point_in_utc_time,
+)
 import homeassistant.util.dt as dt_util
 
 _LOGGER = logging.getLogger(__name__)
 
 PUCKJS_SOURCE_CODE = os.path.join(os.path.dirname(__file__), "ha-puck.js")
+# hashes of the firmware programmed per MAC, in the configuration directory
+FIRMWARE_STORE = ".puckjs_firmware.json"
+HISTORY_DIR = "puckjs_history"
+# seconds of history query_history returns without a start
+HISTORY_QUERY_SPAN = 86400
 
 _LOGGER = logging.getLogger(__name__)
 
-class HCIdump(Thread):
-    """Mimic deprecated hcidump tool."""
-
-    def __init__(self, dumplist, interface=0, active=0):
-        """Initiate HCIdump thread."""
-        Thread.__init__(self)
-        _LOGGER.debug("HCIdump thread: Init")
-        self._interface = interface
-        self._active = active
-        self.dumplist = dumplist
-        self._event_loop = None
-        _LOGGER.debug("HCIdump thread: Init finished")
-
-    def process_hci_events(self, data):
-        """Collect HCI events."""
-        self.dumplist.append(data)
-
-    def run(self):
-        """Run HCIdump thread."""
-        _LOGGER.debug("HCIdump thread: Run")
-        try:
-            mysocket = aiobs.create_bt_socket(self._interface)
-        except OSError as error:
-            _LOGGER.error("HCIdump thread: OS error: %s", error)
-        else:
-            self._event_loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self._event_loop)
-            fac = self._event_loop._create_connection_transport(
-                mysocket, aiobs.BLEScanRequester, None, None
-            )
-            _LOGGER.debug("HCIdump thread: Connection")
-            conn, btctrl = self._event_loop.run_until_complete(fac)
-            _LOGGER.debug("HCIdump thread: Connected")
-            btctrl.process = self.process_hci_events
-            btctrl.send_command(
-                aiobs.HCI_Cmd_LE_Set_Scan_Params(scan_type=self._active)
-            )
-            btctrl.send_scan_request()
-            _LOGGER.debug("HCIdump thread: start main event_loop")
-            try:
-                self._event_loop.run_forever()
-            finally:
-                _LOGGER.debug(
-                    "HCIdump thread: main event_loop stopped, finishing",
-                )
-                btctrl.stop_scan_request()
-                conn.close()
-                self._event_loop.run_until_complete(asyncio.sleep(0))
-                self._event_loop.close()
-                _LOGGER.debug("HCIdump thread: Run finished")
-
-    def join(self, timeout=10):
-        """Join HCIdump thread."""
-        _LOGGER.debug("HCIdump thread: joining")
-        try:
-            self._event_loop.call_soon_threadsafe(self._event_loop.stop)
-        except AttributeError as error:
-            _LOGGER.debug("%s", error)
-        finally:
-            Thread.join(self, timeout)
-            _LOGGER.debug("HCIdump thread: joined")
-
-
-
-def parse_raw_message(data, whitelist, report_unknown=False):
-    """Parse the raw data."""
-    if data is None:
-        return None
-
-    ev=aiobs.HCI_Event()
-    decoded_msg=ev.decode(data)
-    mac= ev.retrieve("peer")
-    mac= mac[0].val if len(mac) > 0 else None
-
-    if not mac or (whitelist and mac not in whitelist):
-        return
-    
-    rssi = ev.retrieve("rssi")
-    rssi = rssi[0].val if len(rssi) > 0 else None
-    
-    manufacturer_data = ev.retrieve("Manufacturer Specific Data")
-    if len(manufacturer_data) == 0:
-        # This message is not a manufacture data
-        return { "rssi": rssi, "mac": mac, "type": "puck.js" }
-
-    manufacturer_id = manufacturer_data[0].retrieve("Manufacturer ID")
-    manufacturer_id = manufacturer_id[0].val
-
-    if manufacturer_id != 1424:
-        # This is not the puck
-        return
-
-    payload = manufacturer_data[0].retrieve("Payload")
-    if len(payload) == 0:
-        return
-    
-    payload = payload[0].val
-
-    battery     = float(payload[0:3])
-    temperature = float(payload[3:8])
-    direction   = bool(int(payload[8]) & 2)
-    button      = bool(int(payload[8]) & 1)
-
-    result = {
-        "rssi": rssi,
-        "mac": mac,
-        "temperature" : temperature,
-        "battery" : battery,
-        "direction" : direction,
-        "button" : button,
-        "type": "puck.js" }
-    
-    return result
+class DeviceConfig(NamedTuple):
+    """Per device options with precomputed temperature limits."""
+
+    name: str
+    unit: str
+    tmin: float
+    tmax: float
+
+
+DEFAULT_DEVICE_CONFIG = DeviceConfig(None, TEMP_CELSIUS, CONF_TMIN, CONF_TMAX)
+
+# seconds between the checks of the HCI watchdog
+WATCHDOG_INTERVAL = timedelta(seconds=5)
+
+# (devices list the index was built from, index)
+_DEVICE_INDEX = (None, MappingProxyType({}))
+
+
+def canonical_mac(mac):
+    """Return the MAC address notation used as device index key."""
+    return mac.lower()
+
+
+def build_device_index(devices):
+    """Build an immutable index of the configured devices keyed by MAC."""
+    index = {}
+    for device in devices:
+        if "mac" not in device:
+            continue
+        mac = canonical_mac(device["mac"])
+        if mac in index:
+            continue
+        unit = device.get("temperature_unit", TEMP_CELSIUS)
+        index[mac] = DeviceConfig(
+            device.get("name"),
+            unit,
+            temperature_limit(unit, CONF_TMIN),
+            temperature_limit(unit, CONF_TMAX),
+        )
+    return MappingProxyType(index)
+
+
+def device_index(config):
+    """Return the device index, rebuilt when the configured devices change."""
+    global _DEVICE_INDEX
+    devices, index = _DEVICE_INDEX
+    if devices is not config[CONF_DEVICES]:
+        devices = config[CONF_DEVICES]
+        index = build_device_index(devices)
+        # swap in one assignment, readers see either the old or the new index
+        _DEVICE_INDEX = (devices, index)
+    return index
+
+
+def device_config(config, mac):
+    """Return the DeviceConfig of a device."""
+    return device_index(config).get(canonical_mac(mac), DEFAULT_DEVICE_CONFIG)
 
 
 def sensor_name(config, mac, sensor_type):
     """Set sensor name."""
-
-    if config[CONF_DEVICES]:
-        for device in config[CONF_DEVICES]:
-            if mac.upper() in device["mac"].upper():
-                if "name" in device:
-                    custom_name = device["name"]
-                    _LOGGER.debug(
-                        "Name of %s sensor with mac adress %s is set to: %s",
-                        sensor_type,
-                        mac,
-                        custom_name,
-                    )
-                    return custom_name
-                break
-    return mac
+    custom_name = device_config(config, mac).name
+    if custom_name is None:
+        return mac
+    _LOGGER.debug(
+        "Name of %s sensor with mac adress %s is set to: %s",
+        sensor_type,
+        mac,
+        custom_name,
+    )
+    return custom_name
 
 
 def temperature_unit(config, mac):
     """Set temperature unit to °C or °F."""
-
-    if config[CONF_DEVICES]:
-        for device in config[CONF_DEVICES]:
-            if mac in device["mac"].upper():
-                if "temperature_unit" in device:
-                    _LOGGER.debug(
-                        "Temperature sensor with mac address %s is set to receive data in %s",
-                        mac,
-                        device["temperature_unit"],
-                    )
-                    return device["temperature_unit"]
-                break
+    unit = device_config(config, mac).unit
     _LOGGER.debug(
-        "Temperature sensor with mac address %s is set to receive data in °C",
+        "Temperature sensor with mac address %s is set to receive data in %s",
         mac,
+        unit,
     )
-    return TEMP_CELSIUS
+    return unit
 
 
-def temperature_limit(config, mac, temp):
+def temperature_limit(unit, temp):
     """Set limits for temperature measurement in °C or °F."""
-    if config[CONF_DEVICES]:
-        for device in config[CONF_DEVICES]:
-            if mac in device["mac"].upper():
-                if "temperature_unit" in device:
-                    if device["temperature_unit"] == TEMP_FAHRENHEIT:
-                        temp_fahrenheit = temp * 9 / 5 + 32
-                        return temp_fahrenheit
-                break
+    if unit == TEMP_FAHRENHEIT:
+        temp_fahrenheit = temp * 9 / 5 + 32
+        return temp_fahrenheit
     return temp
 
 
-class BLEScanner:
-    """BLE scanner."""
-
-    dumpthreads = []
-    hcidump_data = []
-
-    def start(self, config):
-        """Start receiving broadcasts."""
-        active_scan = config[CONF_ACTIVE_SCAN]
-        hci_interfaces = config[CONF_HCI_INTERFACE]
-        self.hcidump_data.clear()
-        _LOGGER.debug("Spawning HCIdump thread(s).")
-        for hci_int in hci_interfaces:
-            dumpthread = HCIdump(
-                dumplist=self.hcidump_data,
-                interface=hci_int,
-                active=int(active_scan is True),
-            )
-            self.dumpthreads.append(dumpthread)
-            _LOGGER.debug("Starting HCIdump thread for hci%s", hci_int)
-            dumpthread.start()
-        _LOGGER.debug("HCIdump threads count = %s", len(self.dumpthreads))
-
-    def stop(self):
-        """Stop HCIdump thread(s)."""
-        result = True
-        for dumpthread in self.dumpthreads:
-            if dumpthread.is_alive():
-                dumpthread.join()
-                if dumpthread.is_alive():
-                    result = False
-                    _LOGGER.error(
-                        "Waiting for the HCIdump thread to finish took too long! (>10s)"
-                    )
-        if result is True:
-            self.dumpthreads.clear()
-        return result
-
-    def shutdown_handler(self, event):
-        """Run homeassistant_stop event handler."""
-        _LOGGER.debug("Running homeassistant_stop event handler: %s", event)
-        self.stop()
-
-def program_puckjs(espruino_path, mac):
-    _LOGGER.info('Programming Puck.js with mac: %s.', mac)
-    try:
-        output = subprocess.check_output([espruino_path, '-p', mac, PUCKJS_SOURCE_CODE],
-                                         stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as err:
-        _LOGGER.warning("Running '{}'".format(err.cmd) + "\ngave the following error:\n" + str(err.output.decode()))
-
-        
 def setup_platform(hass, conf, add_entities, discovery_info=None):
     """Set up the sensor platform."""
 
     _LOGGER.debug("Starting")
+    start = perf_counter()
     config = hass.data[DOMAIN]
-    firstrun = True
-    scanner = BLEScanner()
+    scanner = BLEScanner(config[CONF_BUFFER_SIZE], config[CONF_BUFFER_POLICY])
     hass.bus.listen("homeassistant_stop", scanner.shutdown_handler)
+    update_ble, services = _setup_scanning(hass, config, scanner, add_entities)
+    # the HCIdump threads open the adapters, a slow or missing adapter
+    # does not hold up the setup
     scanner.start(config)
-    sensors_by_mac = {}
-    lock = Lock()
 
-    if config[CONF_REPORT_UNKNOWN]:
-        _LOGGER.info(
-            "Attention! Option report_unknown is enabled, be ready for a huge output..."
+    def update_ble_periodically(now):
+        """Lookup Bluetooth LE devices and reschedule."""
+        update_ble(now)
+        track_point_in_utc_time(
+            hass,
+            update_ble_periodically,
+            dt_util.utcnow() + timedelta(seconds=update_period(config)),
+        )
+
+    # Register the services
+    for service, handler in services.items():
+        hass.services.register(DOMAIN, service, handler)
+
+    # the first update cycle runs when a period of frames is collected
+    track_point_in_utc_time(
+        hass,
+        update_ble_periodically,
+        dt_util.utcnow() + timedelta(seconds=update_period(config)),
+    )
+    report_setup_time(scanner, start)
+    # Return successful setup
+    return True
+
+
+async def async_setup_platform(hass, conf, async_add_entities, discovery_info=None):
+    """Set up the sensor platform, natively on the event loop if configured."""
+    config = hass.data[DOMAIN]
+    if not config[CONF_NATIVE_SCAN]:
+
+        def add_entities(entities):
+            """Add entities from the update thread."""
+            hass.add_job(async_add_entities, entities)
+
+        return await hass.async_add_executor_job(
+            setup_platform, hass, conf, add_entities, discovery_info
         )
 
+    _LOGGER.debug("Starting on the event loop")
+    start = perf_counter()
+    scanner = AsyncBLEScanner(
+        hass.loop, config[CONF_BUFFER_SIZE], config[CONF_BUFFER_POLICY]
+    )
+    hass.bus.async_listen("homeassistant_stop", scanner.shutdown_handler)
+    update_ble, services = _setup_scanning(hass, config, scanner, async_add_entities)
+    # open the adapters in the background, the first update cycle runs
+    # when a period of frames is collected
+    hass.async_create_task(scanner.async_start(config))
+    for service, handler in services.items():
+        hass.services.async_register(DOMAIN, service, handler)
+    async_track_time_interval(
+        hass, callback(update_ble), timedelta(seconds=update_period(config))
+    )
+    report_setup_time(scanner, start)
+    return True
+
+
+def report_setup_time(scanner, start):
+    """Log the time the platform setup took, and keep it in the metrics."""
+    setup_time = perf_counter() - start
+    _LOGGER.debug("Platform set up in %.3f s", setup_time)
+    if scanner.metrics is not None:
+        scanner.metrics.setup_time = setup_time
+
+
+def history_time(value, default):
+    """Return a query_history time as epoch seconds.
+
+    value is a datetime, a date and time string or epoch seconds,
+    default is returned for None.
+    """
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return value
+    if not isinstance(value, datetime):
+        parsed = dt_util.parse_datetime(str(value))
+        if parsed is None:
+            raise ValueError("invalid date and time {}".format(value))
+        value = parsed
+    return dt_util.as_utc(value).timestamp()
+
+
+def update_period(config):
+    """Return the seconds between update cycles."""
+    if config[CONF_ADAPTIVE_PERIOD]:
+        # every device is published on its own interval, checked each tick
+        return config[CONF_MIN_PERIOD]
+    return config[CONF_PERIOD]
+
+
+def build_whitelist(config):
+    """Return the MAC addresses to accept, empty if discovery is enabled."""
     whitelist = []
     if isinstance(config[CONF_DISCOVERY], bool):
         if config[CONF_DISCOVERY] is False:
@@ -300,33 +305,260 @@ def setup_platform(hass, conf, add_entities, discovery_info=None):
                 for device in config[CONF_DEVICES]:
                     whitelist.append(device["mac"])
     # remove duplicates from whitelist
-    whitelist = list(dict.fromkeys(whitelist))
+    return list(dict.fromkeys(whitelist))
+
+
+def _setup_scanning(hass, config, scanner, add_entities):
+    """Create the update and program service handlers around a scanner.
+
+    Returns (update_ble, services), services maps the service names to
+    their handlers: program, dump_metrics with the metrics option and
+    query_history with the history option. With
+    an AsyncBLEScanner update_ble has to be called on the event loop.
+    """
+    programming = False
+    dropped_frames = 0
+    native = isinstance(scanner, AsyncBLEScanner)
+    sensors_by_mac = {}
+    lock = Lock()
+    # indexes of the entities in sensors_by_mac
+    t_i, sw_i, d_i, b_i = range(4)
+
+    def listen_once(event_type, listener):
+        """Listen to an event once, from the event loop or a thread."""
+        if native:
+            hass.bus.async_listen_once(event_type, listener)
+        else:
+            hass.bus.listen_once(event_type, listener)
+
+    if config[CONF_REPORT_UNKNOWN]:
+        _LOGGER.info(
+            "Attention! Option report_unknown is enabled, be ready for a huge output..."
+        )
+
+    whitelist = build_whitelist(config)
     _LOGGER.debug("whitelist: [%s]", ", ".join(whitelist).upper())
     _LOGGER.debug("%s whitelist item(s) loaded.", len(whitelist))
-    sleep(1)
+    firmware_watch = None
+    if whitelist:
+        # the configured pucks heard without readings are programmed
+        firmware_watch = FirmwareWatch()
+    if len(config[CONF_HCI_INTERFACE]) > 1 and config[CONF_DEDUP_WINDOW]:
+        # the same advertisement is heard by every adapter
+        scanner.deduplicate(config[CONF_DEDUP_WINDOW] / 1000)
+    if config[CONF_BPF_FILTER]:
+        from .bpf import build_filter
+
+        scanner.socket_filter = build_filter(whitelist)
+    whitelist = compile_whitelist(whitelist)
+    if config.get(CONF_CAPTURE_FILE):
+        from .capture import CaptureWriter
+
+        _LOGGER.info("Recording HCI frames to %s", config[CONF_CAPTURE_FILE])
+        scanner.recorder = CaptureWriter(config[CONF_CAPTURE_FILE])
+    change_filter = None
+    if config[CONF_CHANGE_ONLY]:
+        change_filter = ChangeFilter(config[CONF_HEARTBEAT])
+    publish_scheduler = None
+    if config[CONF_ADAPTIVE_PERIOD]:
+        publish_scheduler = PublishScheduler(
+            config[CONF_MIN_PERIOD],
+            config[CONF_MAX_PERIOD],
+            10 ** -config[CONF_DECIMALS],
+        )
+    metrics = metrics_sensor = None
+    if config[CONF_METRICS]:
+        metrics = scanner.metrics = PipelineMetrics()
+        metrics_sensor = MetricsSensor()
+        add_entities([metrics_sensor])
+    history = None
+    if config[CONF_HISTORY]:
+        history = HistoryStore(hass.config.path(HISTORY_DIR))
+        # the pending minutes and hours are written on the way out, in
+        # the executor
+        listen_once("homeassistant_stop", lambda event: history.close())
+    if config[CONF_WATCHDOG]:
+        scanner.watchdog = HCIWatchdog(config[CONF_STALL_TIMEOUT])
+        health_sensor = HealthSensor()
+        add_entities([health_sensor])
+        if native:
+
+            async def async_check_watchdog(now):
+                """Reopen stalled interfaces and update the health sensor."""
+                await scanner.async_check_watchdog()
+                health_sensor.update_health(scanner.watchdog)
+
+            async_track_time_interval(hass, async_check_watchdog, WATCHDOG_INTERVAL)
+        else:
 
-    def handle_program_puckjs(call, explicit_macs=[]):
-        """Handle the service call."""
+            def check_watchdog(now):
+                """Restart stalled interfaces and update the health sensor."""
+                scanner.check_watchdog()
+                health_sensor.update_health(scanner.watchdog)
+
+            track_time_interval(hass, check_watchdog, WATCHDOG_INTERVAL)
+    if native:
+        # only keep the frames parse_raw_message can use, the update cycle
+        # runs on the event loop
+        scanner.frame_filter = partial(prefilter_raw_message, whitelist=whitelist)
+    processor_class = FrameProcessor
+    if config[CONF_BATCH_ENGINE]:
+        try:
+            from .batch import BatchProcessor
+        except ImportError as error:
+            _LOGGER.warning(
+                "Option %s needs numpy, using the default engine: %s",
+                CONF_BATCH_ENGINE,
+                error,
+            )
+        else:
+            processor_class = BatchProcessor
+    cache_size = config[CONF_DECODE_CACHE]
+    if cache_size and not config[CONF_BPF_FILTER]:
+        # checking every frame for a cached advertisement costs more than
+        # the hits save when most frames come from other devices
+        _LOGGER.warning(
+            "Option %s needs %s, not using the decode cache",
+            CONF_DECODE_CACHE,
+            CONF_BPF_FILTER,
+        )
+        cache_size = 0
+    processor_args = (
+        whitelist,
+        device_index(config),
+        DEFAULT_DEVICE_CONFIG,
+        config[CONF_EWMA_ALPHA],
+        config[CONF_LOG_SPIKES],
+        config[CONF_REPORT_UNKNOWN],
+        metrics,
+        cache_size,
+    )
+    workers = config[CONF_DECODE_WORKERS]
+    if workers:
+        from .sharding import ShardedProcessor
+
+        processor = ShardedProcessor(
+            *processor_args, workers=workers, engine=processor_class
+        )
+    else:
+        processor = processor_class(*processor_args)
+    consumer = None
+    if not native:
+        # process the frames as they arrive instead of all at the end of
+        # the update cycle
+        consumer = FrameConsumer(scanner.hcidump_data, processor)
+        consumer.start()
+
+    def stop_processing(event):
+        """Stop the frame consumer, then the decode workers."""
+        if consumer is not None:
+            consumer.stop(1)
+        if workers:
+            processor.stop()
+
+    if consumer is not None or workers:
+        listen_once("homeassistant_stop", stop_processing)
+
+    def handle_flag_change(data):
+        """Push a button or upside down change straight to the entities."""
+        change = flag_detector(data)
+        if change is None:
+            return
+        mac, direction, button = change
+        sensors = sensors_by_mac.get(mac)
+        if sensors is None:
+            # entities are created by the next update cycle
+            return
+        for index, state in ((sw_i, button), (d_i, direction)):
+            sensor = sensors[index]
+            if sensor._state != int(state):
+                setattr(sensor, "_state", int(state))
+                if change_filter is not None:
+                    change_filter.changed((mac, index), int(state))
+                try:
+                    sensor.schedule_update_ha_state()
+                except (AttributeError, AssertionError, RuntimeError) as err:
+                    _LOGGER.debug("Sensor %s (switch) not updated: %s", mac, err)
+
+    if config[CONF_INSTANT_SWITCHES]:
+        flag_detector = FlagChangeDetector(whitelist)
+        scanner.on_frame = handle_flag_change
+
+    programmer = ProgrammingScheduler(
+        config[CONF_ESPRUINO_PATH],
+        PUCKJS_SOURCE_CODE,
+        FirmwareStore(hass.config.path(FIRMWARE_STORE)),
+        config[CONF_PROGRAM_CONCURRENCY],
+        config[CONF_PROGRAM_TIMEOUT],
+    )
+
+    def stop_scanning():
+        """Stop the HCIdump threads between update cycles."""
         with lock:
-            jres = scanner.stop()
-            if jres is False:
+            return scanner.stop()
+
+    def start_scanning():
+        """Start the HCIdump threads between update cycles."""
+        with lock:
+            scanner.start(config)
+
+    async def handle_program_puckjs(call):
+        """Handle the service call."""
+        macs = call.data.get("mac") or list(sensors_by_mac)
+        if isinstance(macs, str):
+            macs = [macs]
+        await async_program_pucks(macs, call.data.get("force", False))
+
+    async def async_program_pucks(macs, force=False):
+        """Program the pucks with scanning paused."""
+        nonlocal programming
+        if programming:
+            _LOGGER.warning("Puck.js programming is already running")
+            return
+        programming = True
+        try:
+            # espruino needs the adapter, scanning pauses until all are done
+            if native:
+                await scanner.async_stop()
+            elif not await hass.async_add_executor_job(stop_scanning):
                 _LOGGER.error("HCIdump thread(s) is not completed, interrupting !")
                 return
-            if explicit_macs:
-                macs = explicit_macs
+            results = await programmer.async_program(
+                [canonical_mac(mac) for mac in macs], force
+            )
+            _LOGGER.info("Puck.js programming results: %s", results)
+        finally:
+            if native:
+                await scanner.async_start(config)
             else:
-                macs = sensors_by_mac.keys()
-                
-            for mac in macs:
-                program_puckjs(config.get(CONF_ESPRUINO_PATH), mac)              
-
-            scanner.start(config)  # minimum delay between HCIdumps
+                await hass.async_add_executor_job(start_scanning)
+            programming = False
+
+    def publish(pending, entity, mac, index, deadband=0):
+        """Queue the entity for writing if its state is worth publishing."""
+        if change_filter is None or change_filter.changed(
+            (mac, index), getattr(entity, "_state"), deadband
+        ):
+            pending.append(entity)
+
+    @callback
+    def write_states(entities):
+        """Write the states of an update cycle on the event loop."""
+        for entity in entities:
+            if entity.hass is None:
+                # not added yet, the state is written when it is
+                _LOGGER.debug("Sensor %s not yet ready for update", entity.name)
+                continue
+            try:
+                entity.async_write_ha_state()
+            except RuntimeError as err:
+                _LOGGER.error("Sensor %s update error: %s", entity.name, err)
 
     def calc_update_state(
         entity_to_update,
         sensor_mac,
         config,
-        measurements_list,
+        aggregate,
         stype=None,
         fdec=0,
     ):
@@ -339,14 +571,13 @@ def setup_platform(hass, conf, add_entities, discovery_info=None):
         if fdec > 0:
             rdecimals = fdec
 
-        measurements = measurements_list
         try:
             if config[CONF_ROUNDING]:
-                state_median = round(sts.median(measurements), rdecimals)
-                state_mean = round(sts.mean(measurements), rdecimals)
+                state_median = round(aggregate.median(), rdecimals)
+                state_mean = round(aggregate.mean(), rdecimals)
             else:
-                state_median = sts.median(measurements)
-                state_mean = sts.mean(measurements)
+                state_median = aggregate.median()
+                state_mean = aggregate.mean()
             if config[CONF_USE_MEDIAN]:
                 textattr = "last median of"
                 setattr(entity_to_update, "_state", state_median)
@@ -355,17 +586,19 @@ def setup_platform(hass, conf, add_entities, discovery_info=None):
                 setattr(entity_to_update, "_state", state_mean)
             getattr(entity_to_update, "_device_state_attributes")[
                 textattr
-            ] = len(measurements)
+            ] = aggregate.count
             getattr(entity_to_update, "_device_state_attributes")[
                 "median"
             ] = state_median
             getattr(entity_to_update, "_device_state_attributes")[
                 "mean"
             ] = state_mean
-            entity_to_update.schedule_update_ha_state()
-            success = True
-        except (AttributeError, AssertionError):
-            _LOGGER.debug("Sensor %s not yet ready for update", sensor_mac)
+            if aggregate.ewma is not None:
+                getattr(entity_to_update, "_device_state_attributes")["ewma"] = (
+                    round(aggregate.ewma, rdecimals)
+                    if config[CONF_ROUNDING]
+                    else aggregate.ewma
+                )
             success = True
         except ZeroDivisionError as err:
             error = err
@@ -377,90 +610,82 @@ def setup_platform(hass, conf, add_entities, discovery_info=None):
 
     def discover_ble_devices(config, whitelist):
         """Discover Bluetooth LE devices."""
-        nonlocal firstrun
-        if firstrun:
-            firstrun = False
-            _LOGGER.debug("First run, skip parsing.")
+        nonlocal dropped_frames
+        if programming:
+            _LOGGER.debug("Programming pucks, skip parsing.")
             return []
         _LOGGER.debug("Discovering Bluetooth LE devices")
-        log_spikes = config[CONF_LOG_SPIKES]
         _LOGGER.debug("Time to analyze...")
-        stype = {}
-        temp_m_data = {}
-        direction_m_data = {}
-        button_m_data = {}
-        batt = {}  # battery
-        rssi = {}
-        macs = {}  # all found macs
-        fw_not_found = {}
-        with lock:
-            _LOGGER.debug("Getting data from HCIdump thread")
-            jres = scanner.stop()
-            if jres is False:
-                _LOGGER.error("HCIdump thread(s) is not completed, interrupting data processing!")
-                return []
-            hcidump_raw = [*scanner.hcidump_data]
-            scanner.start(config)  # minimum delay between HCIdumps
-        report_unknown = config[CONF_REPORT_UNKNOWN]
-        for msg in hcidump_raw:
-            data = parse_raw_message(msg, whitelist, report_unknown)
-
-            if data and "mac" in data:
-                # ignore duplicated message
-                mac = data["mac"]
-                # store found readings per device
-                if "temperature" in data:
-                    if (
-                        temperature_limit(config, mac, CONF_TMAX)
-                        >= data["temperature"]
-                        >= temperature_limit(config, mac, CONF_TMIN)
-                    ):
-                        if mac not in temp_m_data:
-                            temp_m_data[mac] = []
-                        temp_m_data[mac].append(data["temperature"])
-                        macs[mac] = mac
-                    elif log_spikes:
-                        _LOGGER.error(
-                            "Temperature spike: %s (%s)",
-                            data["temperature"],
-                            mac,
-                        )
-                    fw_not_found[max] = None
+        if native:
+            # called on the event loop that also collects the frames
+            hcidump_raw = scanner.drain()
+        else:
+            with lock:
+                _LOGGER.debug("Getting data from HCIdump thread")
+                if config[CONF_CONTINUOUS_SCAN]:
+                    # HCIdump threads keep scanning, only swap out the collected data
+                    hcidump_raw = scanner.drain()
+                    if not scanner.is_running():
+                        _LOGGER.warning("HCIdump thread(s) not running, restarting")
+                        if metrics is not None:
+                            metrics.hcidump_restarts += 1
+                        scanner.stop()
+                        scanner.start(config)
                 else:
-                    # No temperature info so this indicates that we don't have a proper FW
-                    # in the puck
-                    if fw_not_found.get(mac, None):
-                        time_since_last_data_found = dt_util.utcnow() - fw_not_found[max]
-                        if time_since_last_data_found > timedelta(seconds=60):
-                            # If more than 60 seconds without a temperature reading
-                            # try to update the FW
-                            handle_program_puckjs(None,[mac])                             
-                            fw_not_found[max] = None
-                    else:
-                        fw_not_found[max] = dt_util.utcnow()
-                    
-                if "direction" in data:
-                    direction_m_data[mac] = int(data["direction"])
-                    macs[mac] = mac
-                if "button" in data:
-                    button_m_data[mac] = int(data["button"])
-                    macs[mac] = mac
-                if "battery" in data:
-                    batt[mac] = int(data["battery"])
-                    macs[mac] = mac
-                if mac not in rssi:
-                    rssi[mac] = []
-                if "rssi" in data and data["rssi"]:
-                    rssi[mac].append(int(data["rssi"]))
-                stype[mac] = data["type"]
-            else:
-                # "empty" loop high cpu usage workaround
-                sleep(0.0001)
+                    # wedged threads are abandoned, the frames collected are
+                    # processed all the same
+                    scanner.stop()
+                    hcidump_raw = scanner.drain()
+                    scanner.start(config)  # minimum delay between HCIdumps
+        buffer_stats = scanner.hcidump_data.stats()
+        _LOGGER.debug("HCIdump buffer: %s", buffer_stats)
+        if buffer_stats["dropped"] > dropped_frames:
+            _LOGGER.warning(
+                "HCIdump buffer full, %i frame(s) dropped (%s), consider increasing %s",
+                buffer_stats["dropped"] - dropped_frames,
+                buffer_stats["policy"],
+                CONF_BUFFER_SIZE,
+            )
+            dropped_frames = buffer_stats["dropped"]
+        if scanner.recorder is not None:
+            scanner.recorder.flush()
+        processor.devices = device_index(config)
+        hold = None
+        if publish_scheduler is not None:
+            # readings of the devices not due yet are kept for later, the
+            # processor still returns those with a button or direction change
+            publish_scheduler.advance()
+            hold = publish_scheduler.waiting
+        if consumer is None:
+            processor.add_frames(hcidump_raw)
+            macs = processor.collect(hold)
+            frames = len(hcidump_raw)
+        else:
+            macs, frames = consumer.collect(hcidump_raw, hold)
+        if firmware_watch is not None:
+            missing = firmware_watch.update(processor.silent, macs)
+            if missing:
+                # forced, the firmware store is wrong about a silent puck
+                _LOGGER.info("No readings from Puck.js %s, programming", missing)
+                if native:
+                    hass.async_create_task(async_program_pucks(missing, True))
+                else:
+                    hass.add_job(async_program_pucks, missing, True)
+        if metrics is not None:
+            metrics.buffer_occupancy.observe(frames)
+            metrics_sensor.frames = frames
+        best_interfaces = {}
+        if scanner.deduplicator is not None:
+            best_interfaces = scanner.deduplicator.take_best_interfaces()
+            if metrics is not None:
+                metrics.frames_duplicate = scanner.deduplicator.duplicates
+        pending = []
+        cycle_time = dt_util.utcnow().timestamp()
+        history_rows = []
         # for every seen device
-        for mac in macs:
+        for mac, readings in macs.items():
             # if necessary, create a list of entities
             # according to the sensor implementation
-            t_i, sw_i, d_i, b_i = range(4)
             if mac in sensors_by_mac:
                 sensors = sensors_by_mac[mac]
             else:
@@ -470,104 +695,166 @@ def setup_platform(hass, conf, add_entities, discovery_info=None):
                 sensors.insert(d_i, SwitchBinarySensor(config, mac, "direction"))
                 if config[CONF_BATT_ENTITIES]:
                     sensors.insert(b_i, BatterySensor(config, mac))
+                for sensor in sensors:
+                    getattr(sensor, "_device_state_attributes")["mac address"] = mac
+                    if change_filter is not None:
+                        setattr(sensor, "_force_update", False)
                 sensors_by_mac[mac] = sensors
                 add_entities(sensors)
+            switched = (
+                readings.button is not None
+                and readings.button != getattr(sensors[sw_i], "_state")
+            ) or (
+                readings.direction is not None
+                and readings.direction != getattr(sensors[d_i], "_state")
+            )
             # append joint attributes
-            sensortype = stype[mac]
+            sensortype = readings.type
+            rssi = readings.rssi()
+            best_interface = best_interfaces.get(raw_address(mac))
             for sensor in sensors:
-                getattr(sensor, "_device_state_attributes")["rssi"] = round(
-                    sts.mean(rssi[mac])
-                )
+                if rssi is not None:
+                    getattr(sensor, "_device_state_attributes")["rssi"] = rssi
+                if best_interface is not None:
+                    getattr(sensor, "_device_state_attributes")[
+                        "best adapter"
+                    ] = "hci{}".format(best_interface)
                 getattr(sensor, "_device_state_attributes")["sensor type"] = sensortype
-                getattr(sensor, "_device_state_attributes")["mac address"] = mac
-                if not isinstance(sensor, BatterySensor) and mac in batt:
+                if not isinstance(sensor, BatterySensor) and readings.battery is not None:
                     getattr(sensor, "_device_state_attributes")[
                         ATTR_BATTERY_LEVEL
-                    ] = batt[mac]
+                    ] = readings.battery
 
             # averaging and states updating
-            if mac in batt:
+            temperature = None
+            if readings.battery is not None:
                 if config[CONF_BATT_ENTITIES]:
-                    setattr(sensors[b_i], "_state", batt[mac])
-                    try:
-                        sensors[b_i].schedule_update_ha_state()
-                    except (AttributeError, AssertionError):
-                        _LOGGER.debug(
-                            "Sensor %s (%s, batt.) not yet ready for update",
-                            mac,
-                            sensortype,
-                        )
-                    except RuntimeError as err:
-                        _LOGGER.error(
-                            "Sensor %s (%s, batt.) update error:",
-                            mac,
-                            sensortype,
-                        )
-                        _LOGGER.error(err)
-            if mac in temp_m_data:
+                    setattr(sensors[b_i], "_state", readings.battery)
+                    publish(pending, sensors[b_i], mac, b_i)
+            if readings.temperature is not None:
                 success, error = calc_update_state(
-                    sensors[t_i], mac, config, temp_m_data[mac]
+                    sensors[t_i], mac, config, readings.temperature
                 )
-                if not success:
+                if success:
+                    temperature = getattr(sensors[t_i], "_state")
+                    publish(pending, sensors[t_i], mac, t_i, config[CONF_DEADBAND])
+                else:
                     _LOGGER.error(
                         "Sensor %s (%s, temp.) update error:", mac, sensortype
                     )
                     _LOGGER.error(error)
-            if mac in button_m_data:
-                setattr(sensors[sw_i], "_state", button_m_data[mac])
-                try:
-                    sensors[sw_i].schedule_update_ha_state()
-                except (AttributeError, AssertionError):
+            if readings.lost is not None:
+                for index in (sw_i, d_i):
+                    getattr(sensors[index], "_device_state_attributes")[
+                        "lost adverts"
+                    ] = readings.lost
+                if readings.lost:
                     _LOGGER.debug(
-                        "Sensor %s (%s, switch) not yet ready for update",
+                        "Sensor %s (%s) missed %i advertisement(s), switch changes may be lost",
                         mac,
                         sensortype,
+                        readings.lost,
                     )
-                except RuntimeError as err:
-                    _LOGGER.error(
-                        "Sensor %s (%s, switch) update error:", mac, sensortype
-                    )
-                    _LOGGER.error(err)
-            if mac in direction_m_data:
-                setattr(sensors[d_i], "_state", direction_m_data[mac])
-                try:
-                    sensors[d_i].schedule_update_ha_state()
-                except (AttributeError, AssertionError):
-                    _LOGGER.debug(
-                        "Sensor %s (%s, switch) not yet ready for update",
+            if readings.button is not None:
+                setattr(sensors[sw_i], "_state", readings.button)
+                publish(pending, sensors[sw_i], mac, sw_i)
+            if readings.direction is not None:
+                setattr(sensors[d_i], "_state", readings.direction)
+                publish(pending, sensors[d_i], mac, d_i)
+            if history is not None:
+                history_rows.append(
+                    (
                         mac,
-                        sensortype,
-                    )
-                except RuntimeError as err:
-                    _LOGGER.error(
-                        "Sensor %s (%s, switch) update error:", mac, sensortype
+                        cycle_time,
+                        temperature,
+                        readings.battery,
+                        rssi,
+                        readings.button,
+                        readings.direction,
                     )
-                    _LOGGER.error(err)
+                )
+            if publish_scheduler is not None:
+                publish_scheduler.schedule(
+                    mac, getattr(sensors[t_i], "_state"), switched
+                )
+        if history_rows:
+            if native:
+                # the files of new devices are created, off the event loop
+                hass.async_add_executor_job(append_history, history_rows)
+            else:
+                append_history(history_rows)
+        if pending:
+            if native:
+                write_states(pending)
+            else:
+                # one event loop callback for all states of the cycle
+                hass.add_job(write_states, pending)
         _LOGGER.debug(
-            "Finished. Parsed: %i hci events, %i puckjs devices.",
-            len(hcidump_raw),
+            "Finished. Parsed: %i hci events, %i puckjs devices, %i state(s) written.",
+            frames,
             len(macs),
+            len(pending),
         )
         return []
 
     def update_ble(now):
         """Lookup Bluetooth LE devices and update status."""
-        period = config[CONF_PERIOD]
         _LOGGER.debug("update_ble called")
+        start = perf_counter()
         try:
             discover_ble_devices(config, whitelist)
         except RuntimeError as error:
             _LOGGER.error("Error during Bluetooth LE scan: %s", error)
-        track_point_in_utc_time(
-            hass, update_ble, dt_util.utcnow() + timedelta(seconds=period)
+        if metrics is not None:
+            metrics.discover_time.observe(perf_counter() - start)
+            metrics_sensor.update_metrics(
+                metrics.snapshot(scanner.hcidump_data.stats(), processor.cache_stats())
+            )
+
+    def append_history(rows):
+        """Add the readings of an update cycle to the history."""
+        for row in rows:
+            history.append(*row)
+
+    def handle_dump_metrics(call):
+        """Handle the dump_metrics service call."""
+        snapshot = metrics.snapshot(
+            scanner.hcidump_data.stats(), processor.cache_stats()
         )
+        _LOGGER.info("Pipeline metrics: %s", json.dumps(snapshot))
+        hass.bus.fire("puckjs_metrics", snapshot)
 
-    # Register program service
-    hass.services.register(DOMAIN, "program", handle_program_puckjs)
+    def handle_query_history(call):
+        """Handle the query_history service call."""
+        tier = call.data.get("tier")
+        try:
+            if not call.data.get("mac"):
+                raise ValueError("mac missing")
+            mac = canonical_mac(call.data["mac"])
+            end = history_time(call.data.get("end"), dt_util.utcnow().timestamp())
+            start = history_time(call.data.get("start"), end - HISTORY_QUERY_SPAN)
+            if tier is not None and tier not in [item.name for item in TIERS]:
+                raise ValueError("unknown tier {}".format(tier))
+        except ValueError as error:
+            _LOGGER.error("Invalid history query: %s", error)
+            return
+        tier, records = history.query(mac, start, end, tier)
+        _LOGGER.debug("History of %s: %i %s record(s)", mac, len(records), tier)
+        hass.bus.fire(
+            "puckjs_history",
+            {
+                "mac": mac,
+                "tier": tier,
+                "records": [record._asdict() for record in records],
+            },
+        )
 
-    update_ble(dt_util.utcnow())
-    # Return successful setup
-    return True
+    services = {"program": handle_program_puckjs}
+    if metrics is not None:
+        services["dump_metrics"] = handle_dump_metrics
+    if history is not None:
+        services["query_history"] = handle_query_history
+    return update_ble, services
 
 
 class MeasuringSensor(Entity):
@@ -581,6 +868,7 @@ class MeasuringSensor(Entity):
         self._device_class = None
         self._device_state_attributes = {}
         self._unique_id = ""
+        self._force_update = True
 
     @property
     def name(self):
@@ -620,7 +908,7 @@ class MeasuringSensor(Entity):
     @property
     def force_update(self):
         """Force update."""
-        return True
+        return self._force_update
 
 
 class TemperatureSensor(MeasuringSensor):
@@ -649,6 +937,41 @@ class BatterySensor(MeasuringSensor):
         self._device_class = DEVICE_CLASS_BATTERY
 
 
+class MetricsSensor(MeasuringSensor):
+    """Diagnostic sensor with the scanner pipeline metrics.
+
+    The state is the number of frames processed by the last update
+    cycle, the attributes summarize the other metrics.
+    """
+
+    def __init__(self):
+        """Initialize the sensor."""
+        super().__init__(None, None)
+        self._name = "puckjs metrics"
+        self._unique_id = "puckjs_metrics"
+        self._unit_of_measurement = "frames"
+        self.frames = None
+
+    def update_metrics(self, snapshot):
+        """Publish a PipelineMetrics snapshot."""
+        attributes = {}
+        for key, value in snapshot.items():
+            if isinstance(value, dict) and "buckets" in value:
+                # histograms without their buckets
+                for field in ("count", "mean", "p50", "p99", "max"):
+                    attributes["{} {}".format(key, field)] = value[field]
+            else:
+                attributes[key] = value
+        self._state = self.frames
+        self._device_state_attributes = attributes
+        try:
+            self.schedule_update_ha_state()
+        except (AttributeError, AssertionError):
+            _LOGGER.debug("Metrics sensor not yet ready for update")
+        except RuntimeError as err:
+            _LOGGER.error("Metrics sensor update error: %s", err)
+
+
 class SwitchBinarySensor(BinarySensorEntity):
     """Representation of a Sensor."""
 
@@ -660,6 +983,7 @@ class SwitchBinarySensor(BinarySensorEntity):
         self._unique_id = switch_name + "_" + self._sensor_name
         self._device_state_attributes = {}
         self._device_class = None
+        self._force_update = True
 
     @property
     def is_on(self):
@@ -699,4 +1023,36 @@ class SwitchBinarySensor(BinarySensorEntity):
     @property
     def force_update(self):
         """Force update."""
-        return True
+        return self._force_update
+
+
+class HealthSensor(SwitchBinarySensor):
+    """Diagnostic binary sensor, on when an HCI interface is not healthy.
+
+    The attributes hold the state, the age of the last frame and the
+    restarts of every interface.
+    """
+
+    def __init__(self):
+        """Initialize the sensor."""
+        self._name = "puckjs hci health"
+        self._state = None
+        self._unique_id = "puckjs_hci_health"
+        self._device_state_attributes = {}
+        self._device_class = "problem"
+        self._force_update = False
+
+    def update_health(self, watchdog):
+        """Publish the health an HCIWatchdog reports."""
+        attributes = {}
+        for interface, health in watchdog.health().items():
+            for key, value in health.items():
+                attributes["hci{} {}".format(interface, key.replace("_", " "))] = value
+        self._state = not watchdog.healthy()
+        self._device_state_attributes = attributes
+        try:
+            self.schedule_update_ha_state()
+        except (AttributeError, AssertionError):
+            _LOGGER.debug("Health sensor not yet ready for update")
+        except RuntimeError as err:
+            _LOGGER.error("Health sensor update error: %s", err)
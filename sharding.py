@@ -0,0 +1,325 @@
+"""Decoding of the HCI frames in worker processes, sharded by MAC address.
+
+Every worker process owns the devices of one shard and folds their
+frames into its own processor, so the sequence counters and the EWMA of
+a device always live in the same process. The frames are handed over
+through a shared memory block per worker, the pipe only carries which
+part of it to decode. Only the DeviceReadings of the update cycle come
+back.
+"""
+import logging
+import multiprocessing
+import struct
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+from .metrics import PipelineMetrics
+from .parser import ADV_ADDR_START
+from .processing import FrameProcessor
+
+_LOGGER = logging.getLogger(__name__)
+
+# what the processors of the workers need of a device configuration
+DeviceLimits = namedtuple("DeviceLimits", ("tmin", "tmax"))
+
+# a block of frames in the shared memory: the frame count, the frame
+# lengths and the frames
+FRAME_COUNT = struct.Struct("<I")
+# largest HCI event: packet type, event code, parameter length, parameters
+MAX_FRAME_SIZE = 258
+# the shared memory block of a worker holds two slots, one is filled while
+# the worker decodes the other
+SLOTS = 2
+SLOT_SIZE = 1024 * 1024
+
+
+def device_limits(devices):
+    """Return the temperature limits of a MAC -> device config mapping."""
+    return {
+        mac: DeviceLimits(device.tmin, device.tmax) for mac, device in devices.items()
+    }
+
+
+def pack_frames(frames):
+    """Return frames as one block."""
+    count = len(frames)
+    return b"".join(
+        (
+            FRAME_COUNT.pack(count),
+            struct.pack("<{}H".format(count), *map(len, frames)),
+            *frames,
+        )
+    )
+
+
+def unpack_frames(block):
+    """Return the frames of a block pack_frames() built."""
+    (count,) = FRAME_COUNT.unpack_from(block)
+    lengths = struct.unpack_from("<{}H".format(count), block, FRAME_COUNT.size)
+    frames = []
+    pos = FRAME_COUNT.size + 2 * count
+    for length in lengths:
+        frames.append(block[pos:pos + length])
+        pos += length
+    return frames
+
+
+def run_worker(connection, memory_name, slot_size, engine, args, measure):
+    """Decode the frames of a shard until told to stop, in the worker.
+
+    args are the processor arguments up to report_unknown, followed by
+    its cache_size. With measure the parse counters are returned with
+    the readings of every update cycle.
+    """
+    memory = shared_memory.SharedMemory(memory_name)
+    metrics = PipelineMetrics() if measure else None
+    processor = engine(*args[:-1], metrics=metrics, cache_size=args[-1])
+    try:
+        while True:
+            message = connection.recv()
+            command = message[0]
+            if command == "frames":
+                _, slot, size = message
+                start = slot * slot_size
+                block = bytes(memory.buf[start:start + size])
+                processor.add_frames(unpack_frames(block))
+                connection.send(slot)
+            elif command == "collect":
+                readings = processor.collect(message[1])
+                connection.send(
+                    (readings, metrics, processor.cache_stats(), processor.silent)
+                )
+                if measure:
+                    metrics = processor.metrics = PipelineMetrics()
+            elif command == "devices":
+                processor.devices = message[1]
+            else:
+                break
+    finally:
+        memory.close()
+
+
+class DecodeWorker:
+    """A worker process with its shared memory block and pipe."""
+
+    def __init__(self, context, index, slot_size, engine, args, measure):
+        """Start the worker process."""
+        self.slot_size = slot_size
+        self.memory = shared_memory.SharedMemory(create=True, size=slot_size * SLOTS)
+        self.connection, child = context.Pipe()
+        self.process = context.Process(
+            target=run_worker,
+            args=(child, self.memory.name, slot_size, engine, args, measure),
+            name="PuckjsDecodeWorker{}".format(index),
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        self._slot = 0
+        # slots handed to the worker and not acknowledged yet
+        self._busy = [False] * SLOTS
+
+    def send_frames(self, frames):
+        """Hand frames over to the worker, in as many slots as needed."""
+        # frames of the largest size that fit in a slot
+        chunk = (self.slot_size - FRAME_COUNT.size) // (MAX_FRAME_SIZE + 2)
+        for start in range(0, len(frames), chunk):
+            self._send_block(frames[start:start + chunk])
+
+    def _send_block(self, frames):
+        block = pack_frames(frames)
+        if len(block) > self.slot_size:
+            # longer frames than HCI delivers
+            if len(frames) == 1:
+                _LOGGER.warning("Frame of %s bytes dropped", len(frames[0]))
+                return
+            middle = len(frames) // 2
+            self._send_block(frames[:middle])
+            self._send_block(frames[middle:])
+            return
+        slot = self._slot
+        while self._busy[slot]:
+            self._busy[self.connection.recv()] = False
+        start = slot * self.slot_size
+        self.memory.buf[start:start + len(block)] = block
+        self._busy[slot] = True
+        self.connection.send(("frames", slot, len(block)))
+        self._slot = (slot + 1) % SLOTS
+
+    def send(self, message):
+        """Send a command to the worker."""
+        self.connection.send(message)
+
+    def reply(self):
+        """Return the reply to the last command, past the acknowledgements."""
+        while True:
+            message = self.connection.recv()
+            if isinstance(message, int):
+                self._busy[message] = False
+                continue
+            return message
+
+    def stop(self, timeout=1):
+        """Stop the worker and release its shared memory."""
+        try:
+            self.connection.send(("stop",))
+        except OSError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        self.connection.close()
+        self.memory.close()
+        self.memory.unlink()
+
+
+class ShardedProcessor:
+    """Drop-in for FrameProcessor decoding in worker processes.
+
+    The frames are spread over workers processes by the address of the
+    advertising device, each runs an engine, FrameProcessor or
+    BatchProcessor, with the same arguments. With a PipelineMetrics the
+    parse counters of the workers are added to it at every collect().
+    A worker that died is restarted, the readings it held are lost.
+    The workers are spawned, not forked from the threads of Home
+    Assistant.
+    """
+
+    def __init__(
+        self,
+        whitelist,
+        devices,
+        default_device,
+        ewma_alpha=None,
+        log_spikes=False,
+        report_unknown=False,
+        metrics=None,
+        cache_size=0,
+        workers=2,
+        engine=FrameProcessor,
+        slot_size=SLOT_SIZE,
+    ):
+        """Initialize the processor and start the workers."""
+        self.metrics = metrics
+        self._devices = devices
+        self._args = (
+            whitelist,
+            device_limits(devices),
+            DeviceLimits(default_device.tmin, default_device.tmax),
+            ewma_alpha,
+            log_spikes,
+            report_unknown,
+            cache_size,
+        )
+        self._engine = engine
+        self._slot_size = slot_size
+        self._context = multiprocessing.get_context("spawn")
+        self._cache_stats = None
+        # MACs heard in the last collected cycle without readings
+        self.silent = []
+        self._workers = [self._start_worker(index) for index in range(workers)]
+
+    def _start_worker(self, index):
+        return DecodeWorker(
+            self._context,
+            index,
+            self._slot_size,
+            self._engine,
+            self._args,
+            self.metrics is not None,
+        )
+
+    def _restart_worker(self, index, error):
+        _LOGGER.error("Decode worker %s failed, restarting it: %s", index, error)
+        try:
+            self._workers[index].stop()
+        except OSError:
+            pass
+        self._workers[index] = self._start_worker(index)
+
+    @property
+    def devices(self):
+        """Return the MAC -> device config mapping."""
+        return self._devices
+
+    @devices.setter
+    def devices(self, devices):
+        """Pass changed device configs on to the workers."""
+        if devices is self._devices:
+            return
+        self._devices = devices
+        limits = device_limits(devices)
+        self._args = self._args[:1] + (limits,) + self._args[2:]
+        for index, worker in enumerate(self._workers):
+            try:
+                worker.send(("devices", limits))
+            except OSError as error:
+                self._restart_worker(index, error)
+
+    def add_frames(self, frames):
+        """Hand the frames of an update cycle over to the workers."""
+        shards = len(self._workers)
+        if not shards:
+            return
+        batches = [[] for _ in range(shards)]
+        appends = [batch.append for batch in batches]
+        for frame in frames:
+            # by the lowest byte of the address
+            try:
+                appends[frame[ADV_ADDR_START] % shards](frame)
+            except IndexError:
+                appends[0](frame)
+        for index, batch in enumerate(batches):
+            if batch:
+                try:
+                    self._workers[index].send_frames(batch)
+                except (EOFError, OSError) as error:
+                    self._restart_worker(index, error)
+
+    def collect(self, hold=None):
+        """Return the DeviceReadings of the cycle by MAC and start a new one.
+
+        hold and silent as for the processor of the workers.
+        """
+        hold = set(hold) if hold else None
+        asked = []
+        for index, worker in enumerate(self._workers):
+            try:
+                worker.send(("collect", hold))
+            except OSError as error:
+                self._restart_worker(index, error)
+            else:
+                asked.append(index)
+        readings = {}
+        silent = []
+        cache_stats = None
+        for index in asked:
+            try:
+                reply = self._workers[index].reply()
+            except (EOFError, OSError) as error:
+                self._restart_worker(index, error)
+                continue
+            shard_readings, metrics, shard_stats, shard_silent = reply
+            readings.update(shard_readings)
+            silent += shard_silent
+            if metrics is not None and self.metrics is not None:
+                self.metrics.merge_parsing(metrics)
+            if shard_stats is not None:
+                if cache_stats is None:
+                    cache_stats = dict.fromkeys(shard_stats, 0)
+                for key, value in shard_stats.items():
+                    cache_stats[key] += value
+        self._cache_stats = cache_stats
+        self.silent = silent
+        return readings
+
+    def cache_stats(self):
+        """Return the ReadingCache counters of all workers as of the last cycle."""
+        return self._cache_stats
+
+    def stop(self, timeout=1):
+        """Stop the workers."""
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop(timeout)
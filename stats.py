@@ -0,0 +1,58 @@
+"""Streaming statistics for the puck.js measurements."""
+from heapq import heappush, heappushpop
+
+
+class MeasurementAggregator:
+    """Running aggregate of one measurement of a device.
+
+    The mean is kept as a running float sum, good to floating point
+    accuracy like the mean of BatchProcessor. The median is kept exactly
+    by two heaps, the lower half of the samples in a max-heap of negated
+    values and the upper half in a min-heap, so add() takes O(log n) and
+    median() O(1). With an alpha the exponentially weighted moving
+    average is kept too, it carries over reset().
+    """
+
+    __slots__ = ("count", "ewma", "_alpha", "_sum", "_lower", "_upper")
+
+    def __init__(self, alpha=None):
+        """Initialize an empty aggregate."""
+        self._alpha = alpha or None
+        self.ewma = None
+        self.reset()
+
+    def reset(self):
+        """Start a new period."""
+        self.count = 0
+        self._sum = 0.0
+        self._lower = []
+        self._upper = []
+
+    def add(self, value):
+        """Fold in a sample."""
+        self.count += 1
+        self._sum += value
+        # the lower half holds the extra sample of an odd count
+        if self.count % 2:
+            heappush(self._lower, -heappushpop(self._upper, value))
+        else:
+            heappush(self._upper, -heappushpop(self._lower, -value))
+        if self._alpha is not None:
+            if self.ewma is None:
+                self.ewma = value
+            else:
+                self.ewma += self._alpha * (value - self.ewma)
+
+    def mean(self):
+        """Return the mean of the period's samples."""
+        if not self.count:
+            raise ZeroDivisionError("mean of an empty aggregate")
+        return self._sum / self.count
+
+    def median(self):
+        """Return the median of the period's samples."""
+        if not self.count:
+            raise IndexError("median of an empty aggregate")
+        if self.count % 2:
+            return -self._lower[0]
+        return (-self._lower[0] + self._upper[0]) / 2
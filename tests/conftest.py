@@ -0,0 +1,13 @@
+"""Import the integration as the puckjs package, see site/puckjs."""
+import os
+import sys
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(TESTS, "site"))
+
+import puckjs  # noqa: E402
+
+# pytest imports the __init__ of the directory holding tests/ under the
+# name of the directory, it is the same package
+sys.modules.setdefault(os.path.basename(os.path.dirname(TESTS)), puckjs)
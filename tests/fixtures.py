@@ -0,0 +1,191 @@
+"""Stand-ins for Home Assistant and the Bluetooth adapters."""
+import asyncio
+import os
+import sys
+from contextlib import contextmanager
+from functools import partial
+from threading import Event, Thread
+from types import SimpleNamespace
+
+from puckjs.scanner import AsyncBLEScanner, BLEScanner
+
+
+# HCI Command Complete of LE Set Scan Enable, not an advertising report
+COMMAND_COMPLETE = bytes((0x04, 0x0E, 0x04, 0x01, 0x0C, 0x20, 0x00))
+
+# Stand-in for the espruino command line tool, takes a while and exits
+FAKE_ESPRUINO = """#!{python}
+import sys, time
+time.sleep({delay})
+print("Connected to", sys.argv[2])
+sys.exit({exit_code})
+"""
+
+
+def fake_espruino(directory, delay=0, exit_code=0):
+    """Write a fake espruino to a directory, return its path."""
+    path = os.path.join(directory, "espruino")
+    with open(path, "w") as script:
+        script.write(
+            FAKE_ESPRUINO.format(
+                python=sys.executable, delay=delay, exit_code=exit_code
+            )
+        )
+    os.chmod(path, 0o755)
+    return path
+
+
+class Clock:
+    """A monotonic clock moved by hand."""
+
+    def __init__(self, now=0.0):
+        """Initialize the clock at now."""
+        self.now = now
+
+    def __call__(self):
+        """Return the time."""
+        return self.now
+
+
+class FakeHCIdump(Thread):
+    """Stand-in for HCIdump delivering a frame every interval seconds.
+
+    Once its interface is in wedged the thread stops delivering and
+    ignores join until release is set, as an HCIdump stuck on a dead
+    adapter. A new thread for the interface delivers again. Opening the
+    adapter takes open_delay seconds.
+    """
+
+    def __init__(
+        self,
+        collect,
+        interface=0,
+        active=0,
+        socket_filter=None,
+        frame=b"",
+        interval=0.001,
+        wedged=frozenset(),
+        release=None,
+        open_delay=0,
+    ):
+        """Initialize the thread, with the HCIdump arguments first."""
+        Thread.__init__(self, daemon=True)
+        self.interface = interface
+        self.abandoned = False
+        self._collect = collect
+        self._frame = frame
+        self._interval = interval
+        self._wedged = wedged
+        self._release = release
+        self._open_delay = open_delay
+        self._stopped = Event()
+        self._was_wedged = interface in wedged
+
+    def run(self):
+        """Open the adapter, then deliver frames until joined or wedged."""
+        if self._stopped.wait(self._open_delay):
+            return
+        while not self._stopped.wait(self._interval):
+            if self.interface in self._wedged and not self._was_wedged:
+                self._release.wait()
+                return
+            if not self.abandoned:
+                self._collect(self._frame)
+
+    def join(self, timeout=10):
+        """Stop delivering and join, a wedged thread does not stop."""
+        self._stopped.set()
+        Thread.join(self, timeout)
+
+
+
+
+class SlowBLEScanner(BLEScanner):
+    """BLEScanner on fake adapters taking open_delay seconds to open."""
+
+    open_delay = 1.0
+
+    def __init__(self, *args, **kwargs):
+        """Initiate the scanner with FakeHCIdump threads."""
+        super().__init__(*args, **kwargs)
+        self.dump_factory = partial(FakeHCIdump, open_delay=self.open_delay)
+
+
+class SlowAsyncBLEScanner(AsyncBLEScanner):
+    """AsyncBLEScanner on fake adapters taking open_delay seconds to open."""
+
+    open_delay = 1.0
+
+    async def _async_start_interface(self, hci_int):
+        await asyncio.sleep(self.open_delay)
+        return True
+
+
+class StubBus:
+    """Event bus of StubHass, keeping the listeners."""
+
+    def __init__(self):
+        """Initialize the bus without listeners."""
+        self.listeners = []
+
+    def listen(self, event_type, listener):
+        """Keep a listener."""
+        self.listeners.append((event_type, listener))
+
+    listen_once = async_listen = async_listen_once = listen
+
+    def fire(self, event_type):
+        """Call the listeners of an event."""
+        for listened, listener in self.listeners:
+            if listened == event_type:
+                listener(None)
+
+
+class StubHass:
+    """What the platform setup uses of Home Assistant.
+
+    The loop runs in another thread, the services and the entities are
+    dropped.
+    """
+
+    def __init__(self, loop, config_dir, data):
+        """Initialize the stand-in around an event loop."""
+        self.loop = loop
+        self.data = data
+        self.bus = StubBus()
+        self.config = SimpleNamespace(path=partial(os.path.join, config_dir))
+        self.services = SimpleNamespace(
+            register=lambda *args: None, async_register=lambda *args: None
+        )
+
+    def add_job(self, target, *args):
+        """Drop a job."""
+
+    def async_add_executor_job(self, target, *args):
+        """Run a job in the executor of the loop."""
+        return self.loop.run_in_executor(None, target, *args)
+
+    def async_create_task(self, target):
+        """Run a coroutine on the loop."""
+        return self.loop.create_task(target)
+
+
+@contextmanager
+def replaced(module, **attributes):
+    """Replace attributes of a module for the duration of the block."""
+    saved = {name: getattr(module, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+async def cancel_tasks():
+    """Cancel the other tasks of the running loop and wait for them."""
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
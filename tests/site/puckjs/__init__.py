@@ -0,0 +1,19 @@
+"""The integration under test, in the directory above tests/.
+
+The tests and the decode workers they spawn import the integration as
+the puckjs package from here. Its own package __init__ needs Home
+Assistant and only runs when Home Assistant is installed.
+"""
+import os
+from importlib.util import find_spec
+
+__path__ = [
+    os.path.dirname(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    )
+]
+
+if find_spec("homeassistant") is not None:
+    _INIT = os.path.join(__path__[0], "__init__.py")
+    with open(_INIT) as _source:
+        exec(compile(_source.read(), _INIT, "exec"))
@@ -0,0 +1,88 @@
+"""The BPF socket filter against the parser's prefilter."""
+import pytest
+
+from puckjs.bench import build_adv_report, build_puck_frame, synthetic_capture
+from puckjs.bpf import REJECT, build_filter, run_filter
+from puckjs.parser import (
+    PUCKJS_AD_MARKER,
+    compile_whitelist,
+    parse_raw_message,
+    prefilter_raw_message,
+    scan_raw_message,
+)
+
+from fixtures import COMMAND_COMPLETE
+
+PUCK = "c0:ff:ee:00:00:01"
+OTHER_PUCK = "c0:ff:ee:00:00:02"
+
+
+def has_readings(data):
+    """Return True if a PuckReading holds more than the rssi."""
+    return data is not None and any(
+        value is not None
+        for value in (data.temperature, data.battery, data.button, data.direction)
+    )
+
+
+def truncated_frames():
+    """Return puck.js advertisements cut short in various ways."""
+    frame = build_puck_frame(PUCK)
+    # the advertising data length claims more than the frame holds
+    overlong = bytearray(frame)
+    overlong[13] += 8
+    return [
+        bytes(overlong),
+        frame[:-1],
+        frame[:-4],
+        frame[:16],
+        frame[:14],
+        frame[:8],
+        build_adv_report(PUCK, [(0xFF, b"\x90")]),
+        build_adv_report(PUCK, [(0xFF, b"")]),
+    ]
+
+
+def corpus():
+    """Return a synthetic capture with extra cases and its puck MACs."""
+    capture, puck_macs = synthetic_capture(5000, pucks=4, puck_ratio=0.05)
+    capture += [build_puck_frame(PUCK), build_puck_frame(OTHER_PUCK, version=1)]
+    capture += truncated_frames()
+    return capture, puck_macs
+
+
+@pytest.mark.parametrize("whitelisted", [0, 2], ids=["discovery", "whitelist"])
+def test_filter_matches_prefilter(whitelisted):
+    capture, puck_macs = corpus()
+    whitelist = puck_macs[:whitelisted] + [PUCK] * bool(whitelisted)
+    program = build_filter(whitelist)
+    compiled = compile_whitelist(whitelist)
+    for frame in capture:
+        accepted = run_filter(program, frame) != REJECT
+        scanned = scan_raw_message(frame)
+        if scanned is not None and scanned[2] is None:
+            # no manufacturer data, at most the rssi of a scan response is lost
+            assert not accepted
+            assert not has_readings(parse_raw_message(frame, compiled))
+        elif scanned is None and not accepted:
+            # malformed reports are only dropped when cut before the payload
+            assert PUCKJS_AD_MARKER not in frame, frame.hex()
+        else:
+            assert accepted == prefilter_raw_message(frame, compiled), frame.hex()
+
+
+def test_whitelist_rejects_other_pucks():
+    program = build_filter([PUCK])
+    assert run_filter(program, build_puck_frame(PUCK)) != REJECT
+    assert run_filter(program, build_puck_frame(OTHER_PUCK)) == REJECT
+
+
+def test_non_puck_manufacturer_rejected():
+    frame = build_adv_report(PUCK, [(0xFF, b"\x4c\x00" + bytes(20))])
+    assert run_filter(build_filter(), frame) == REJECT
+    assert not prefilter_raw_message(frame, frozenset())
+
+
+def test_other_events_accepted():
+    # aioblescan needs the replies to its commands
+    assert run_filter(build_filter([PUCK]), COMMAND_COMPLETE) != REJECT
@@ -0,0 +1,81 @@
+"""Recording and replay of HCI frames."""
+import time
+
+import pytest
+
+from puckjs.bench import build_puck_frame
+from puckjs.capture import (
+    CAPTURE_MAGIC,
+    CaptureWriter,
+    read_capture,
+    replay_capture,
+)
+from puckjs.scanner import BLEScanner
+
+FRAMES = [build_puck_frame("c0:ff:ee:00:00:{:02x}".format(n)) for n in range(5)]
+
+
+@pytest.fixture
+def capture(tmp_path):
+    """Return the path of a capture of FRAMES, 50 ms apart on two interfaces."""
+    path = str(tmp_path / "frames.cap")
+    writer = CaptureWriter(path)
+    for index, frame in enumerate(FRAMES):
+        writer.append(frame, index % 2, 1000 + index * 0.05)
+    writer.close()
+    return path
+
+
+def test_round_trip(capture):
+    assert list(read_capture(capture)) == [
+        (1000 + index * 0.05, index % 2, frame) for index, frame in enumerate(FRAMES)
+    ]
+    # reopened captures are appended to
+    writer = CaptureWriter(capture)
+    writer.append(FRAMES[0], 3, 2000)
+    writer.close()
+    assert list(read_capture(capture))[-1] == (2000, 3, FRAMES[0])
+
+
+def test_truncated_record_ignored(capture):
+    with open(capture, "ab") as file:
+        file.write(open(capture, "rb").read()[len(CAPTURE_MAGIC):][:20])
+    assert [frame for _, _, frame in read_capture(capture)] == FRAMES
+
+
+def test_not_a_capture(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"not a capture")
+    with pytest.raises(ValueError):
+        list(read_capture(str(path)))
+    with pytest.raises(ValueError):
+        CaptureWriter(str(path))
+
+
+def test_replay_speed(capture):
+    frames = []
+    start = time.monotonic()
+    assert replay_capture(capture, frames.append, speed=1) == len(FRAMES)
+    assert time.monotonic() - start >= 0.19
+    assert frames == FRAMES
+    received = []
+    assert replay_capture(capture, lambda *args: received.append(args), 0, None, True)
+    assert received == [(frame, 1000 + n * 0.05) for n, frame in enumerate(FRAMES)]
+
+
+def test_scanner_records_and_replays(tmp_path, capture):
+    scanner = BLEScanner()
+    scanner.recorder = CaptureWriter(str(tmp_path / "recorded.cap"))
+    scanner.replay(capture, speed=0)
+    replay = scanner.dumpthreads[0]
+    deadline = time.monotonic() + 5
+    while replay.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert replay.frames == len(FRAMES)
+    assert scanner.drain() == FRAMES
+    scanner.stop()
+    scanner.recorder.close()
+    recorded = read_capture(scanner.recorder.path)
+    assert [(interface, frame) for _, interface, frame in recorded] == [
+        (index % 2, frame) for index, frame in enumerate(FRAMES)
+    ]
@@ -0,0 +1,61 @@
+"""Deduplication of the advertisements heard by several adapters."""
+from puckjs.bench import build_puck_frame
+from puckjs.dedup import FrameDeduplicator
+from puckjs.parser import raw_address
+from puckjs.scanner import BLEScanner
+
+from fixtures import COMMAND_COMPLETE, Clock
+
+MAC = "c0:ff:ee:00:00:01"
+
+
+def deduplicator(window=0.1, max_entries=1024):
+    released = []
+    clock = Clock()
+    dedup = FrameDeduplicator(released.append, window, max_entries, clock)
+    return dedup, released, clock
+
+
+def test_keeps_the_best_copy():
+    dedup, released, clock = deduplicator()
+    for interface, rssi in enumerate((-70, -50, -60)):
+        dedup.add(build_puck_frame(MAC, rssi=rssi), interface)
+    assert released == []
+    # the next frame after the window releases the held copy
+    clock.now = 0.2
+    dedup.add(build_puck_frame(MAC, temperature=22), 0)
+    assert released == [build_puck_frame(MAC, rssi=-50)]
+    assert dedup.duplicates == 2
+    assert dedup.take_best_interfaces() == {raw_address(MAC): 1}
+    assert dedup.take_best_interfaces() == {}
+
+
+def test_repeat_on_the_same_interface_is_kept():
+    dedup, released, _ = deduplicator()
+    frame = build_puck_frame(MAC)
+    dedup.add(frame, 0)
+    dedup.add(frame, 0)
+    dedup.flush()
+    assert released == [frame, frame]
+    assert dedup.duplicates == 0
+
+
+def test_bounded_and_passes_other_events():
+    dedup, released, _ = deduplicator(max_entries=2)
+    frames = [build_puck_frame(MAC, temperature=20 + index) for index in range(3)]
+    for frame in frames:
+        dedup.add(frame, 0)
+    assert released == frames[:1]
+    dedup.add(COMMAND_COMPLETE, 0)
+    assert released == [frames[0], COMMAND_COMPLETE]
+    dedup.flush()
+    assert released == [frames[0], COMMAND_COMPLETE] + frames[1:]
+
+
+def test_scanner_drains_one_copy():
+    scanner = BLEScanner()
+    scanner.deduplicate(10)
+    for interface in range(3):
+        scanner.collector(interface)(build_puck_frame(MAC, rssi=-60 - interface))
+    assert scanner.drain() == [build_puck_frame(MAC, rssi=-60)]
+    assert scanner.drain() == []
@@ -0,0 +1,75 @@
+"""The on-disk history of the published readings."""
+import pytest
+
+from puckjs.history import SeriesFile, Tier, HistoryStore
+
+TIERS = (Tier("raw", 0, 8), Tier("minute", 60, 8), Tier("hour", 3600, 8))
+MAC = "c0:ff:ee:00:00:01"
+START = 1600000000 - 1600000000 % 3600
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = HistoryStore(str(tmp_path), TIERS)
+    yield store
+    store.close()
+
+
+def test_downsampling(store):
+    for index in range(4):
+        store.append(MAC, START + index * 30, 20 + index, 90, -60, button=index == 1)
+    store.close()
+    _, minutes = store.query(MAC, START, START + 3600, "minute")
+    assert [record.time for record in minutes] == [START, START + 60]
+    assert [record.temperature for record in minutes] == [20.5, 22.5]
+    assert [record.count for record in minutes] == [2, 2]
+    assert [record.flags for record in minutes] == [1, 0]
+    _, hours = store.query(MAC, START, START + 3600, "hour")
+    assert [(record.count, record.temperature) for record in hours] == [(4, 21.5)]
+
+
+def test_missing_values(store):
+    store.append(MAC, START)
+    store.close()
+    record = store.query(MAC, START, START, "raw")[1][0]
+    assert (record.temperature, record.battery, record.rssi) == (None, None, None)
+
+
+def test_ring_overwrites_oldest(store):
+    for index in range(12):
+        store.append(MAC, START + index, float(index))
+    tier, records = store.query(MAC, START, START + 11, "raw")
+    assert tier == "raw"
+    assert [record.time for record in records] == list(range(START + 4, START + 12))
+    assert store.query(MAC, START + 5, START + 6, "raw")[1][0].time == START + 5
+
+
+def test_query_picks_finest_tier(store):
+    for index in range(10):
+        store.append(MAC, START + index * 30, 20.0)
+    assert store.query(MAC, START + 60, START + 300)[0] == "raw"
+    assert store.query(MAC, START, START + 300)[0] == "minute"
+    assert store.query("c0:ff:ee:00:00:02", START, START + 300) == (None, [])
+
+
+def test_reopen_merges_last_record(tmp_path):
+    store = HistoryStore(str(tmp_path), TIERS)
+    store.append(MAC, START, 20.0)
+    store.close()
+    store = HistoryStore(str(tmp_path), TIERS)
+    store.append(MAC, START + 30, 22.0)
+    store.append(MAC, START + 60, 24.0)
+    store.close()
+    for tier, expected in (
+        ("minute", [(START, 21.0, 2), (START + 60, 24.0, 1)]),
+        ("hour", [(START, 22.0, 3)]),
+    ):
+        records = store.query(MAC, START, START + 3600, tier)[1]
+        assert [record[:3] for record in records] == expected
+
+
+def test_not_a_history_file(tmp_path):
+    path = tmp_path / "other"
+    path.write_bytes(b"x" * 64)
+    with pytest.raises(ValueError):
+        SeriesFile(str(path), 8)
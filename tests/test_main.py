@@ -0,0 +1,45 @@
+"""The command line tools, run without Home Assistant."""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from puckjs.__main__ import main
+from puckjs.bench import write_capture
+
+import puckjs
+
+ROOT = puckjs.__path__[0]
+
+
+@pytest.fixture
+def capture(tmp_path):
+    path = str(tmp_path / "frames.cap")
+    write_capture(path, frames=2000, pucks=5, puck_ratio=0.2)
+    return path
+
+
+def test_decode_summary(capture, capsys):
+    assert main(["decode", capture, "--summary", "--json"]) == 0
+    summary = json.loads(capsys.readouterr().out)
+    assert len(summary) == 5
+    assert all(device["temperatures"] for device in summary.values())
+
+
+def test_unknown_argument(capture):
+    with pytest.raises(SystemExit):
+        main(["decode", capture, "--frames", "10"])
+
+
+def test_directory_run(capture):
+    """Home Assistant is not imported when running the directory."""
+    run = subprocess.run(
+        [sys.executable, ROOT, "decode", capture, "--summary", "--json"],
+        cwd=os.path.dirname(capture),
+        capture_output=True,
+        text=True,
+    )
+    assert run.returncode == 0, run.stderr
+    assert len(json.loads(run.stdout)) == 5
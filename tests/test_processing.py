@@ -0,0 +1,110 @@
+"""Folding of the frames into readings, with held devices."""
+import pytest
+
+from puckjs.bench import build_puck_frame, build_scan_response, cycle_capture
+from puckjs.bench import published_states
+from puckjs.const import CONF_TMAX, CONF_TMIN
+from puckjs.parser import FLAG_BUTTON, FLAG_DIRECTION, compile_whitelist
+from puckjs.processing import FrameProcessor
+from puckjs.publish import PublishScheduler
+from puckjs.sharding import DeviceLimits
+
+from fixtures import Clock
+
+MAC = "c0:ff:ee:00:00:01"
+CYCLE = 10
+
+
+@pytest.fixture(params=["python", "numpy"])
+def engine(request):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+        from puckjs.batch import BatchProcessor
+
+        return BatchProcessor
+    return FrameProcessor
+
+
+class Pipeline:
+    """Update cycles of a puck as run by discover_ble_devices."""
+
+    def __init__(self, engine):
+        self.clock = Clock()
+        self.scheduler = PublishScheduler(CYCLE, 600, 0.1, clock=self.clock)
+        limits = DeviceLimits(CONF_TMIN, CONF_TMAX)
+        self.processor = engine(compile_whitelist([]), {}, limits)
+        self.sequence = 0
+        self.switches = None
+
+    def cycle(self, flags=0, temperature=21.5):
+        """Run a cycle with an advertisement, return the published readings."""
+        self.scheduler.advance()
+        self.sequence += 1
+        frame = build_puck_frame(
+            MAC, temperature=temperature, flags=flags, version=1, sequence=self.sequence
+        )
+        self.processor.add_frames([frame])
+        readings = self.processor.collect(self.scheduler.waiting)
+        for mac, device in readings.items():
+            switches = (device.button, device.direction)
+            self.scheduler.schedule(
+                mac, device.temperature.mean(), switches != self.switches
+            )
+            self.switches = switches
+        self.clock.now += CYCLE
+        return readings
+
+
+def test_held_device_published_on_switch_change(engine):
+    pipeline = Pipeline(engine)
+    assert MAC in pipeline.cycle()
+    # a steady temperature stretches the interval to max_interval
+    assert MAC in pipeline.cycle()
+    assert not pipeline.cycle()
+    assert MAC in pipeline.scheduler.waiting
+    readings = pipeline.cycle(FLAG_BUTTON)
+    assert readings[MAC].button == 1
+    # the held readings of the previous cycle are folded in
+    assert readings[MAC].temperature.count == 2
+    # published again every min_interval while switching
+    assert pipeline.cycle()[MAC].button == 0
+    assert pipeline.cycle(FLAG_DIRECTION)[MAC].direction == 1
+
+
+def test_held_device_kept_without_switch_change(engine):
+    pipeline = Pipeline(engine)
+    pipeline.cycle(FLAG_DIRECTION)
+    pipeline.cycle(FLAG_DIRECTION)
+    for _ in range(5):
+        assert not pipeline.cycle(FLAG_DIRECTION, temperature=21.6)
+    readings = pipeline.cycle(FLAG_DIRECTION | FLAG_BUTTON)
+    assert readings[MAC].temperature.count == 6
+
+
+def test_silent_devices(engine):
+    pipeline = Pipeline(engine)
+    other = "c0:ff:ee:00:00:02"
+    processor = pipeline.processor
+    pipeline.cycle()
+    pipeline.cycle()
+    # held, not silent
+    processor.add_frames([build_scan_response(MAC), build_scan_response(other)])
+    assert not pipeline.cycle()
+    assert processor.silent == [other]
+    processor.add_frames([build_puck_frame(other)])
+    assert other in pipeline.cycle()
+    assert processor.silent == []
+
+
+def test_decode_cache_same_readings():
+    limits = DeviceLimits(CONF_TMIN, CONF_TMAX)
+    plain = FrameProcessor(compile_whitelist([]), {}, limits)
+    cached = FrameProcessor(compile_whitelist([]), {}, limits, cache_size=64)
+    for seed in range(3):
+        capture, _ = cycle_capture(40, seed=seed % 2, payload_version=seed % 2)
+        capture.append(None)
+        for processor in (plain, cached):
+            processor.add_frames(capture)
+        assert published_states(cached.collect()) == published_states(plain.collect())
+    stats = cached.cache_stats()
+    assert stats["hits"] and stats["evictions"]
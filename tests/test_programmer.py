@@ -0,0 +1,97 @@
+"""Programming of the pucks with espruino subprocesses."""
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+from puckjs.programmer import (
+    FAILED,
+    PROGRAMMED,
+    SKIPPED,
+    TIMEOUT,
+    FirmwareStore,
+    FirmwareWatch,
+    ProgrammingScheduler,
+    firmware_hash,
+)
+
+from fixtures import Clock, fake_espruino
+
+MACS = ["c0:ff:ee:00:00:{:02x}".format(index) for index in range(4)]
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "ha-puck.js"
+    path.write_text("NRF.setAdvertising({});\n")
+    return str(path)
+
+
+def program(scheduler, macs=MACS, force=False):
+    return asyncio.run(scheduler.async_program(macs, force))
+
+
+def test_programs_in_parallel(tmp_path, source):
+    espruino = fake_espruino(str(tmp_path), delay=0.3)
+    scheduler = ProgrammingScheduler(espruino, source, concurrency=len(MACS))
+    start = time.perf_counter()
+    assert program(scheduler) == dict.fromkeys(MACS, PROGRAMMED)
+    # one after the other takes 1.2 s
+    assert time.perf_counter() - start < 0.9
+
+
+def test_skips_pucks_on_current_firmware(tmp_path, source):
+    espruino = fake_espruino(str(tmp_path))
+    path = str(tmp_path / "firmware.json")
+    scheduler = ProgrammingScheduler(espruino, source, FirmwareStore(path))
+    assert program(scheduler, MACS[:2]) == dict.fromkeys(MACS[:2], PROGRAMMED)
+    with open(path) as store:
+        assert json.load(store) == dict.fromkeys(MACS[:2], firmware_hash(source))
+    # a new scheduler reads the store
+    scheduler = ProgrammingScheduler(espruino, source, FirmwareStore(path))
+    assert program(scheduler) == {
+        MACS[0]: SKIPPED,
+        MACS[1]: SKIPPED,
+        MACS[2]: PROGRAMMED,
+        MACS[3]: PROGRAMMED,
+    }
+    assert program(scheduler, force=True) == dict.fromkeys(MACS, PROGRAMMED)
+    with open(source, "a") as firmware:
+        firmware.write("// changed\n")
+    assert program(scheduler, MACS[:1]) == {MACS[0]: PROGRAMMED}
+
+
+def test_failures_are_not_stored(tmp_path, source):
+    path = str(tmp_path / "firmware.json")
+    store = FirmwareStore(path)
+    failing = fake_espruino(str(tmp_path), exit_code=1)
+    scheduler = ProgrammingScheduler(failing, source, store)
+    assert program(scheduler, MACS[:1]) == {MACS[0]: FAILED}
+    missing = str(tmp_path / "missing" / "espruino")
+    scheduler = ProgrammingScheduler(missing, source, store)
+    assert program(scheduler, MACS[:1]) == {MACS[0]: FAILED}
+    hanging = fake_espruino(str(tmp_path), delay=10)
+    scheduler = ProgrammingScheduler(hanging, source, store, timeout=0.2)
+    start = time.perf_counter()
+    assert program(scheduler, MACS[:1]) == {MACS[0]: TIMEOUT}
+    assert time.perf_counter() - start < 5
+    assert store.get(MACS[0]) is None
+    assert not os.path.exists(path)
+
+
+def test_firmware_watch():
+    clock = Clock()
+    watch = FirmwareWatch(60, clock)
+    assert watch.update([MACS[0], MACS[1]], {}) == []
+    clock.now = 30
+    assert watch.update([MACS[0]], {MACS[1]: None}) == []
+    clock.now = 61
+    # heard for a minute without a reading
+    assert watch.update([MACS[0], MACS[1]], {}) == [MACS[0]]
+    clock.now = 100
+    assert watch.update([MACS[0], MACS[1]], {}) == []
+    # retried after another minute
+    clock.now = 122
+    assert watch.update([MACS[0], MACS[1]], {}) == [MACS[0], MACS[1]]
@@ -0,0 +1,91 @@
+"""Change detection and scheduling of the published states."""
+from pytest import approx
+
+from puckjs.publish import ChangeFilter, PublishScheduler
+
+from fixtures import Clock
+
+
+def test_unchanged_state_skipped():
+    changes = ChangeFilter()
+    assert changes.changed("t", 20.0)
+    assert not changes.changed("t", 20.0)
+    assert changes.changed("t", None)
+    assert not changes.changed("t", None)
+    assert changes.changed("u", 20.0)
+
+
+def test_deadband_from_last_written_state():
+    changes = ChangeFilter()
+    assert changes.changed("t", 20.0, 0.2)
+    assert not changes.changed("t", 20.1, 0.2)
+    assert not changes.changed("t", 20.2, 0.2)
+    # the drift adds up from the last written 20.0
+    assert changes.changed("t", 20.3, 0.2)
+    assert not changes.changed("t", 20.1, 0.2)
+    assert changes.changed("t", None, 0.2)
+
+
+def test_heartbeat():
+    clock = Clock()
+    changes = ChangeFilter(60, clock)
+    assert changes.changed("t", 20.0)
+    clock.now = 59
+    assert not changes.changed("t", 20.0)
+    clock.now = 60
+    assert changes.changed("t", 20.0)
+    clock.now = 119
+    assert not changes.changed("t", 20.0)
+
+
+def test_forget():
+    changes = ChangeFilter()
+    changes.changed("t", 20.0)
+    changes.forget("t")
+    changes.forget("u")
+    assert changes.changed("t", 20.0)
+
+
+def test_interval_follows_rate_of_change():
+    clock = Clock()
+    scheduler = PublishScheduler(10, 600, 0.1, clock=clock)
+    # until the rate is known
+    assert scheduler.schedule("a", 20.0) == 10
+    clock.now = 10
+    assert scheduler.schedule("a", 20.0) == 600
+    clock.now = 20
+    assert scheduler.schedule("b", 20.0) == 10
+    clock.now = 120
+    # 0.1 in 100 s, due when it changed by the resolution again
+    assert scheduler.schedule("b", 20.1) == approx(100)
+    clock.now = 220
+    # halfway from 0.001 to the observed 0.002 per second
+    assert scheduler.schedule("b", 20.3) == approx(0.1 / 0.0015)
+    clock.now = 221
+    assert scheduler.schedule("b", 25.0) == 10
+    assert scheduler.schedule("b", None, switched=True) == 10
+
+
+def test_advance():
+    clock = Clock()
+    scheduler = PublishScheduler(10, 600, 0.1, clock=clock)
+    scheduler.schedule("a", 20.0)
+    scheduler.schedule("b", 20.0)
+    assert scheduler.waiting == {"a", "b"}
+    clock.now = 4
+    assert scheduler.advance() == []
+    # due within half a min_interval
+    clock.now = 5
+    assert sorted(scheduler.advance()) == ["a", "b"]
+    assert scheduler.waiting == set()
+    clock.now = 10
+    scheduler.schedule("a", 20.0)
+    scheduler.schedule("b", 20.0)
+    # a switch change brings b forward, its old entry is dropped
+    scheduler.schedule("b", switched=True)
+    clock.now = 15
+    assert scheduler.advance() == ["b"]
+    scheduler.forget("a")
+    assert scheduler.waiting == set()
+    clock.now = 1000
+    assert scheduler.advance() == []
@@ -0,0 +1,88 @@
+"""The platform setup returns quickly on adapters slow to open."""
+import asyncio
+import sys
+import time
+from threading import Thread
+
+import pytest
+
+pytest.importorskip("homeassistant")
+
+from puckjs import CONFIG_SCHEMA, DOMAIN, sensor  # noqa: E402
+from puckjs.bench import STARTUP_BUDGET  # noqa: E402
+from puckjs.const import CONF_ESPRUINO_PATH, CONF_NATIVE_SCAN  # noqa: E402
+
+from fixtures import (  # noqa: E402
+    SlowAsyncBLEScanner,
+    SlowBLEScanner,
+    StubHass,
+    cancel_tasks,
+    replaced,
+)
+
+# seconds the fake adapters take to open, far beyond the budget
+OPEN_DELAY = 1.0
+
+
+@pytest.fixture
+def loop():
+    """Return an event loop running in another thread, as Home Assistant's."""
+    loop = asyncio.new_event_loop()
+    loop_thread = Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    yield loop
+    asyncio.run_coroutine_threadsafe(cancel_tasks(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    loop_thread.join()
+    loop.close()
+
+
+@pytest.fixture
+def slow_adapters(monkeypatch):
+    """Make the adapters slow to open and drop the scheduled updates."""
+    monkeypatch.setattr(SlowBLEScanner, "open_delay", OPEN_DELAY)
+    monkeypatch.setattr(SlowAsyncBLEScanner, "open_delay", OPEN_DELAY)
+    unscheduled = dict.fromkeys(
+        ("track_point_in_utc_time", "track_time_interval", "async_track_time_interval"),
+        lambda *args: None,
+    )
+    with replaced(
+        sensor,
+        BLEScanner=SlowBLEScanner,
+        AsyncBLEScanner=SlowAsyncBLEScanner,
+        **unscheduled,
+    ):
+        yield
+
+
+@pytest.mark.usefixtures("slow_adapters")
+@pytest.mark.parametrize(
+    "entry_point, native",
+    [
+        ("setup_platform", False),
+        ("async_setup_platform", False),
+        ("async_setup_platform", True),
+    ],
+    ids=["setup_platform", "async_setup_platform", "native_scan"],
+)
+def test_setup_within_budget(loop, tmp_path, entry_point, native):
+    config = CONFIG_SCHEMA(
+        {
+            DOMAIN: {
+                # any existing file, nothing is programmed
+                CONF_ESPRUINO_PATH: sys.executable,
+                CONF_NATIVE_SCAN: native,
+            }
+        }
+    )[DOMAIN]
+    hass = StubHass(loop, str(tmp_path), {DOMAIN: config})
+    start = time.perf_counter()
+    if entry_point == "setup_platform":
+        sensor.setup_platform(hass, {}, lambda entities: None)
+    else:
+        asyncio.run_coroutine_threadsafe(
+            sensor.async_setup_platform(hass, {}, lambda entities: None), loop
+        ).result()
+    elapsed = time.perf_counter() - start
+    hass.bus.fire("homeassistant_stop")
+    assert elapsed <= STARTUP_BUDGET
@@ -0,0 +1,80 @@
+"""Decoding in worker processes sharded by MAC address."""
+import pytest
+
+from puckjs.bench import build_puck_frame, build_scan_response, cycle_capture
+from puckjs.bench import published_states
+from puckjs.const import CONF_TMAX, CONF_TMIN
+from puckjs.parser import compile_whitelist
+from puckjs.processing import FrameProcessor
+from puckjs.sharding import (
+    DeviceLimits,
+    ShardedProcessor,
+    pack_frames,
+    unpack_frames,
+)
+
+LIMITS = DeviceLimits(CONF_TMIN, CONF_TMAX)
+
+
+@pytest.fixture
+def sharded():
+    processors = []
+
+    def start(**kwargs):
+        processor = ShardedProcessor(compile_whitelist([]), {}, LIMITS, 0.1, **kwargs)
+        processors.append(processor)
+        return processor
+
+    yield start
+    for processor in processors:
+        processor.stop()
+
+
+def cycles(processor, count=2, devices=40):
+    """Run update cycles of a synthetic capture, return the published states."""
+    states = []
+    for seed in range(count):
+        capture, _ = cycle_capture(devices, seed=seed, payload_version=seed % 2)
+        processor.add_frames(capture)
+        states.append(published_states(processor.collect()))
+    return states
+
+
+def test_pack_frames():
+    frames = [build_puck_frame("c0:ff:ee:00:00:01"), b"", b"\x04"]
+    assert unpack_frames(pack_frames(frames)) == frames
+    assert unpack_frames(pack_frames([])) == []
+
+
+@pytest.mark.parametrize("slot_size", [1024 * 1024, 1024], ids=["large", "small"])
+def test_same_readings_as_in_process(sharded, slot_size):
+    expected = cycles(FrameProcessor(compile_whitelist([]), {}, LIMITS, 0.1))
+    assert cycles(sharded(workers=3, slot_size=slot_size)) == expected
+
+
+def test_hold_and_silent(sharded):
+    processor = sharded(workers=2)
+    pucks = ["c0:ff:ee:00:00:{:02x}".format(index) for index in range(4)]
+    # the first switch states are changes, held devices are published
+    processor.add_frames([build_puck_frame(mac) for mac in pucks])
+    assert set(processor.collect(hold=pucks)) == set(pucks)
+    processor.add_frames([build_puck_frame(mac) for mac in pucks])
+    processor.add_frames([build_scan_response("c0:ff:ee:00:01:00")])
+    assert set(processor.collect(hold=pucks[:2])) == set(pucks[2:])
+    assert processor.silent == ["c0:ff:ee:00:01:00"]
+    processor.add_frames([build_puck_frame(pucks[0], temperature=23.5)])
+    readings = processor.collect()
+    assert set(readings) == set(pucks[:2])
+    assert readings[pucks[0]].temperature.count == 2
+    assert processor.silent == []
+
+
+def test_dead_worker_restarted(sharded):
+    processor = sharded(workers=2)
+    cycles(processor, 1)
+    processor._workers[0].process.kill()
+    processor._workers[0].process.join()
+    # the readings of the dead worker are lost, the next cycles are whole
+    cycles(processor, 1)
+    expected = cycles(FrameProcessor(compile_whitelist([]), {}, LIMITS, 0.1), 1)
+    assert {mac for mac in cycles(processor, 1)[0]} == set(expected[0])
@@ -0,0 +1,39 @@
+"""Streaming statistics of the measurements."""
+import random
+import statistics
+
+import pytest
+
+from puckjs.stats import MeasurementAggregator
+
+
+@pytest.mark.parametrize("samples", [1, 2, 3, 10, 101])
+def test_same_as_statistics(samples):
+    rnd = random.Random(samples)
+    values = [round(rnd.uniform(15, 25), 2) for _ in range(samples)]
+    aggregate = MeasurementAggregator()
+    for value in values:
+        aggregate.add(value)
+    assert aggregate.count == samples
+    assert aggregate.median() == statistics.median(values)
+    assert aggregate.mean() == pytest.approx(statistics.mean(values), abs=1e-12)
+
+
+def test_empty():
+    aggregate = MeasurementAggregator()
+    with pytest.raises(ZeroDivisionError):
+        aggregate.mean()
+    with pytest.raises(IndexError):
+        aggregate.median()
+
+
+def test_ewma_carries_over_reset():
+    aggregate = MeasurementAggregator(0.5)
+    aggregate.add(20.0)
+    aggregate.add(22.0)
+    assert aggregate.ewma == 21.0
+    aggregate.reset()
+    aggregate.add(23.0)
+    assert (aggregate.count, aggregate.mean(), aggregate.median()) == (1, 23.0, 23.0)
+    assert aggregate.ewma == 22.0
+    assert MeasurementAggregator().ewma is None
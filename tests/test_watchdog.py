@@ -0,0 +1,123 @@
+"""Stall detection and restart of the HCI interfaces."""
+import time
+from functools import partial
+from threading import Event
+
+from puckjs.bench import build_puck_frame
+from puckjs.const import CONF_ACTIVE_SCAN, CONF_HCI_INTERFACE
+from puckjs.scanner import BLEScanner
+from puckjs.watchdog import HEALTH_DEAD, HEALTH_OK, HEALTH_STALLED, HCIWatchdog
+
+from fixtures import Clock, FakeHCIdump
+
+STALL_TIMEOUT = 0.3
+CHECK_INTERVAL = 0.05
+CONFIG = {CONF_ACTIVE_SCAN: False, CONF_HCI_INTERFACE: [0, 1, 2]}
+FRAME = build_puck_frame("c0:11:22:33:44:55")
+
+
+def silent_dump(silent, collect, interface=0, **kwargs):
+    """Return a FakeHCIdump that delivers nothing on the silent interfaces."""
+    if interface in silent:
+        collect = lambda data: None  # noqa: E731
+    return FakeHCIdump(collect, interface, frame=FRAME, **kwargs)
+
+
+def wait_for_restart(scanner, cycle=None):
+    """Run the watchdog checks until it restarts an interface.
+
+    cycle is called between the checks, returns the restarted interfaces
+    and the seconds it took.
+    """
+    start = time.perf_counter()
+    while time.perf_counter() - start < STALL_TIMEOUT * 10:
+        time.sleep(CHECK_INTERVAL)
+        if cycle is not None:
+            cycle()
+        restarted = scanner.check_watchdog()
+        if restarted:
+            return restarted, time.perf_counter() - start
+    return [], None
+
+
+def test_stall_backoff():
+    clock = Clock()
+    watchdog = HCIWatchdog(1, backoff=5, clock=clock)
+    assert watchdog.check({0: True, 1: False}) == [1]
+    assert watchdog.health()[1]["state"] == HEALTH_DEAD
+    watchdog.feed(0)
+    clock.now = 2
+    assert watchdog.check({0: True}) == [0]
+    watchdog.started(0)
+    # no frames since the restart, retried after the backoff, doubling
+    clock.now = 4
+    assert watchdog.check({0: True}) == []
+    assert watchdog.health()[0]["state"] == HEALTH_STALLED
+    clock.now = 7
+    assert watchdog.check({0: True}) == [0]
+    watchdog.started(0)
+    clock.now = 16
+    assert watchdog.check({0: True}) == []
+    clock.now = 17
+    assert watchdog.check({0: True}) == [0]
+    watchdog.started(0)
+    clock.now = 17.5
+    watchdog.feed(0)
+    assert watchdog.check({0: True}) == []
+    assert watchdog.health()[0] == {
+        "state": HEALTH_OK,
+        "last_frame_age": 0,
+        "restarts": 3,
+    }
+
+
+def test_continuous_scan_restarts_wedged_interface():
+    wedged = set()
+    release = Event()
+    scanner = BLEScanner()
+    scanner.watchdog = HCIWatchdog(STALL_TIMEOUT)
+    scanner.dump_factory = partial(
+        FakeHCIdump, frame=FRAME, wedged=wedged, release=release
+    )
+    scanner.start(CONFIG)
+    try:
+        time.sleep(CHECK_INTERVAL * 2)
+        threads = {thread.interface: thread for thread in scanner.dumpthreads}
+        wedged.add(2)
+        restarted, elapsed = wait_for_restart(scanner)
+        assert restarted == [2]
+        assert elapsed >= STALL_TIMEOUT
+        assert threads[2].abandoned
+        current = {thread.interface: thread for thread in scanner.dumpthreads}
+        assert current[0] is threads[0] and current[1] is threads[1]
+        time.sleep(CHECK_INTERVAL * 2)
+        assert scanner.check_watchdog() == []
+        assert scanner.watchdog.healthy()
+    finally:
+        release.set()
+        scanner.stop()
+
+
+def test_restarts_between_cycles_do_not_hide_a_stall():
+    """Without continuous_scan every update cycle restarts the interfaces."""
+    silent = set()
+    scanner = BLEScanner()
+    scanner.watchdog = HCIWatchdog(STALL_TIMEOUT)
+    scanner.dump_factory = partial(silent_dump, silent)
+
+    def update_cycle():
+        scanner.stop()
+        scanner.drain()
+        scanner.start(CONFIG)
+
+    scanner.start(CONFIG)
+    try:
+        time.sleep(CHECK_INTERVAL * 2)
+        assert scanner.check_watchdog() == []
+        silent.add(1)
+        restarted, elapsed = wait_for_restart(scanner, update_cycle)
+        assert restarted == [1]
+        assert STALL_TIMEOUT <= elapsed < STALL_TIMEOUT * 3
+        assert not scanner.watchdog.healthy()
+    finally:
+        scanner.stop()
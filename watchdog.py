@@ -0,0 +1,111 @@
+"""Stall detection for the HCI interfaces."""
+from time import monotonic
+
+HEALTH_OK = "ok"
+HEALTH_STALLED = "stalled"
+HEALTH_DEAD = "dead"
+
+
+class InterfaceHealth:
+    """What the watchdog knows about one HCI interface."""
+
+    __slots__ = ("state", "last_frame", "started", "restarts", "failures", "retry_at")
+
+    def __init__(self, now):
+        """Initialize the health of an interface started now."""
+        self.state = HEALTH_OK
+        self.last_frame = None
+        self.started = now
+        self.restarts = 0
+        # restarts since frames were last received
+        self.failures = 0
+        self.retry_at = None
+
+
+class HCIWatchdog:
+    """Notice HCI interfaces that stopped delivering frames.
+
+    feed() is called for every frame with its interface. An interface
+    whose HCIdump thread died, or that received no frame for
+    stall_timeout seconds since its last frame, its first check or its
+    last restart by the watchdog, is due for a restart. A restart that
+    does not bring frames back is retried after backoff seconds,
+    doubling up to max_backoff.
+    """
+
+    def __init__(self, stall_timeout=60, backoff=5, max_backoff=300, clock=monotonic):
+        """Initialize the watchdog, the times in seconds."""
+        self.stall_timeout = stall_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._clock = clock
+        # time of the last frame per interface, written by the HCIdump threads
+        self._last_frame = {}
+        self._health = {}
+
+    def feed(self, interface):
+        """Note a frame received on an interface."""
+        self._last_frame[interface] = self._clock()
+
+    def started(self, interface):
+        """Note a restart by the watchdog, the stall timer starts now."""
+        health = self._health.get(interface)
+        if health is None:
+            self._health[interface] = InterfaceHealth(self._clock())
+        else:
+            health.started = self._clock()
+
+    def check(self, alive):
+        """Return the interfaces to restart now.
+
+        alive maps the scanning interfaces to whether their HCIdump
+        thread (or connection) is alive.
+        """
+        now = self._clock()
+        due = []
+        for interface, is_alive in alive.items():
+            health = self._health.get(interface)
+            if health is None:
+                health = self._health[interface] = InterfaceHealth(now)
+            last_frame = self._last_frame.get(interface)
+            health.last_frame = last_frame
+            restarted = last_frame is None or last_frame < health.started
+            quiet_since = health.started if restarted else last_frame
+            if not is_alive:
+                health.state = HEALTH_DEAD
+            elif now - quiet_since > self.stall_timeout:
+                health.state = HEALTH_STALLED
+            else:
+                if not restarted:
+                    # frames since the last (re)start
+                    health.failures = 0
+                    health.retry_at = None
+                health.state = HEALTH_OK
+                continue
+            if health.retry_at is not None and now < health.retry_at:
+                continue
+            health.retry_at = now + min(
+                self.backoff * 2 ** health.failures, self.max_backoff
+            )
+            health.failures += 1
+            health.restarts += 1
+            due.append(interface)
+        return due
+
+    def healthy(self):
+        """Return True if all interfaces are healthy."""
+        return all(health.state == HEALTH_OK for health in self._health.values())
+
+    def health(self):
+        """Return the health per interface as a dict of plain values."""
+        now = self._clock()
+        return {
+            interface: {
+                "state": health.state,
+                "last_frame_age": None
+                if health.last_frame is None
+                else round(now - health.last_frame, 1),
+                "restarts": health.restarts,
+            }
+            for interface, health in sorted(self._health.items())
+        }